@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Measure insert rates for each database durability mode.
+
+Each mode is measured both with one commit per data point (what
+``POST /api/v1/data`` does by default) and with batched commits (what the
+write buffer and the socket listeners do).
+
+Usage::
+
+    python benchmarks/durability.py [--dir DIR] [--single N] [--batched N]
+
+Use ``--dir`` to run on the same disk that will hold the real database:
+the results depend almost entirely on how long that disk takes to sync.
+"""
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+from trendlines import db
+from trendlines import logger
+from trendlines import orm
+
+BATCH_SIZE = 1000
+METRICS = ["bench.metric_{}".format(n) for n in range(10)]
+
+
+def _points(n, offset=0):
+    return [(METRICS[i % len(METRICS)], i * 0.5, 1546532003 + offset + i)
+            for i in range(n)]
+
+
+def run(directory, mode, n_single, n_batched):
+    """
+    Return the ``(single, batched)`` insert rates for one mode, in rows/s.
+    """
+    path = Path(directory) / "bench_{}.db".format(mode)
+    orm.create_db(str(path), pragmas=orm.get_pragmas(mode))
+    orm.db.connect(reuse_if_open=True)
+    db.invalidate_metric_cache()
+    for name in METRICS:
+        db.get_metric_id(name, create=True)
+
+    start = time.perf_counter()
+    for metric, value, timestamp in _points(n_single):
+        db.insert_datapoint(metric, value, timestamp)
+    single = n_single / (time.perf_counter() - start)
+
+    points = _points(n_batched, offset=n_single)
+    start = time.perf_counter()
+    for n in range(0, len(points), BATCH_SIZE):
+        db.insert_datapoints(points[n:n + BATCH_SIZE])
+    batched = n_batched / (time.perf_counter() - start)
+
+    orm.db.close()
+    return single, batched
+
+
+@click.command()
+@click.option("--dir", "directory", default=None,
+              help="Where to create the database files.")
+@click.option("--single", "n_single", default=2000,
+              help="Data points to insert one commit at a time.")
+@click.option("--batched", "n_batched", default=100000,
+              help="Data points to insert %s per commit." % BATCH_SIZE)
+def main(directory, n_single, n_batched):
+    logger.remove()
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        print("| Mode     | 1 row/commit | {} rows/commit |".format(BATCH_SIZE))
+        print("|----------|--------------|------------------|")
+        for mode in ("fast", "balanced", "durable"):
+            single, batched = run(tmp, mode, n_single, n_batched)
+            print("| {:<8} | {:>10,.0f}/s | {:>14,.0f}/s |"
+                  .format(mode, single, batched))
+
+
+if __name__ == "__main__":
+    main()
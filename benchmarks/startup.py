@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Measure how long it takes to open an up-to-date database at startup.
+
+This is the work done by :func:`orm.create_db` (and so by every
+``create_app()`` call) before the first request can be served. The fast
+path compares the schema version stored in the database with the packaged
+migrations; the full path builds a :class:`peewee_moves.DatabaseManager`
+and compares the migration history table with the migrations directory.
+
+Usage::
+
+    python benchmarks/startup.py [--runs N]
+
+Run it from the project directory, so that ``migrations/`` can be found.
+"""
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+from trendlines import logger
+from trendlines import orm
+
+
+def _reset_schema_version(path):
+    orm.db.init(str(path))
+    orm.db.pragma("user_version", 0)
+    orm.db.close()
+
+
+def run(path, runs, fast):
+    """
+    Return the average time, in milliseconds, of one ``create_db`` call.
+    """
+    total = 0
+    for _ in range(runs):
+        if not fast:
+            _reset_schema_version(path)
+        start = time.perf_counter()
+        orm.create_db(str(path))
+        total += time.perf_counter() - start
+    return 1000 * total / runs
+
+
+@click.command()
+@click.option("--runs", default=200, help="The number of startups to time.")
+def main(runs):
+    logger.remove()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "startup.db"
+        orm.create_db(str(path))
+        full = run(path, runs, fast=False)
+        fast = run(path, runs, fast=True)
+    print("| Path | create_db  |")
+    print("|------|------------|")
+    print("| full | {:>7.2f} ms |".format(full))
+    print("| fast | {:>7.2f} ms |".format(fast))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""
+add_datapoint_metric_id_timestamp_index
+date created: 2026-10-17 09:12:44.503118
+"""
+
+# A covering index for time-window reads of a single metric. Together with
+# the implicit rowid (datapoint_id), it holds every column of `datapoint`,
+# so range queries never need to touch the table itself.
+#
+# The old single-column index on `metric_id` is a prefix of the new index,
+# so it's dropped: it would only slow down inserts. The new index still
+# satisfies the "index the child key of a foreign key" advice given in
+# migration 0006.
+
+DOWNGRADE = """
+CREATE INDEX IF NOT EXISTS "datapoint_metric_id" ON "datapoint" ("metric_id");
+DROP INDEX IF EXISTS "datapoint_metric_id_timestamp_value";
+"""
+
+UPGRADE = """
+CREATE INDEX IF NOT EXISTS "datapoint_metric_id_timestamp_value"
+  ON "datapoint" ("metric_id", "timestamp", "value");
+DROP INDEX IF EXISTS "datapoint_metric_id";
+"""
+
+
+def upgrade(migrator):
+    for line in UPGRADE.split(";"):
+        sql = line + ";"
+        migrator.execute_sql(sql)
+
+
+def downgrade(migrator):
+    for line in DOWNGRADE.split(";"):
+        sql = line + ";"
+        migrator.execute_sql(sql)
@@ -0,0 +1,49 @@
+"""
+create_table_rollup
+date created: 2026-10-17 14:05:12.118524
+"""
+
+# Per-bucket summaries of each metric's data, at several resolutions. Each
+# row covers the `resolution` seconds starting at `bucket` (a POSIX
+# timestamp). `first` and `last` are the values of the earliest and latest
+# data points in the bucket, found at `first_timestamp` and `last_timestamp`.
+#
+# The primary key is also the only index we need: reads are always for one
+# metric and resolution over a range of buckets. Hence WITHOUT ROWID.
+#
+# Existing data is *not* rolled up here, since that could take a long time
+# on a large database. See `flask backfill-rollups`.
+
+DOWNGRADE = """
+DROP TABLE IF EXISTS "rollup";
+"""
+
+UPGRADE = """
+CREATE TABLE IF NOT EXISTS "rollup" (
+  "metric_id"  INTEGER NOT NULL,
+  "resolution"  INTEGER NOT NULL,
+  "bucket"  INTEGER NOT NULL,
+  "count"  INTEGER NOT NULL,
+  "total"  REAL NOT NULL,
+  "minimum"  REAL NOT NULL,
+  "maximum"  REAL NOT NULL,
+  "first"  REAL NOT NULL,
+  "first_timestamp"  INTEGER NOT NULL,
+  "last"  REAL NOT NULL,
+  "last_timestamp"  INTEGER NOT NULL,
+  PRIMARY KEY ("metric_id", "resolution", "bucket"),
+  FOREIGN KEY ("metric_id") REFERENCES "metric" ("metric_id") ON DELETE CASCADE
+) WITHOUT ROWID;
+"""
+
+
+def upgrade(migrator):
+    for line in UPGRADE.split(";"):
+        sql = line + ";"
+        migrator.execute_sql(sql)
+
+
+def downgrade(migrator):
+    for line in DOWNGRADE.split(";"):
+        sql = line + ";"
+        migrator.execute_sql(sql)
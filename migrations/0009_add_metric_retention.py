@@ -0,0 +1,18 @@
+"""
+add_metric_retention
+date created: 2026-10-18 09:41:37.204815
+"""
+
+# Per-metric retention policies. Data older than `retention_days`, or not
+# among the newest `retention_points` data points, is deleted by
+# `db.apply_retention`. NULL means that the global default applies.
+
+
+def upgrade(migrator):
+    migrator.add_column('metric', 'retention_days', 'float', null=True)
+    migrator.add_column('metric', 'retention_points', 'int', null=True)
+
+
+def downgrade(migrator):
+    migrator.drop_column('metric', 'retention_points')
+    migrator.drop_column('metric', 'retention_days')
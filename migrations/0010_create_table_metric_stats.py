@@ -0,0 +1,55 @@
+"""
+create_table_metric_stats
+date created: 2026-10-18 11:02:54.630118
+"""
+
+# Summary statistics of each metric's data, so that questions such as "how
+# many data points are there?" or "what's the latest value?" don't need to
+# read the whole series. One row per metric that has data; timestamps are
+# POSIX timestamps. The rows are kept up to date by the `db` module.
+#
+# Unlike the rollups, existing data is summarized here: it's a single pass
+# over the `(metric_id, timestamp, value)` index.
+
+DOWNGRADE = """
+DROP TABLE IF EXISTS "metric_stats";
+"""
+
+UPGRADE = """
+CREATE TABLE IF NOT EXISTS "metric_stats" (
+  "metric_id"  INTEGER NOT NULL PRIMARY KEY,
+  "count"  INTEGER NOT NULL,
+  "total"  REAL NOT NULL,
+  "total_squares"  REAL NOT NULL,
+  "minimum"  REAL NOT NULL,
+  "maximum"  REAL NOT NULL,
+  "first_timestamp"  INTEGER NOT NULL,
+  "last_timestamp"  INTEGER NOT NULL,
+  "last_value"  REAL NOT NULL,
+  FOREIGN KEY ("metric_id") REFERENCES "metric" ("metric_id") ON DELETE CASCADE
+);
+INSERT INTO "metric_stats"
+  SELECT "metric_id", COUNT(*), SUM("value"), SUM("value" * "value"),
+         MIN("value"), MAX("value"), MIN("timestamp"), MAX("timestamp"),
+         0
+  FROM "datapoint"
+  GROUP BY "metric_id";
+UPDATE "metric_stats" SET "last_value" = (
+  SELECT "value" FROM "datapoint"
+  WHERE "datapoint"."metric_id" = "metric_stats"."metric_id"
+  ORDER BY "timestamp" DESC, "datapoint_id" DESC
+  LIMIT 1
+);
+"""
+
+
+def upgrade(migrator):
+    for line in UPGRADE.split(";"):
+        sql = line + ";"
+        migrator.execute_sql(sql)
+
+
+def downgrade(migrator):
+    for line in DOWNGRADE.split(";"):
+        sql = line + ";"
+        migrator.execute_sql(sql)
@@ -17,7 +17,8 @@ def make_db_from_orm():
     print("making...")
     orm.db.init("internal.db", pragmas=orm.DB_OPTS)
     orm.db.connect()
-    orm.db.create_tables([orm.Metric, orm.DataPoint])
+    orm.db.create_tables([orm.Metric, orm.DataPoint, orm.Rollup,
+                          orm.MetricStats])
     orm.db.close()
     print("Done.")
 
@@ -14,6 +14,7 @@ long_descr = Path("./README.md").read_text()
 
 requires = [
     "flask>=1.0",
+    "numpy>=1.13",
     "peewee>=3.8",
 ]
 
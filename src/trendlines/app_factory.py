@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
+import atexit
 import os
 from traceback import format_exc
 
+import click
 from flask import Flask
+from flask import current_app
 from flask import g
+from flask import request
+from flask.cli import with_appcontext
+from peewee import DoesNotExist
 from peewee import OperationalError
 
 from trendlines import _logging
+from trendlines import db
 from trendlines import logger
 from trendlines import routes
 from trendlines import orm
@@ -48,7 +55,19 @@ def create_app():
     routes.api_class.register_blueprint(routes.api_metric)
 
     # Create the database file and populate initial tables if needed.
-    orm.create_db(app.config['DATABASE'])
+    orm.create_db(app.config['DATABASE'], pragmas=get_db_pragmas(app.config))
+    orm.db.set_pooled(app.config['DB_POOL'])
+
+    # Cached metric ids are only valid for the database they came from.
+    db.invalidate_metric_cache()
+    db.metric_id_cache.resize(app.config['METRIC_ID_CACHE_SIZE'])
+    db.metric_id_cache.ttl = app.config['METRIC_ID_CACHE_TTL']
+    db.metric_tree_cache.ttl = app.config['METRIC_TREE_CACHE_TTL']
+
+    setup_write_buffer(app)
+
+    app.cli.add_command(backfill_rollups)
+    app.cli.add_command(apply_retention)
 
     # If I redesign the architecture a bit, then these could be moved so
     # that they only act on the `api` blueprint instead of the entire app.
@@ -71,14 +90,127 @@ def create_app():
             https://github.com/coleifer/peewee/blob/master/examples/twitter/app.py#L152
         """
         g.db = orm.db
+        read_only = (request.method in ("GET", "HEAD")
+                     and app.config['DB_READ_ONLY_GET'])
         try:
-            g.db.connect()
+            g.db.connect(read_only=read_only)
         except OperationalError:
             pass
 
     @app.after_request
     def after_request(response):
-        g.db.close()
+        if response.is_streamed:
+            # The body is still being read from the database.
+            response.call_on_close(g.db.close)
+        else:
+            g.db.close()
         return response
 
     return app
+
+
+def setup_write_buffer(app):
+    """
+    Create (or remove) the process-wide :class:`db.WriteBuffer`.
+
+    Any existing buffer is flushed and closed first. The buffer is also
+    flushed when the interpreter exits.
+
+    If ``WRITE_BUFFER_ENABLED`` is ``None``, the buffer is only used when
+    ``DB_DURABILITY`` is "balanced".
+    """
+    if db.write_buffer is not None:
+        db.write_buffer.close()
+        atexit.unregister(db.write_buffer.close)
+        db.write_buffer = None
+
+    enabled = app.config['WRITE_BUFFER_ENABLED']
+    if enabled is None:
+        # Batched commits are part of the "balanced" durability mode.
+        enabled = app.config['DB_DURABILITY'] == "balanced"
+    if not enabled:
+        return
+
+    max_rows = app.config['WRITE_BUFFER_MAX_ROWS']
+    max_latency = app.config['WRITE_BUFFER_MAX_LATENCY_MS'] / 1000
+    logger.info("Buffering writes: up to %s rows or %s ms."
+                % (max_rows, app.config['WRITE_BUFFER_MAX_LATENCY_MS']))
+    db.write_buffer = db.WriteBuffer(max_rows, max_latency,
+                                     app.config['WRITE_BUFFER_MAX_PENDING'])
+    atexit.register(db.write_buffer.close)
+
+
+@click.command("backfill-rollups")
+@click.option("--metric", "metrics", multiple=True,
+              help="Only backfill this metric. Can be given more than once.")
+def backfill_rollups(metrics):
+    """
+    Recalculate the rollup tables from the raw data.
+
+    Run this once after upgrading, to roll up the data that was added before
+    the rollup tables existed. Each metric is done in its own transaction.
+    """
+    orm.db.connect(reuse_if_open=True)
+    try:
+        if metrics:
+            metric_ids = []
+            for name in metrics:
+                try:
+                    metric_ids.append(db.get_metric_id(name))
+                except DoesNotExist:
+                    msg = "Metric '%s' does not exist." % name
+                    raise click.BadParameter(msg, param_hint="--metric")
+        else:
+            metric_ids = [m.metric_id for m
+                          in orm.Metric.select(orm.Metric.metric_id)]
+
+        total = 0
+        for metric_id in metric_ids:
+            total += db.rebuild_rollups(metric_id)
+        click.echo("Rolled up %s data points of %s metrics."
+                   % (total, len(metric_ids)))
+    finally:
+        orm.db.close()
+
+
+@click.command("apply-retention")
+@with_appcontext
+def apply_retention():
+    """
+    Delete the data that is outside of the retention policies.
+
+    Uses each metric's own policy, or else ``RETENTION_DAYS`` and
+    ``RETENTION_POINTS``. The celery beat scheduler runs this every
+    ``RETENTION_INTERVAL`` seconds; use this command to run it from cron
+    instead.
+    """
+    config = current_app.config
+    orm.db.connect(reuse_if_open=True)
+    try:
+        count = db.apply_retention(config['RETENTION_DAYS'],
+                                   config['RETENTION_POINTS'],
+                                   config['RETENTION_CHUNK_SIZE'])
+        click.echo("Deleted %s data points." % count)
+    finally:
+        orm.db.close()
+
+
+def get_db_pragmas(config):
+    """
+    Return the SQLite pragmas for the ``DB_*`` settings in ``config``.
+
+    Parameters
+    ----------
+    config : dict-like
+        A Flask or Celery config.
+
+    Returns
+    -------
+    pragmas : dict
+        See :func:`orm.get_pragmas`.
+    """
+    return orm.get_pragmas(
+        durability=config['DB_DURABILITY'],
+        cache_size=config['DB_CACHE_SIZE'],
+        extra=config['DB_PRAGMAS'],
+    )
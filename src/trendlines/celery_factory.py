@@ -4,17 +4,17 @@ Celery factory and related functions.
 """
 import errno
 import os
-import socketserver
 import types
 from pathlib import Path
 from traceback import format_exc
 
-import requests
 from celery import Celery
 from celery.exceptions import ImproperlyConfigured
 
-from trendlines import utils
+from trendlines import db
+from trendlines import listeners
 from trendlines import logger
+from trendlines import orm
 
 # TODO: queueing?
 
@@ -117,37 +117,62 @@ def create_celery():
     TCP_PORT = celery.conf['TCP_PORT']
     HOST = celery.conf['TARGET_HOST']
     URL = celery.conf['TRENDLINES_API_URL']
+    BATCH_SIZE = celery.conf['LISTENER_BATCH_SIZE']
+    BATCH_DELAY = celery.conf['LISTENER_BATCH_DELAY']
+    MAX_PENDING = celery.conf['LISTENER_MAX_PENDING']
+    WRITER = celery.conf['LISTENER_WRITER']
+    DATABASE = celery.conf['DATABASE']
+    METRIC_ID_CACHE_TTL = celery.conf['LISTENER_METRIC_ID_CACHE_TTL']
+    PRAGMAS = orm.get_pragmas(
+        durability=celery.conf['DB_DURABILITY'],
+        cache_size=celery.conf['DB_CACHE_SIZE'],
+        extra=celery.conf['DB_PRAGMAS'],
+    )
+    RETENTION_DAYS = celery.conf['RETENTION_DAYS']
+    RETENTION_POINTS = celery.conf['RETENTION_POINTS']
+    RETENTION_CHUNK_SIZE = celery.conf['RETENTION_CHUNK_SIZE']
+    celery.conf.beat_schedule = {
+        'apply-retention': {
+            'task': __name__ + '.apply_retention',
+            'schedule': celery.conf['RETENTION_INTERVAL'],
+        },
+    }
     celery.finalize()
     logger.debug("Celery has been finalized.")
 
 
-    class TCPHandler(socketserver.BaseRequestHandler):
-        def handle(self):
-            data = self.request.recv(1024).strip()
-            try:
-                parsed = utils.parse_socket_data(data)
-                logger.debug("TCP: {}".format(parsed))
-            except ValueError:
-                logger.warn("TCP: Failed to parse `%s`." % data)
-                return
-
-            try:
-                r = requests.post(URL, json=parsed)
-                logger.info(r.status_code)
-            except Exception:
-                raise
-            self.request.sendall(b"accepted")
-
     @celery.task
     def listen_to_tcp():
-        hp = (HOST, TCP_PORT)
-        logger.info("listening for TCP on %s:%s" % hp)
-        with socketserver.TCPServer(hp, TCPHandler) as server:
-            server.serve_forever()
+        listeners.serve_forever(HOST, tcp_port=TCP_PORT, writer=WRITER,
+                                database=DATABASE, url=URL,
+                                batch_size=BATCH_SIZE,
+                                batch_delay=BATCH_DELAY, pragmas=PRAGMAS,
+                                metric_id_cache_ttl=METRIC_ID_CACHE_TTL,
+                                max_pending=MAX_PENDING)
 
-    # Start our tasks
+    @celery.task
+    def listen_to_udp():
+        listeners.serve_forever(HOST, udp_port=UDP_PORT, writer=WRITER,
+                                database=DATABASE, url=URL,
+                                batch_size=BATCH_SIZE,
+                                batch_delay=BATCH_DELAY, pragmas=PRAGMAS,
+                                metric_id_cache_ttl=METRIC_ID_CACHE_TTL,
+                                max_pending=MAX_PENDING)
+
+    @celery.task
+    def apply_retention():
+        orm.open_db(DATABASE, pragmas=PRAGMAS)
+        orm.db.connect(reuse_if_open=True)
+        try:
+            db.apply_retention(RETENTION_DAYS, RETENTION_POINTS,
+                               RETENTION_CHUNK_SIZE)
+        finally:
+            orm.db.close()
+
+    # Start our tasks. Each listener holds on to a worker process for good,
+    # see `worker_concurrency` in the default config.
     logger.debug("Starting tasks")
-    #  listen_to_udp.delay()
+    listen_to_udp.delay()
     listen_to_tcp.delay()
 
     return celery
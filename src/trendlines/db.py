@@ -9,16 +9,119 @@ we need that information to determine things like which ErrorResponse
 to send.
 """
 
+import math
+import sys
+import threading
+import time
 from datetime import datetime
 from datetime import timezone
 
+import numpy as np
+from peewee import Expression
+from peewee import IntegrityError
+from peewee import SQL
+from peewee import chunked
+from peewee import fn
+
 from trendlines import logger
+from . import utils
 from .orm import Metric
 from .orm import DataPoint
+from .orm import MetricStats
+from .orm import Rollup
+from .orm import ROLLUP_RESOLUTIONS
 from .orm import db as _db
 
+# Number of rows per multi-row INSERT statement.
+_INSERT_BATCH_SIZE = 100
+
+# Number of rows per rollup INSERT. Each row has 11 parameters, and we need
+# to stay below SQLITE_MAX_VARIABLE_NUMBER (999 on older builds).
+_ROLLUP_BATCH_SIZE = 80
+
+# Number of data points read at a time when recalculating rollups.
+_ROLLUP_REBUILD_CHUNK_SIZE = 10000
+
+# Number of data points deleted per transaction by retention and by
+# `delete_metric`. Each transaction is short, so that writers are never
+# locked out for long.
+_DELETE_CHUNK_SIZE = 5000
+
+# Seconds that retention waits between two deletion chunks, so that writers
+# waiting for the lock get it before the next chunk does. `delete_metric`
+# runs within a request, so it doesn't wait.
+_DELETE_CHUNK_PAUSE = 0.01
+
+# Merge a new per-bucket summary into an existing `rollup` row. The
+# parameters are numbered in the order of the row tuples built by
+# `_add_to_rollups`, and the bare column names are the values already
+# stored. This doesn't use UPSERT, which needs SQLite 3.24.
+_ROLLUP_UPDATE = """
+UPDATE "rollup" SET
+  "count" = "count" + ?4,
+  "total" = "total" + ?5,
+  "minimum" = min("minimum", ?6),
+  "maximum" = max("maximum", ?7),
+  "first" = CASE WHEN ?9 < "first_timestamp" THEN ?8 ELSE "first" END,
+  "first_timestamp" = min("first_timestamp", ?9),
+  "last" = CASE WHEN ?11 >= "last_timestamp" THEN ?10 ELSE "last" END,
+  "last_timestamp" = max("last_timestamp", ?11)
+WHERE "metric_id" = ?1 AND "resolution" = ?2 AND "bucket" = ?3
+"""
+
+_ROLLUP_INSERT = """
+INSERT INTO "rollup" ("metric_id", "resolution", "bucket", "count", "total",
+                      "minimum", "maximum", "first", "first_timestamp",
+                      "last", "last_timestamp")
+VALUES {values}
+"""
+
+# Merge new data points into an existing `metric_stats` row, like
+# `_ROLLUP_UPDATE`. The parameters are numbered in the order of the row
+# tuples built by `_add_to_metric_stats`.
+_METRIC_STATS_UPDATE = """
+UPDATE "metric_stats" SET
+  "count" = "count" + ?2,
+  "total" = "total" + ?3,
+  "total_squares" = "total_squares" + ?4,
+  "minimum" = min("minimum", ?5),
+  "maximum" = max("maximum", ?6),
+  "first_timestamp" = min("first_timestamp", ?7),
+  "last_value" = CASE WHEN ?8 >= "last_timestamp" THEN ?9
+                      ELSE "last_value" END,
+  "last_timestamp" = max("last_timestamp", ?8)
+WHERE "metric_id" = ?1
+"""
+
+_METRIC_STATS_INSERT = """
+INSERT INTO "metric_stats" ("metric_id", "count", "total", "total_squares",
+                            "minimum", "maximum", "first_timestamp",
+                            "last_timestamp", "last_value")
+VALUES {values}
+"""
+
+# The errors raised by inserting a data point that can't be stored.
+_INVALID_POINT_ERRORS = (IntegrityError, OverflowError, TypeError, ValueError)
 
-def add_metric(name, units=None, lower_limit=None, upper_limit=None):
+# Process-local cache of metric name -> metric_id, used by the write path.
+# Other processes can't invalidate it, so it also expires. The size and the
+# expiry are set from ``METRIC_ID_CACHE_SIZE`` and ``METRIC_ID_CACHE_TTL``
+# when the app is created.
+metric_id_cache = utils.LRUCache(maxsize=10000, ttl=10)
+
+# Process-local cache of the children of every metric tree node, as used by
+# :func:`get_metric_tree_children`. Other processes can't invalidate it, so it
+# also expires after ``METRIC_TREE_CACHE_TTL`` seconds.
+metric_tree_cache = utils.CachedValue(ttl=60)
+
+# The process-wide :class:`WriteBuffer`, or ``None`` if data points are
+# written immediately. Set up from ``WRITE_BUFFER_ENABLED`` when the app is
+# created.
+write_buffer = None
+
+
+def add_metric(name, units=None, lower_limit=None, upper_limit=None,
+               retention_days=None, retention_points=None):
     """
     Add a new metric to the database.
 
@@ -37,6 +140,12 @@ def add_metric(name, units=None, lower_limit=None, upper_limit=None):
     upper_limit: float, optional
         The upper limit for data. Data values above this limit will trigger
         email alerts.
+    retention_days : float, optional
+        Delete data once it is this many days old. See
+        :func:`apply_retention`.
+    retention_points : int, optional
+        Only keep this many of the newest data points. See
+        :func:`apply_retention`.
 
     Returns
     -------
@@ -46,9 +155,10 @@ def add_metric(name, units=None, lower_limit=None, upper_limit=None):
     Raises
     ------
     ValueError
-        The provide limits do not satisfy ``upper_limit <= lower_limit``.
+        The provide limits do not satisfy ``upper_limit <= lower_limit``,
+        or the retention policy is out of range.
     TypeError
-        The provided limits are not numeric or ``None``.
+        The provided limits or retention policy are not numeric or ``None``.
     """
     logger.debug("Querying metric '%s'" % name)
 
@@ -63,19 +173,119 @@ def add_metric(name, units=None, lower_limit=None, upper_limit=None):
             logger.error("upper_limit not greater than lower_limit.")
             raise ValueError("upper_limit must be greater than lower_limit")
 
+    check_retention(retention_days, retention_points)
+
     metric, created = Metric.get_or_create(
         name=name,
         units=units,
         lower_limit=lower_limit,
         upper_limit=upper_limit,
+        retention_days=retention_days,
+        retention_points=retention_points,
     )
     if created:
         logger.info("Metric '%s' created." % name)
+        metric_tree_cache.invalidate()
     else:
         logger.debug("Found existing metric '%s'." % name)
     return metric
 
 
+def check_retention(retention_days=None, retention_points=None):
+    """
+    Check a metric's retention policy before it is saved.
+
+    Parameters
+    ----------
+    retention_days : float or None
+        Must be greater than zero.
+    retention_points : int or None
+        Must be at least 1.
+
+    Raises
+    ------
+    TypeError
+        ``retention_days`` is not a number, or ``retention_points`` is not
+        an integer.
+    ValueError
+        A value is out of range.
+    """
+    # bool is a subclass of int, but `True` days makes no sense.
+    if retention_days is not None:
+        if (isinstance(retention_days, bool)
+                or not isinstance(retention_days, (int, float))):
+            raise TypeError("retention_days must be a number or None.")
+        if not (0 < retention_days and math.isfinite(retention_days)):
+            raise ValueError("retention_days must be greater than zero.")
+
+    if retention_points is not None:
+        if (isinstance(retention_points, bool)
+                or not isinstance(retention_points, int)):
+            raise TypeError("retention_points must be an integer or None.")
+        if retention_points < 1:
+            raise ValueError("retention_points must be at least 1.")
+
+
+def get_metric_id(name, create=False):
+    """
+    Return the ``metric_id`` of a metric, using the metric id cache.
+
+    Parameters
+    ----------
+    name : str
+        The full metric name.
+    create : bool, optional
+        If ``True``, create the metric if it does not exist.
+
+    Returns
+    -------
+    metric_id : int
+
+    Raises
+    ------
+    Metric.DoesNotExist : :class:`peewee.DoesNotExist`
+        if the metric is not found and ``create`` is ``False``.
+    """
+    metric_id = metric_id_cache.get(name)
+    if metric_id is not None:
+        return metric_id
+
+    try:
+        metric_id = (Metric
+                     .select(Metric.metric_id)
+                     .where(Metric.name == name)
+                     .get()
+                     .metric_id)
+    except Metric.DoesNotExist:
+        if not create:
+            raise
+        metric_id = add_metric(name).metric_id
+
+    metric_id_cache.set(name, metric_id)
+    return metric_id
+
+
+def invalidate_metric_cache(name=None):
+    """
+    Drop cached metric lookups.
+
+    Must be called whenever a metric is renamed or deleted. This also
+    drops the cached metric tree.
+
+    Parameters
+    ----------
+    name : str, optional
+        The metric name to drop. If ``None``, the entire cache is cleared.
+    """
+    metric_tree_cache.invalidate()
+    if name is None:
+        logger.debug("Clearing metric id cache.")
+        metric_id_cache.clear()
+    else:
+        logger.debug("Dropping metric '%s' from the metric id cache." % name)
+        metric_id_cache.discard(name)
+
+
 def insert_datapoint(metric, value, timestamp=None):
     """
     Add a new datapoint for a given metric.
@@ -96,28 +306,391 @@ def insert_datapoint(metric, value, timestamp=None):
         An instance of the newly-created model object.
     """
     logger.debug("Adding data point %s to metric '%s'" % (value, metric))
-    metric = Metric.get(Metric.name == metric)
 
     if timestamp is None:
         logger.debug("Timestamp not given, using current time.")
         timestamp = datetime.now(timezone.utc).timestamp()
 
-    new = DataPoint.create(
-        metric=metric,
-        value=value,
-        timestamp=timestamp,
-    )
+    try:
+        return _insert_datapoint(get_metric_id(metric), value, timestamp)
+    except IntegrityError:
+        # The cached metric may have been deleted by another process, which
+        # can't invalidate our cache. Try again without it.
+        logger.warning("Failed to add data point. Retrying without the"
+                       " metric id cache.")
+        invalidate_metric_cache(metric)
+        return _insert_datapoint(get_metric_id(metric), value, timestamp)
+
+
+def _insert_datapoint(metric_id, value, timestamp):
+    """
+    Insert a single data point. See :func:`insert_datapoint`.
+    """
+    with _db.atomic():
+        new = DataPoint.create(
+            metric=metric_id,
+            value=value,
+            timestamp=timestamp,
+        )
+        _add_to_rollups([(metric_id, value, timestamp)])
+        _add_to_metric_stats([(metric_id, value, timestamp)])
     return new
 
 
-def get_data(metric):
+def insert_datapoints(points, skip_invalid=False):
+    """
+    Add many datapoints, possibly for many metrics, in a single transaction.
+
+    Metrics that do not exist are created automatically. Each distinct
+    metric name is only resolved once, no matter how many points reference
+    it.
+
+    Parameters
+    ----------
+    points : iterable of (metric, value, timestamp) tuples
+        ``metric`` is the full metric name, ``value`` is numeric and
+        ``timestamp`` is the POSIX timestamp of the data point. If
+        ``timestamp`` is ``None``, the current timestamp is used.
+    skip_invalid : bool, optional
+        If ``True``, drop the points that can't be stored, with a warning,
+        instead of failing the whole batch. See
+        :func:`_insert_valid_datapoints`.
+
+    Returns
+    -------
+    count : int
+        The number of datapoints that were inserted.
+    """
+    points = list(points)
+    if len(points) == 0:
+        return 0
+
+    if skip_invalid:
+        return _insert_valid_datapoints(points)
+
+    logger.debug("Adding %s data points." % len(points))
+    now = datetime.now(timezone.utc).timestamp()
+
+    try:
+        metric_ids, created = _insert_datapoints(points, now)
+    except IntegrityError:
+        # A cached metric may have been deleted by another process, which
+        # can't invalidate our cache. Try again without it.
+        logger.warning("Failed to add data points. Retrying without the"
+                       " metric id cache.")
+        invalidate_metric_cache()
+        metric_ids, created = _insert_datapoints(points, now)
+
+    # Only cache the ids once we know the transaction was committed.
+    for name, metric_id in metric_ids.items():
+        metric_id_cache.set(name, metric_id)
+    if created:
+        metric_tree_cache.invalidate()
+
+    logger.info("Added %s data points." % len(points))
+    return len(points)
+
+
+def _insert_valid_datapoints(points):
+    """
+    Insert data points, dropping the ones that can't be stored.
+
+    Points that fail :func:`utils.validate_data_point` are dropped up front.
+    If the rest still can't be inserted, the batch is split in half and each
+    half is inserted on its own, so that a bad point only loses itself.
+
+    Returns
+    -------
+    count : int
+        The number of datapoints that were inserted.
+    """
+    valid = []
+    for point in points:
+        try:
+            valid.append(utils.validate_data_point(*point))
+        except ValueError as err:
+            logger.warning("Dropped data point %s: %s" % (point, err))
+    return _insert_bisecting(valid)
+
+
+def _insert_bisecting(points):
+    """
+    Insert data points, splitting the batch in half each time it fails.
+    """
+    if len(points) == 0:
+        return 0
+    try:
+        return insert_datapoints(points)
+    except _INVALID_POINT_ERRORS as err:
+        if len(points) == 1:
+            logger.warning("Dropped data point %s: %s" % (points[0], err))
+            return 0
+    half = len(points) // 2
+    return _insert_bisecting(points[:half]) + _insert_bisecting(points[half:])
+
+
+def _insert_datapoints(points, now):
+    """
+    Insert data points in a single transaction. See :func:`insert_datapoints`.
+
+    Returns
+    -------
+    metric_ids : dict
+    created : bool
+        ``True`` if any metric was created.
+    """
+    with _db.atomic():
+        names = set(p[0] for p in points)
+        metric_ids, created = _get_or_create_metric_ids(names)
+
+        rows = [
+            {
+                DataPoint.metric: metric_ids[metric],
+                DataPoint.value: value,
+                DataPoint.timestamp: now if timestamp is None else timestamp,
+            }
+            for metric, value, timestamp in points
+        ]
+
+        # Stay well below SQLITE_MAX_VARIABLE_NUMBER (999 on older builds).
+        for batch in chunked(rows, _INSERT_BATCH_SIZE):
+            DataPoint.insert_many(batch).execute()
+
+        points = [(row[DataPoint.metric],
+                   row[DataPoint.value],
+                   row[DataPoint.timestamp])
+                  for row in rows]
+        _add_to_rollups(points)
+        _add_to_metric_stats(points)
+
+    return metric_ids, created
+
+
+class WriteBuffer(object):
+    """
+    Coalesce data points and write them many at a time, in the background.
+
+    Data points given to :meth:`add` are written by a background thread
+    with :func:`insert_datapoints`, one transaction per batch. A batch is
+    written once it holds ``max_rows`` data points or once its oldest data
+    point has waited ``max_latency`` seconds, whichever comes first.
+
+    Data points that are still buffered when the process dies are lost, so
+    call :meth:`close` on shutdown.
+
+    At most ``max_pending`` data points are buffered. Once it is full,
+    :meth:`add` waits for the background thread to make room, so callers
+    are slowed down to the write rate instead of using ever more memory.
+
+    Parameters
+    ----------
+    max_rows : int
+        The most data points to write in one transaction.
+    max_latency : float
+        The longest time, in seconds, that a data point is buffered.
+    max_pending : int, optional
+        The most data points to buffer. Defaults to ten batches.
+    """
+    def __init__(self, max_rows, max_latency, max_pending=None):
+        self.max_rows = max_rows
+        self.max_latency = max_latency
+        if max_pending is None:
+            max_pending = 10 * max_rows
+        self.max_pending = max(max_pending, max_rows)
+        self._points = []
+        self._deadline = None
+        self._closed = False
+        lock = threading.Lock()
+        # Wakes the background thread when a batch may be due.
+        self._cond = threading.Condition(lock)
+        # Wakes callers of `add` that are waiting for room.
+        self._room = threading.Condition(lock)
+        # Only one batch is written at a time, so that batches are written
+        # in order. Also used by `flush` to wait for the writer thread.
+        self._write_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run,
+                                        name="WriteBuffer", daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._points)
+
+    def add(self, metric, value, timestamp=None):
+        """
+        Buffer a data point. See :func:`insert_datapoint`.
+
+        The metric is created when the data point is written, if needed.
+        Blocks while the buffer is full.
+
+        Raises
+        ------
+        ValueError
+            The data point fails :func:`utils.validate_data_point`.
+        RuntimeError
+            The buffer is closed.
+        """
+        # Reject bad points now: once buffered, the caller has been told
+        # that they were accepted.
+        utils.validate_data_point(metric, value, timestamp)
+        if timestamp is None:
+            # Use the time of arrival, not the time of the write.
+            timestamp = datetime.now(timezone.utc).timestamp()
+        with self._cond:
+            while len(self._points) >= self.max_pending and not self._closed:
+                self._room.wait()
+            if self._closed:
+                raise RuntimeError("WriteBuffer is closed.")
+            if not self._points:
+                # Start the clock on a new batch.
+                self._deadline = time.monotonic() + self.max_latency
+                self._cond.notify()
+            self._points.append((metric, value, timestamp))
+            if len(self._points) >= self.max_rows:
+                self._cond.notify()
+
+    def flush(self):
+        """
+        Write all buffered data points now, ``max_rows`` at a time.
+        """
+        with self._write_lock:
+            # Don't chase data points that are added while flushing.
+            remaining = len(self._points)
+            while remaining > 0:
+                points = self._take()
+                if not points:
+                    break
+                self._write(points)
+                remaining -= len(points)
+
+    def close(self):
+        """
+        Stop the background thread and write any buffered data points.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+            self._room.notify_all()
+        self._thread.join()
+        self.flush()
+
+    def _take(self):
+        """
+        Remove and return the next batch of at most ``max_rows`` points.
+        """
+        with self._cond:
+            points = self._points[:self.max_rows]
+            del self._points[:self.max_rows]
+            if not self._points:
+                self._deadline = None
+            # The points left over are newer, so the current deadline is
+            # early enough for them too.
+            self._room.notify_all()
+        return points
+
+    def _wait(self):
+        """
+        Wait until a batch is due. Return ``False`` once closed.
+        """
+        with self._cond:
+            while not self._closed:
+                if len(self._points) >= self.max_rows:
+                    return True
+                if self._deadline is None:
+                    self._cond.wait()
+                    continue
+                timeout = self._deadline - time.monotonic()
+                if timeout <= 0:
+                    return True
+                self._cond.wait(timeout)
+            return False
+
+    def _run(self):
+        while self._wait():
+            with self._write_lock:
+                self._write(self._take())
+
+    def _write(self, points):
+        if not points:
+            return
+        # Connections are per-thread. Only close the ones we open.
+        was_closed = _db.is_closed()
+        try:
+            if was_closed:
+                _db.connect()
+            try:
+                # Don't lose the whole batch to one bad point.
+                insert_datapoints(points, skip_invalid=True)
+            finally:
+                if was_closed:
+                    _db.close()
+        except Exception:
+            logger.exception("Failed to write %s buffered data points."
+                             % len(points))
+
+
+def _get_or_create_metric_ids(names):
     """
-    Return all of the data for a given metric.
+    Return a ``{name: metric_id}`` dict, creating any missing metrics.
+
+    Must be called within a transaction.
+
+    Parameters
+    ----------
+    names : set of str
+        The full metric names to resolve.
+
+    Returns
+    -------
+    metric_ids : dict
+    created : bool
+        ``True`` if any metric was created.
+    """
+    metric_ids = {}
+    for name in names:
+        metric_id = metric_id_cache.get(name)
+        if metric_id is not None:
+            metric_ids[name] = metric_id
+
+    missing = sorted(names - metric_ids.keys())
+    for batch in chunked(missing, _INSERT_BATCH_SIZE):
+        query = (Metric
+                 .select(Metric.name, Metric.metric_id)
+                 .where(Metric.name.in_(batch))
+                 .tuples())
+        metric_ids.update(query)
+
+    created = names - metric_ids.keys()
+    for name in created:
+        metric_ids[name] = Metric.create(name=name).metric_id
+        logger.info("Metric '%s' created." % name)
+
+    return metric_ids, bool(created)
+
+
+def get_data(metric, start=None, end=None, limit=None, descending=False):
+    """
+    Return the data for a given metric, ordered by timestamp.
+
+    The time window given by ``start`` and ``end``, the ordering and the
+    limit are all applied within the query, where they're satisfied by the
+    ``(metric_id, timestamp, value)`` index on the ``datapoint`` table.
 
     Parameters
     ----------
     metric : str
         The full metric name.
+    start : int or :class:`datetime.datetime`, optional
+        Only return data at or after this time. Integers are POSIX
+        timestamps; datetimes must be naive UTC.
+    end : int or :class:`datetime.datetime`, optional
+        Only return data before this time.
+    limit : int, optional
+        Return at most this many data points.
+    descending : bool, optional
+        If ``True``, return the newest data first. Combined with ``limit``
+        this returns the most recent data points.
 
     Returns
     -------
@@ -126,10 +699,55 @@ def get_data(metric):
         :class:`orm.DataPoint` objects
     """
     logger.debug("Querying data for '%s'" % metric)
-    metric = Metric.get(Metric.name == metric)
-    data = DataPoint.select().where(DataPoint.metric == metric.metric_id)
+    metric_id = get_metric_id(metric)
+
+    data = _data_in_window(metric_id, start, end)
+
+    # Ties are broken by insertion order.
+    if descending:
+        data = data.order_by(DataPoint.timestamp.desc(),
+                             DataPoint.datapoint_id.desc())
+    else:
+        data = data.order_by(DataPoint.timestamp, DataPoint.datapoint_id)
+
+    if limit is not None:
+        data = data.limit(limit)
+
     return data
 
+
+def count_data(metric, start=None, end=None):
+    """
+    Return the number of data points of a metric in a time window.
+
+    Only reads the ``(metric_id, timestamp, value)`` index.
+
+    Parameters
+    ----------
+    metric : str
+        The full metric name.
+    start, end : int or :class:`datetime.datetime`, optional
+        The time window. See :func:`get_data`.
+
+    Returns
+    -------
+    count : int
+
+    Raises
+    ------
+    Metric.DoesNotExist : :class:`peewee.DoesNotExist`
+        if the metric is not found.
+    """
+    metric_id = get_metric_id(metric)
+    if start is not None:
+        start = _to_timestamp(start)
+    if end is not None:
+        end = _to_timestamp(end)
+    query = (_data_in_window(metric_id, start, end)
+             .select(fn.COUNT(DataPoint.datapoint_id)))
+    return query.scalar()
+
+
 def get_recent_data(metric, age):
     """
     Return all data that is less than `age` seconds old.
@@ -146,27 +764,107 @@ def get_recent_data(metric, age):
     data : iterable of :class:`orm.DataPoint` objects
     """
     logger.debug("Querying last %s seconds of data for '%s'." % (age, metric))
-    metric = Metric.get(Metric.name == metric)
     now = datetime.now(timezone.utc).timestamp()
-
-    data = DataPoint.select().where(
-        (DataPoint.metric == metric.metric_id)
-        & (DataPoint.timestamp > (now - age))
-    )
-
-    return data
+    return get_data(metric).where(DataPoint.timestamp > (now - age))
 
 
-def get_metrics():
+def get_metrics(after=None, before=None, limit=None):
     """
-    Return a list of all metrics.
+    Return a list of all metrics, ordered by ``metric_id``.
+
+    Supports keyset pagination: see :func:`paginate` for a description of
+    the ``after``, ``before`` and ``limit`` parameters.
 
     Returns
     -------
     metrics : iterable of :class:`orm.Metric` objects
     """
     logger.debug("Querying list of metrics.")
-    return Metric.select()
+    return paginate(Metric.select(), Metric.metric_id, after, before, limit)
+
+
+def get_metric_stats(metric):
+    """
+    Return the summary statistics of a metric's data.
+
+    Parameters
+    ----------
+    metric : str or int
+        The full metric name or the ``metric_id``.
+
+    Returns
+    -------
+    stats : :class:`orm.MetricStats` or None
+        ``None`` if the metric has no data.
+
+    Raises
+    ------
+    Metric.DoesNotExist : :class:`peewee.DoesNotExist`
+        if the metric is not found.
+    """
+    if not isinstance(metric, int):
+        metric = get_metric_id(metric)
+    stats = MetricStats.get_or_none(MetricStats.metric == metric)
+    if stats is None:
+        # Tell "no data" apart from "no such metric".
+        Metric.get_by_id(metric)
+    return stats
+
+
+def get_latest(prefix=None):
+    """
+    Return the newest data point of each metric that has data.
+
+    This is read from the metric stats, so it's a single query no matter
+    how much data there is.
+
+    Parameters
+    ----------
+    prefix : str, optional
+        Only include the metrics whose name starts with this string. Case
+        sensitive.
+
+    Returns
+    -------
+    latest : :class:`peewee.ModelSelect`
+        Acts like an iterable of ``(name, units, timestamp, value)`` tuples,
+        ordered by name. ``timestamp`` is a POSIX timestamp.
+    """
+    logger.debug("Querying the latest data points for prefix '%s'" % prefix)
+    query = (Metric
+             .select(Metric.name,
+                     Metric.units,
+                     MetricStats.last_timestamp,
+                     MetricStats.last_value)
+             .join(MetricStats, on=(MetricStats.metric == Metric.metric_id))
+             .order_by(Metric.name))
+    if prefix:
+        # A range on the unique index of names. Unlike LIKE, this is case
+        # sensitive and treats "%" and "_" literally.
+        query = query.where(Metric.name >= prefix)
+        upper = _prefix_upper_bound(prefix)
+        if upper is not None:
+            query = query.where(Metric.name < upper)
+    return query.tuples()
+
+
+def _prefix_upper_bound(prefix):
+    """
+    Return the smallest string greater than every string that starts with
+    ``prefix``, or ``None`` if there is no such string.
+
+    SQLite compares text by its UTF-8 bytes, which sorts like code points
+    as long as surrogates (which can't be encoded) are skipped.
+    """
+    while prefix:
+        code = ord(prefix[-1]) + 1
+        if 0xD800 <= code <= 0xDFFF:
+            code = 0xE000
+        if code <= sys.maxunicode:
+            return prefix[:-1] + chr(code)
+        # The last character is already the largest one.
+        prefix = prefix[:-1]
+    return None
 
 
 def get_units(metric):
@@ -185,9 +883,43 @@ def get_units(metric):
     return units
 
 
-def get_datapoints():
+def get_metric_tree_children(node_id="#"):
     """
-    Return a list of all datapoints.
+    Return the direct children of a node in the metric tree.
+
+    The tree is cached, so this only queries the database after a metric
+    was created, renamed or deleted.
+
+    Parameters
+    ----------
+    node_id : str, optional
+        The id of the tree node, which is the (possibly partial) dotted
+        metric name. Defaults to the root node ``#``.
+
+    Returns
+    -------
+    children : list of dict
+        See :func:`utils.build_jstree_children`. Must not be modified.
+
+    Raises
+    ------
+    KeyError
+        The node does not exist.
+    """
+    def build():
+        logger.debug("Building metric tree.")
+        tree = utils.build_jstree_data(get_metrics())
+        return utils.build_jstree_children(tree)
+
+    return metric_tree_cache.get(build)[node_id]
+
+
+def get_datapoints(after=None, before=None, limit=None):
+    """
+    Return a list of all datapoints, ordered by ``datapoint_id``.
+
+    Supports keyset pagination: see :func:`paginate` for a description of
+    the ``after``, ``before`` and ``limit`` parameters.
 
     Returns
     -------
@@ -196,7 +928,48 @@ def get_datapoints():
     """
     logger.debug("Querying list of datapoints.")
     # TODO: Should I raise DoesNotExist if there's no data?
-    return DataPoint.select()
+    return paginate(_datapoints_with_metric(), DataPoint.datapoint_id,
+                    after, before, limit)
+
+
+def paginate(query, key, after=None, before=None, limit=None):
+    """
+    Apply keyset (cursor) pagination to a query.
+
+    Unlike ``OFFSET`` pagination, this seeks directly to the cursor through
+    the primary key, so every page costs the same no matter how deep into
+    the table it is.
+
+    Parameters
+    ----------
+    query : :class:`peewee.ModelSelect`
+        The query to paginate.
+    key : :class:`peewee.Field`
+        The unique field to paginate on, typically the primary key.
+    after : int, optional
+        Only return rows whose ``key`` is greater than this value.
+    before : int, optional
+        Only return rows whose ``key`` is less than this value. The rows
+        closest to ``before`` are returned, in **descending** order.
+    limit : int, optional
+        Return at most this many rows.
+
+    Returns
+    -------
+    query : :class:`peewee.ModelSelect`
+    """
+    if after is not None:
+        query = query.where(key > after)
+
+    if before is not None:
+        query = query.where(key < before).order_by(key.desc())
+    else:
+        query = query.order_by(key)
+
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query
 
 
 def get_datapoint(datapoint_id):
@@ -214,7 +987,20 @@ def get_datapoint(datapoint_id):
         ``None`` if the item isn't found.
     """
     logger.debug("Querying datapoint: %s" % datapoint_id)
-    return DataPoint.get_by_id(datapoint_id)
+    return (_datapoints_with_metric()
+            .where(DataPoint.datapoint_id == datapoint_id)
+            .get())
+
+
+def _datapoints_with_metric():
+    """
+    Select datapoints along with their metric, in a single query.
+
+    Accessing ``datapoint.metric`` on the results (which includes
+    :func:`playhouse.shortcuts.model_to_dict`) then doesn't need to query
+    the metric table for every datapoint.
+    """
+    return DataPoint.select(DataPoint, Metric).join(Metric)
 
 
 def update_datapoint(datapoint, metric=None, value=None, timestamp=None):
@@ -267,6 +1053,10 @@ def update_datapoint(datapoint, metric=None, value=None, timestamp=None):
         logger.warning(msg % datapoint)
         raise
 
+    # The rollups of both the old and the new day need to be recalculated.
+    old = (datapoint.metric_id, datapoint.timestamp)
+    old_value = datapoint.value
+
     # We should only get down here if the row exists.
     if metric is not None:
         datapoint.metric = metric
@@ -291,7 +1081,16 @@ def update_datapoint(datapoint, metric=None, value=None, timestamp=None):
     # will not end up creating a row.
     # We want people to either (a) use the PK or (b) query the DataPoint
     # object before running this function.
-    datapoint.save()
+    with _db.atomic():
+        datapoint.save()
+        for metric_id, timestamp in {old, (datapoint.metric_id,
+                                           datapoint.timestamp)}:
+            _rebuild_rollups_of_day(metric_id, timestamp)
+        # Treat it as a data point that moved.
+        _remove_from_metric_stats(old[0], [old_value])
+        _add_to_metric_stats([(datapoint.metric_id,
+                               datapoint.value,
+                               datapoint.timestamp)])
 
     return datapoint
 
@@ -315,4 +1114,748 @@ def delete_datapoint(datapoint):
     if isinstance(datapoint, int):
         datapoint = get_datapoint(datapoint)
 
-    datapoint.delete_instance()
+    with _db.atomic():
+        if datapoint.delete_instance() == 0:
+            msg = "Unable to find datapoint %s. Nothing deleted."
+            logger.warning(msg % datapoint)
+            raise DataPoint.DoesNotExist(msg % datapoint)
+        # A timestamp of 0 is read back as None. See peewee#1875.
+        timestamp = datapoint.timestamp
+        if timestamp is None:
+            timestamp = 0
+        _rebuild_rollups_of_day(datapoint.metric_id, timestamp)
+        _remove_from_metric_stats(datapoint.metric_id, [datapoint.value])
+
+
+def delete_metric(metric, chunk_size=_DELETE_CHUNK_SIZE):
+    """
+    Delete a metric and all of its data.
+
+    The data is deleted ``chunk_size`` data points per transaction, and the
+    metric itself last. Unlike letting the deletion cascade from the metric,
+    this never holds the write lock for long, so data can still be written
+    while a large metric is being deleted.
+
+    Parameters
+    ----------
+    metric : int or :class:`orm.Metric`
+        The metric to delete. Can be provided as an ``int`` for the
+        ``metric_id`` or as a :class:`~orm.Metric` object directly.
+    chunk_size : int, optional
+        The number of data points to delete per transaction.
+
+    Returns
+    -------
+    count : int
+        The number of data points that were deleted.
+
+    Raises
+    ------
+    Metric.DoesNotExist : :class:`peewee.DoesNotExist`
+        if the ``metric`` or ``metric_id`` is not found.
+    """
+    if not isinstance(metric, Metric):
+        metric = Metric.get_by_id(metric)
+
+    logger.info("Deleting metric '%s'." % metric.name)
+    count = _delete_data_before(metric.metric_id, None, chunk_size)
+    metric.delete_instance()
+    invalidate_metric_cache(metric.name)
+    logger.info("Deleted metric '%s' and %s data points."
+                % (metric.name, count))
+    return count
+
+
+def apply_retention(days=None, points=None, chunk_size=_DELETE_CHUNK_SIZE):
+    """
+    Delete the data that is outside of each metric's retention policy.
+
+    Data is deleted once it is older than ``retention_days`` or is no longer
+    among the newest ``retention_points`` data points of its metric. A
+    metric's own ``retention_days`` and ``retention_points`` take precedence
+    over the defaults given here.
+
+    The oldest data is deleted first, ``chunk_size`` data points per
+    transaction, so that writers are never locked out for long.
+
+    Parameters
+    ----------
+    days : float, optional
+        The default maximum age of data, in days.
+    points : int, optional
+        The default number of data points to keep for each metric.
+    chunk_size : int, optional
+        The number of data points to delete per transaction.
+
+    Returns
+    -------
+    count : int
+        The number of data points that were deleted.
+    """
+    metrics = list(Metric.select(Metric.metric_id,
+                                 Metric.name,
+                                 Metric.retention_days,
+                                 Metric.retention_points))
+    total = 0
+    for metric in metrics:
+        metric_days = metric.retention_days
+        if metric_days is None:
+            metric_days = days
+        metric_points = metric.retention_points
+        if metric_points is None:
+            metric_points = points
+
+        cutoff = get_retention_cutoff(metric.metric_id, metric_days,
+                                      metric_points)
+        if cutoff is None:
+            continue
+        count = _delete_data_before(metric.metric_id, cutoff, chunk_size,
+                                    pause=_DELETE_CHUNK_PAUSE)
+        if count:
+            logger.info("Retention: deleted %s data points of '%s'."
+                        % (count, metric.name))
+        total += count
+    return total
+
+
+def get_retention_cutoff(metric_id, days=None, points=None, now=None):
+    """
+    Return the time before which a metric's data should be deleted.
+
+    Parameters
+    ----------
+    metric_id : int
+    days : float, optional
+        The maximum age of data, in days.
+    points : int, optional
+        The number of data points to keep. Must be at least 1. Data points
+        with the same timestamp as the oldest one kept are also kept.
+    now : int or :class:`datetime.datetime`, optional
+        The time that ``days`` is counted back from. Defaults to the
+        current time.
+
+    Returns
+    -------
+    cutoff : int or None
+        A POSIX timestamp, or ``None`` if there is nothing to delete.
+    """
+    cutoff = None
+    if days is not None:
+        if now is None:
+            now = time.time()
+        cutoff = _to_timestamp(_to_timestamp(now) - days * 86400)
+    if points is not None:
+        query = (DataPoint.select(DataPoint.timestamp)
+                 .where(DataPoint.metric == metric_id)
+                 .order_by(DataPoint.timestamp.desc())
+                 .limit(1)
+                 .offset(points - 1))
+        # Read the raw timestamp. See peewee#1875.
+        row = _db.execute_sql(*query.sql()).fetchone()
+        if row is not None and (cutoff is None or row[0] > cutoff):
+            cutoff = row[0]
+    return cutoff
+
+
+def _delete_data_before(metric_id, cutoff, chunk_size, pause=0):
+    """
+    Delete a metric's data points older than ``cutoff``, oldest first.
+
+    Each chunk of ``chunk_size`` data points is deleted in its own
+    transaction, along with the rollups of the days that no longer have any
+    data. The rollups of the last day touched are recalculated at the end.
+
+    Parameters
+    ----------
+    metric_id : int
+    cutoff : int or None
+        A POSIX timestamp. If ``None``, delete all of the metric's data.
+    chunk_size : int
+    pause : float, optional
+        Seconds to wait between two chunks.
+
+    Returns
+    -------
+    count : int
+        The number of data points that were deleted.
+    """
+    day = ROLLUP_RESOLUTIONS['day']
+    chunk = DataPoint.select(DataPoint.datapoint_id,
+                             DataPoint.timestamp,
+                             DataPoint.value)
+    chunk = chunk.where(DataPoint.metric == metric_id)
+    if cutoff is not None:
+        chunk = chunk.where(DataPoint.timestamp < cutoff)
+    # Ordering by the timestamp alone lets SQLite walk the
+    # (metric_id, timestamp, value) index instead of sorting.
+    chunk = chunk.order_by(DataPoint.timestamp).limit(chunk_size)
+    ids = chunk.select(DataPoint.datapoint_id)
+
+    count = 0
+    newest = None
+    stale = False
+    while True:
+        with _db.atomic():
+            rows = _db.execute_sql(*chunk.sql()).fetchall()
+            if rows:
+                (DataPoint.delete()
+                 .where(DataPoint.datapoint_id.in_(ids))
+                 .execute())
+                # Everything before the newest deleted data point is gone,
+                # so the days before its day have nothing left to roll up.
+                newest = rows[-1][1]
+                (Rollup.delete()
+                 .where(Rollup.metric == metric_id,
+                        Rollup.bucket < newest - newest % day)
+                 .execute())
+                # Finding the new min and max means reading all of the
+                # metric's data, so only do it once, at the end.
+                stale |= _remove_from_metric_stats(
+                    metric_id, [row[2] for row in rows],
+                    refresh_extremes=False)
+        count += len(rows)
+        if len(rows) < chunk_size:
+            break
+        if pause:
+            time.sleep(pause)
+
+    if newest is not None:
+        _rebuild_rollups_of_day(metric_id, newest)
+    if stale:
+        _refresh_metric_extremes(metric_id)
+    return count
+
+
+def get_rollups(metric, resolution, start=None, end=None, descending=False):
+    """
+    Return the rollups of a metric at one resolution, ordered by time.
+
+    Buckets are never split: the first one returned is the one that holds
+    ``start``, so it may begin before ``start``.
+
+    Parameters
+    ----------
+    metric : str
+        The full metric name.
+    resolution : int
+        The bucket size in seconds. One of :data:`orm.ROLLUP_RESOLUTIONS`.
+    start : int or :class:`datetime.datetime`, optional
+        Only return buckets that end after this time.
+    end : int or :class:`datetime.datetime`, optional
+        Only return buckets that start before this time.
+    descending : bool, optional
+        If ``True``, return the newest bucket first.
+
+    Returns
+    -------
+    rollups : :class:`peewee.ModelSelect`
+        Acts like an iterable of :class:`orm.Rollup` objects.
+    """
+    logger.debug("Querying %ss rollups for '%s'" % (resolution, metric))
+    query = _rollups_in_window(get_metric_id(metric), resolution, start, end)
+    if descending:
+        return query.order_by(Rollup.bucket.desc())
+    return query.order_by(Rollup.bucket)
+
+
+def choose_resolution(metric, start=None, end=None, max_points=None):
+    """
+    Pick the rollup resolution to use for showing at most ``max_points``.
+
+    This is the coarsest resolution that still has at least ``max_points``
+    buckets over the data's time span, so that no detail is lost compared
+    to downsampling the raw data. Rollups are only used if they have fewer
+    buckets than there are data points.
+
+    Parameters
+    ----------
+    metric : str
+        The full metric name.
+    start, end : int or :class:`datetime.datetime`, optional
+        The time window. See :func:`get_data`.
+    max_points : int
+        The point budget.
+
+    Returns
+    -------
+    resolution : int or None
+        The bucket size in seconds, or ``None`` if the raw data fits within
+        ``max_points``, or if some of it has not been rolled up.
+    """
+    metric_id = get_metric_id(metric)
+    day = ROLLUP_RESOLUTIONS['day']
+    query = (_rollups_in_window(metric_id, day, start, end)
+             .select(fn.SUM(Rollup.count),
+                     fn.MIN(Rollup.first_timestamp),
+                     fn.MAX(Rollup.last_timestamp)))
+    count, first, last = query.tuples().get()
+    if not count or count <= max_points:
+        return None
+    # Reading incomplete rollups would silently leave data out.
+    if not _rollups_complete(metric_id):
+        return None
+
+    if start is not None:
+        first = max(first, _to_timestamp(start))
+    if end is not None:
+        last = min(last, _to_timestamp(end) - 1)
+
+    for resolution in sorted(ROLLUP_RESOLUTIONS.values(), reverse=True):
+        # The number of buckets in the window, empty or not.
+        buckets = last // resolution - first // resolution + 1
+        if max_points <= buckets < count:
+            return resolution
+    return None
+
+
+def aggregate(metric, bucket, aggregates, start=None, end=None):
+    """
+    Aggregate a metric's data over fixed time buckets.
+
+    Buckets start at multiples of ``bucket`` seconds since the epoch (UTC),
+    and only the buckets that have data are returned.
+
+    ``count``, ``sum``, ``mean``, ``min``, ``max`` and ``std`` are
+    calculated by SQLite with ``GROUP BY``. When ``bucket`` and the time
+    window line up with a rollup resolution, the first five are read from
+    the rollups instead. Percentiles are calculated with NumPy, from all of
+    the data in the window at once; use :func:`count_data` to check that it
+    fits in memory first.
+
+    Parameters
+    ----------
+    metric : str
+        The full metric name.
+    bucket : int
+        The bucket size in seconds.
+    aggregates : list of str
+        Any of ``count``, ``sum``, ``mean``, ``min``, ``max``, ``std`` (the
+        population standard deviation), ``median``, or a percentile such as
+        ``p95`` or ``p99.9``.
+    start, end : int or :class:`datetime.datetime`, optional
+        The time window. See :func:`get_data`.
+
+    Returns
+    -------
+    buckets : list of int
+        The POSIX timestamp of the start of each bucket.
+    columns : dict
+        Maps each of ``aggregates`` to a list with one value per bucket.
+
+    Raises
+    ------
+    ValueError
+        An aggregate is not recognized.
+    Metric.DoesNotExist : :class:`peewee.DoesNotExist`
+        if the metric is not found.
+    """
+    percentiles = {}
+    for name in aggregates:
+        if name not in utils.SQL_AGGREGATES:
+            percentiles[name] = utils.parse_percentile(name)
+
+    logger.debug("Aggregating '%s' over %ss buckets: %s"
+                 % (metric, bucket, ", ".join(aggregates)))
+    metric_id = get_metric_id(metric)
+    if start is not None:
+        start = _to_timestamp(start)
+    if end is not None:
+        end = _to_timestamp(end)
+
+    resolution = None
+    if not percentiles and 'std' not in aggregates:
+        resolution = _aggregate_resolution(metric_id, bucket, start, end)
+
+    # Read everything from the same snapshot, so that the buckets found by
+    # each query match.
+    with _db.atomic():
+        if resolution is not None:
+            query = _aggregate_rollups(metric_id, resolution, bucket,
+                                       start, end)
+        else:
+            query = _aggregate_data(metric_id, bucket, start, end)
+        rows = _db.execute_sql(*query.sql()).fetchall()
+        if percentiles:
+            values = _aggregate_percentiles(metric_id, bucket, start, end,
+                                            list(percentiles.values()))
+
+    buckets = [row[0] for row in rows]
+    columns = {}
+    for name in aggregates:
+        if name in percentiles:
+            i = list(percentiles).index(name)
+            columns[name] = [values[b][i] for b in buckets]
+        else:
+            columns[name] = [_bucket_aggregate(name, *row[1:])
+                             for row in rows]
+    return buckets, columns
+
+
+def _bucket_aggregate(name, count, total, minimum, maximum, total_squares):
+    """
+    Calculate one of the :data:`utils.SQL_AGGREGATES` from a bucket's
+    summary.
+    """
+    if name == 'count':
+        return count
+    if name == 'sum':
+        return total
+    if name == 'mean':
+        return total / count
+    if name == 'min':
+        return minimum
+    if name == 'max':
+        return maximum
+    # Population standard deviation. Rounding errors can make a zero
+    # variance slightly negative.
+    variance = total_squares / count - (total / count) ** 2
+    return max(variance, 0) ** 0.5
+
+
+def _aggregate_resolution(metric_id, bucket, start=None, end=None):
+    """
+    Return the coarsest rollup resolution that can be aggregated into
+    ``bucket`` seconds buckets over the time window, or ``None``.
+
+    Rollups are only used if each bucket is made of whole rollups, and if
+    every data point of the metric has been rolled up.
+    """
+    for resolution in sorted(ROLLUP_RESOLUTIONS.values(), reverse=True):
+        if bucket % resolution == 0 and all(t is None or t % resolution == 0
+                                            for t in (start, end)):
+            break
+    else:
+        return None
+
+    if not _rollups_complete(metric_id):
+        return None
+    return resolution
+
+
+def _rollups_complete(metric_id):
+    """
+    Return ``True`` if every data point of the metric has been rolled up.
+
+    Data added before the rollup table existed isn't rolled up until
+    ``flask backfill-rollups`` is run.
+    """
+    stats = MetricStats.get_or_none(MetricStats.metric == metric_id)
+    rolled_up = (Rollup
+                 .select(fn.SUM(Rollup.count))
+                 .where(Rollup.metric == metric_id,
+                        Rollup.resolution == ROLLUP_RESOLUTIONS['day'])
+                 .scalar())
+    return stats is not None and rolled_up == stats.count
+
+
+def _bucket_start(column, bucket):
+    # peewee's `%` operator means LIKE, so spell out the modulo.
+    return column - Expression(column, '%', bucket)
+
+
+def _aggregate_rollups(metric_id, resolution, bucket, start=None, end=None):
+    key = _bucket_start(Rollup.bucket, bucket)
+    query = (_rollups_in_window(metric_id, resolution, start, end)
+             .select(key,
+                     fn.SUM(Rollup.count),
+                     fn.SUM(Rollup.total),
+                     fn.MIN(Rollup.minimum),
+                     fn.MAX(Rollup.maximum),
+                     SQL("NULL"))
+             .group_by(key)
+             .order_by(key))
+    return query
+
+
+def _aggregate_data(metric_id, bucket, start=None, end=None):
+    key = _bucket_start(DataPoint.timestamp, bucket)
+    query = (_data_in_window(metric_id, start, end)
+             .select(key,
+                     fn.COUNT(DataPoint.value),
+                     fn.SUM(DataPoint.value),
+                     fn.MIN(DataPoint.value),
+                     fn.MAX(DataPoint.value),
+                     fn.SUM(DataPoint.value * DataPoint.value))
+             .group_by(key)
+             .order_by(key))
+    return query
+
+
+def _aggregate_percentiles(metric_id, bucket, start, end, percentiles):
+    """
+    Return a dict mapping each bucket to the list of its ``percentiles``.
+    """
+    key = _bucket_start(DataPoint.timestamp, bucket)
+    query = (_data_in_window(metric_id, start, end)
+             .select(key, DataPoint.value)
+             .order_by(DataPoint.timestamp))
+    rows = _db.execute_sql(*query.sql()).fetchall()
+    if not rows:
+        return {}
+
+    buckets, values = np.array(rows, dtype=float).T
+    # The rows are ordered by time, so each bucket is a contiguous run.
+    splits = np.flatnonzero(np.diff(buckets)) + 1
+    keys = buckets[np.concatenate(([0], splits))].astype(int).tolist()
+    groups = np.split(values, splits)
+    return {key: np.percentile(group, percentiles).tolist()
+            for key, group in zip(keys, groups)}
+
+
+def _data_in_window(metric_id, start=None, end=None):
+    query = DataPoint.select().where(DataPoint.metric == metric_id)
+    if start is not None:
+        query = query.where(DataPoint.timestamp >= start)
+    if end is not None:
+        query = query.where(DataPoint.timestamp < end)
+    return query
+
+
+def rebuild_rollups(metric_id=None, start=None, end=None):
+    """
+    Recalculate the rollups from the raw data.
+
+    Used to fill in the rollups of data added before the rollup tables
+    existed, and to fix them after data points are changed.
+
+    Whole days are recalculated: ``start`` is rounded down and ``end`` is
+    rounded up to the nearest day (UTC).
+
+    Parameters
+    ----------
+    metric_id : int, optional
+        Only recalculate the rollups of this metric. Defaults to all
+        metrics.
+    start, end : int or :class:`datetime.datetime`, optional
+        Only recalculate the rollups for this time window. Defaults to all
+        time.
+
+    Returns
+    -------
+    count : int
+        The number of data points that were rolled up.
+    """
+    day = ROLLUP_RESOLUTIONS['day']
+    rollups = Rollup.delete()
+    data = DataPoint.select(DataPoint.metric,
+                            DataPoint.value,
+                            DataPoint.timestamp)
+    if metric_id is not None:
+        rollups = rollups.where(Rollup.metric == metric_id)
+        data = data.where(DataPoint.metric == metric_id)
+    if start is not None:
+        start = _to_timestamp(start)
+        start -= start % day
+        rollups = rollups.where(Rollup.bucket >= start)
+        data = data.where(DataPoint.timestamp >= start)
+    if end is not None:
+        end = _to_timestamp(end)
+        end += -end % day
+        rollups = rollups.where(Rollup.bucket < end)
+        data = data.where(DataPoint.timestamp < end)
+    data = data.order_by(DataPoint.metric,
+                         DataPoint.timestamp,
+                         DataPoint.datapoint_id)
+
+    count = 0
+    with _db.atomic():
+        rollups.execute()
+        # Read the raw timestamps straight from the cursor, rather than
+        # having peewee convert them to datetimes.
+        cursor = _db.execute_sql(*data.sql())
+        for chunk in chunked(cursor, _ROLLUP_REBUILD_CHUNK_SIZE):
+            _add_to_rollups(chunk)
+            count += len(chunk)
+    return count
+
+
+def _rebuild_rollups_of_day(metric_id, timestamp):
+    timestamp = _to_timestamp(timestamp)
+    rebuild_rollups(metric_id, timestamp, timestamp + 1)
+
+
+def _rollups_in_window(metric_id, resolution, start=None, end=None):
+    query = Rollup.select().where(Rollup.metric == metric_id,
+                                  Rollup.resolution == resolution)
+    if start is not None:
+        start = _to_timestamp(start)
+        query = query.where(Rollup.bucket >= start - start % resolution)
+    if end is not None:
+        query = query.where(Rollup.bucket < _to_timestamp(end))
+    return query
+
+
+def _add_to_rollups(points):
+    """
+    Add data points to the rollups of every resolution.
+
+    Must be called in the same transaction that inserts the points, and
+    only once for each point.
+
+    Parameters
+    ----------
+    points : iterable of (metric_id, value, timestamp) tuples
+        The timestamp can be anything accepted by ``DataPoint.timestamp``.
+    """
+    # Summarize the points per bucket first, so that each bucket is only
+    # written once.
+    buckets = {}
+    for metric_id, value, timestamp in points:
+        value = float(value)
+        timestamp = _to_timestamp(timestamp)
+        for resolution in ROLLUP_RESOLUTIONS.values():
+            key = (metric_id, resolution, timestamp - timestamp % resolution)
+            summary = buckets.get(key)
+            if summary is None:
+                buckets[key] = [1, value, value, value,
+                                value, timestamp, value, timestamp]
+                continue
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = min(summary[2], value)
+            summary[3] = max(summary[3], value)
+            # Ties go to the point inserted first (for `first`) and last
+            # (for `last`), which matches the order used by `get_data`.
+            if timestamp < summary[5]:
+                summary[4:6] = [value, timestamp]
+            if timestamp >= summary[7]:
+                summary[6:8] = [value, timestamp]
+
+    rows = [key + tuple(summary) for key, summary in buckets.items()]
+    _merge_summaries(_ROLLUP_UPDATE, _ROLLUP_INSERT, rows)
+
+
+def _merge_summaries(update, insert, rows):
+    """
+    Merge summary rows into a table, inserting the ones that don't exist.
+
+    Each row is first merged into the existing one by ``update``. The rows
+    that didn't match anything are then inserted in batches. Must be called
+    inside a transaction, so that no other writer can insert a row in
+    between.
+
+    Parameters
+    ----------
+    update : str
+        An UPDATE statement taking a whole row as its parameters.
+    insert : str
+        An INSERT statement with a ``{values}`` placeholder.
+    rows : list of tuples
+    """
+    missing = [row for row in rows
+               if _db.execute_sql(update, row).rowcount == 0]
+    for batch in chunked(missing, _ROLLUP_BATCH_SIZE):
+        placeholders = "({})".format(", ".join(["?"] * len(batch[0])))
+        values = ", ".join([placeholders] * len(batch))
+        params = [param for row in batch for param in row]
+        _db.execute_sql(insert.format(values=values), params)
+
+
+def _add_to_metric_stats(points):
+    """
+    Add data points to the stats of their metrics.
+
+    Must be called in the same transaction that inserts the points, and
+    only once for each point.
+
+    Parameters
+    ----------
+    points : iterable of (metric_id, value, timestamp) tuples
+        The timestamp can be anything accepted by ``DataPoint.timestamp``.
+    """
+    metrics = {}
+    for metric_id, value, timestamp in points:
+        value = float(value)
+        timestamp = _to_timestamp(timestamp)
+        stats = metrics.get(metric_id)
+        if stats is None:
+            metrics[metric_id] = [1, value, value * value, value, value,
+                                  timestamp, timestamp, value]
+            continue
+        stats[0] += 1
+        stats[1] += value
+        stats[2] += value * value
+        stats[3] = min(stats[3], value)
+        stats[4] = max(stats[4], value)
+        stats[5] = min(stats[5], timestamp)
+        # Ties go to the point inserted last, like in `_add_to_rollups`.
+        if timestamp >= stats[6]:
+            stats[6:8] = [timestamp, value]
+
+    rows = [(metric_id, ) + tuple(stats) for metric_id, stats
+            in metrics.items()]
+    _merge_summaries(_METRIC_STATS_UPDATE, _METRIC_STATS_INSERT, rows)
+
+
+def _remove_from_metric_stats(metric_id, values, refresh_extremes=True):
+    """
+    Update the stats of a metric after some of its data points are removed.
+
+    Must be called after the data points are deleted (or moved to another
+    metric), in the same transaction.
+
+    The count, sums and first and last data points are updated right away.
+    If a removed value was the minimum or maximum, finding the new one
+    means reading all of the metric's data: that is only done if
+    ``refresh_extremes`` is ``True``.
+
+    Parameters
+    ----------
+    metric_id : int
+    values : list of float
+        The values of the data points that were removed.
+    refresh_extremes : bool, optional
+
+    Returns
+    -------
+    stale : bool
+        ``True`` if the minimum and maximum still need to be recalculated
+        with :func:`_refresh_metric_extremes`.
+    """
+    stats = MetricStats.get_or_none(MetricStats.metric == metric_id)
+    if stats is None:
+        return False
+    if stats.count <= len(values):
+        stats.delete_instance()
+        return False
+
+    values = [float(v) for v in values]
+    stale = (min(values) <= stats.minimum or max(values) >= stats.maximum)
+    data = DataPoint.select().where(DataPoint.metric == metric_id)
+    newest = data.order_by(DataPoint.timestamp.desc(),
+                           DataPoint.datapoint_id.desc()).limit(1)
+    (MetricStats
+     .update(count=MetricStats.count - len(values),
+             total=MetricStats.total - sum(values),
+             total_squares=(MetricStats.total_squares
+                            - sum(v * v for v in values)),
+             first_timestamp=data.select(fn.MIN(DataPoint.timestamp)),
+             last_timestamp=newest.select(DataPoint.timestamp),
+             last_value=newest.select(DataPoint.value))
+     .where(MetricStats.metric == metric_id)
+     .execute())
+
+    if stale and refresh_extremes:
+        _refresh_metric_extremes(metric_id)
+        return False
+    return stale
+
+
+def _refresh_metric_extremes(metric_id):
+    """
+    Recalculate the minimum and maximum in the stats of a metric.
+    """
+    data = DataPoint.select().where(DataPoint.metric == metric_id)
+    (MetricStats
+     .update(minimum=data.select(fn.MIN(DataPoint.value)),
+             maximum=data.select(fn.MAX(DataPoint.value)))
+     .where(MetricStats.metric == metric_id)
+     .execute())
+
+
+def _to_timestamp(value):
+    """
+    Convert anything accepted by ``DataPoint.timestamp`` to the integer
+    POSIX timestamp that would be stored.
+    """
+    return DataPoint.timestamp.db_value(value)
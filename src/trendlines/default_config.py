@@ -16,6 +16,82 @@ DB_TYPE = "sqlite"
 # The database file to use. Ignored if DB_TYPE is not "sqlite"
 DATABASE = "./internal.db"
 
+# How much to trade durability for write speed. Valid options are:
+#   "fast": never wait for the disk. Recent data can be lost, and the
+#           database corrupted, by an OS crash or power loss.
+#   "balanced": data can only be lost by an OS crash or power loss, and the
+#               database is never corrupted. Also enables the write buffer
+#               unless WRITE_BUFFER_ENABLED is set.
+#   "durable": wait for the disk on every commit.
+# See the "Durability" section of the docs for measured insert rates.
+DB_DURABILITY = "fast"
+
+# SQLite page cache size, in KiB.
+DB_CACHE_SIZE = 64000
+
+# Any other SQLite pragmas to set, eg. {"mmap_size": 2**28}. These take
+# precedence over DB_DURABILITY and DB_CACHE_SIZE.
+DB_PRAGMAS = {}
+
+# Keep database connections open between requests and reuse them, instead of
+# opening the file (and starting with an empty page cache) for every request.
+DB_POOL = True
+
+# Serve GET requests with read-only database connections, so that reads can
+# never take a write lock or change anything.
+DB_READ_ONLY_GET = True
+
+# Maximum number of metric name -> metric_id lookups to cache in each
+# process. Used to avoid querying the metric table for every new data point.
+METRIC_ID_CACHE_SIZE = 10000
+# Each cached id is forgotten after METRIC_ID_CACHE_TTL seconds. A process
+# drops the ids of the metrics it renames or deletes itself right away, so
+# this only bounds how long changes made by *other* processes, such as other
+# web workers, can go unseen.
+METRIC_ID_CACHE_TTL = 10
+
+# How long, in seconds, to cache the metric tree shown on the index page.
+# The cache is cleared whenever this process changes a metric, so this only
+# bounds how long changes made by *other* processes can go unseen.
+METRIC_TREE_CACHE_TTL = 60
+
+# Buffer new data points sent to the API and write them in the background,
+# many per transaction. Much faster under heavy load, but the API then
+# replies with "202 Accepted" before the data is written, and anything still
+# buffered is lost if the process is killed.
+# A batch is written once it holds WRITE_BUFFER_MAX_ROWS data points or once
+# its oldest data point has waited WRITE_BUFFER_MAX_LATENCY_MS milliseconds.
+# If None, the buffer is enabled when DB_DURABILITY is "balanced".
+WRITE_BUFFER_ENABLED = None
+WRITE_BUFFER_MAX_ROWS = 1000
+WRITE_BUFFER_MAX_LATENCY_MS = 200
+# At most WRITE_BUFFER_MAX_PENDING data points are buffered. Once that many
+# are waiting, requests wait for the buffer to be written.
+WRITE_BUFFER_MAX_PENDING = 10000
+
+# Default retention policy, used for metrics that don't set their own
+# `retention_days` or `retention_points`. Data is deleted once it is older
+# than RETENTION_DAYS days, or once it is no longer among the newest
+# RETENTION_POINTS data points of its metric. None keeps data forever.
+RETENTION_DAYS = None
+RETENTION_POINTS = None
+
+# Retention is applied every RETENTION_INTERVAL seconds by the celery beat
+# scheduler (or by running `flask apply-retention`), deleting at most
+# RETENTION_CHUNK_SIZE data points per transaction.
+RETENTION_INTERVAL = 3600
+RETENTION_CHUNK_SIZE = 5000
+
+# Number of results per page for the paginated API listings, and the largest
+# page size that a client can request with the `limit` query parameter.
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Percentiles in GET /api/v1/data/<metric>/aggregate are calculated from all
+# of the data in the time window, which is loaded into memory. Windows with
+# more than this many data points are rejected.
+AGGREGATE_MAX_PERCENTILE_POINTS = 1000000
+
 # Set this value to insert a prefix into any generaged URLs. Mainly used when
 # running behind a proxy that is adjusting URLs.
 #URL_PREFIX = "/trendlines"
@@ -24,12 +100,43 @@ DATABASE = "./internal.db"
 # http://docs.celeryproject.org/en/latest/userguide/configuration.html
 broker_url = "redis://redis"
 
+# The two socket listeners are tasks that never return, and each one keeps a
+# worker process busy for good. One more process is needed for the tasks
+# scheduled by celery beat, such as retention, so don't go below 3. Each
+# process only takes a task once it is free, so nothing is stuck waiting
+# behind a listener.
+worker_concurrency = 3
+worker_prefetch_multiplier = 1
+
 # Socket stuff.
 TARGET_HOST = "0.0.0.0"
 TRENDLINES_API_URL = "http://trendlines/api/v1/data"
 TCP_PORT = 2003
 UDP_PORT = 2003
 
+# Data points received by the socket listeners are sent on in batches of up
+# to LISTENER_BATCH_SIZE points. A data point is held for at most
+# LISTENER_BATCH_DELAY seconds before being sent.
+LISTENER_BATCH_SIZE = 1000
+LISTENER_BATCH_DELAY = 1.0
+# At most LISTENER_MAX_PENDING batches are held while they are written.
+# Beyond that, TCP connections aren't read until there is room again, and
+# UDP datagrams are dropped with a warning.
+LISTENER_MAX_PENDING = 100
+
+# How the socket listeners store data points. Valid options are:
+#   "database": write straight into DATABASE. The listener must be able to
+#               access the same database file as the web app.
+#   "http": send batches to TRENDLINES_API_URL.
+LISTENER_WRITER = "database"
+
+# With the "database" writer, the listeners cache metric ids like the web
+# app does (see METRIC_ID_CACHE_TTL), but they can't see when the web app
+# renames or deletes a metric. Each cached id is forgotten after
+# LISTENER_METRIC_ID_CACHE_TTL seconds, so data sent under a metric's old
+# name goes to the renamed metric for at most that long.
+LISTENER_METRIC_ID_CACHE_TTL = 10
+
 # Flask Builtins ################################
 DEBUG = False
 TESTING = False
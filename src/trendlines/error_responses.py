@@ -43,6 +43,11 @@ class ErrorResponse(object):
         detail = "The datapoint '{}' does not exist".format(datapoint_id)
         return error_response(404, ErrorResponseType.NOT_FOUND, detail)
 
+    @classmethod
+    def tree_node_not_found(cls, node_id):
+        detail = "The tree node '{}' does not exist".format(node_id)
+        return error_response(404, ErrorResponseType.NOT_FOUND, detail)
+
     @classmethod
     def metric_has_no_data(cls, name):
         detail = "No data exists for metric '{}'.".format(name)
@@ -60,6 +65,22 @@ class ErrorResponse(object):
         detail = detail.format(old, new)
         return error_response(409, ErrorResponseType.INTEGRITY_ERROR, detail)
 
+    @classmethod
+    def invalid_query_parameter(cls, name, reason):
+        detail = "Invalid query parameter '{}': {}".format(name, reason)
+        return error_response(400, ErrorResponseType.INVALID_REQUEST, detail)
+
+    @classmethod
+    def window_too_large(cls, max_points):
+        detail = ("The time window is too large: it holds more than {} data"
+                  " points. Use a smaller window.").format(max_points)
+        return error_response(400, ErrorResponseType.INVALID_REQUEST, detail)
+
+    @classmethod
+    def invalid_metric(cls, reason):
+        detail = "Invalid metric: {}".format(reason)
+        return error_response(400, ErrorResponseType.INVALID_REQUEST, detail)
+
     @classmethod
     def missing_required_key(cls, key):
         if isinstance(key, (list, tuple)):
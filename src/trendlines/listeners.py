@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+"""
+Socket listeners for the plaintext protocol.
+
+Each line sent to a listener must follow the ``"metric value [timestamp]"``
+format, just like `Graphite's plaintext protocol`_. Parsed data points are
+handed to a *sink*: a callable that accepts the dict returned by
+:func:`utils.parse_socket_data`. Sinks are called from the event loop, so
+they must not block.
+
+The sink used by :func:`serve_forever` is a :class:`Batcher`, which groups
+data points so that they can be written many at a time.
+
+.. _`Graphite's plaintext protocol`: https://graphite.readthedocs.io/en/latest/feeding-carbon.html#the-plaintext-protocol
+"""
+import abc
+import asyncio
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from trendlines import db
+from trendlines import logger
+from trendlines import orm
+from trendlines import utils
+
+# The longest line we'll accept, in bytes.
+MAX_LINE_LENGTH = 4096
+
+# The number of pending connections that the OS will queue for us.
+TCP_BACKLOG = 1024
+
+# The size of the kernel's receive buffer for the UDP socket. A large buffer
+# absorbs bursts of datagrams while the event loop is busy.
+UDP_RECEIVE_BUFFER = 4 * 1024 * 1024
+
+
+def parse_line(line):
+    """
+    Parse a single line of the plaintext protocol.
+
+    Parameters
+    ----------
+    line : bytes or str
+        The line, with or without the trailing newline.
+
+    Returns
+    -------
+    point : dict or None
+        See :func:`utils.parse_socket_data`. ``None`` if the line was blank
+        or could not be parsed.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        return utils.parse_socket_data(line)
+    except (ValueError, UnicodeDecodeError):
+        logger.warning("Failed to parse `%s`." % line)
+        return None
+
+
+async def handle_tcp_connection(reader, writer, sink, drain=None):
+    """
+    Read newline-delimited data points from a TCP connection until it closes.
+
+    Parameters
+    ----------
+    reader : :class:`asyncio.StreamReader`
+    writer : :class:`asyncio.StreamWriter`
+    sink : callable
+        Called with each parsed data point.
+    drain : coroutine function, optional
+        Awaited after each data point, to wait until the data points can be
+        written. The connection isn't read in the meantime, so TCP flow
+        control slows the client down instead of data being dropped.
+    """
+    peer = writer.get_extra_info('peername')
+    logger.debug("TCP: connection from %s" % (peer, ))
+    count = 0
+    try:
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # asyncio raises this when a line is longer than the limit.
+                logger.warning("TCP: line too long from %s, closing."
+                               % (peer, ))
+                break
+            except ConnectionError:
+                break
+            if not line:
+                break
+            point = parse_line(line)
+            if point is not None:
+                sink(point)
+                count += 1
+                if drain is not None:
+                    await drain()
+    finally:
+        writer.close()
+        logger.debug("TCP: received %s points from %s." % (count, peer))
+
+
+def start_tcp_server(host, port, sink, drain=None):
+    """
+    Start listening for plaintext protocol data over TCP.
+
+    Each connection is served by its own task, so any number of clients
+    can stream data at the same time.
+
+    Parameters
+    ----------
+    host : str
+    port : int
+    sink : callable
+        Called with each parsed data point.
+    drain : coroutine function, optional
+        See :func:`handle_tcp_connection`.
+
+    Returns
+    -------
+    coroutine
+        Resolves to the :class:`asyncio.AbstractServer`.
+    """
+    def client_connected(reader, writer):
+        return handle_tcp_connection(reader, writer, sink, drain)
+
+    logger.info("Listening for TCP on %s:%s" % (host, port))
+    return asyncio.start_server(client_connected, host, port,
+                                limit=MAX_LINE_LENGTH, backlog=TCP_BACKLOG)
+
+
+class UDPProtocol(asyncio.DatagramProtocol):
+    """
+    Receive plaintext protocol datagrams.
+
+    A datagram may hold any number of newline-delimited data points.
+
+    UDP has no flow control, so datagrams that arrive while ``is_full()``
+    is true are dropped. That is logged once when dropping starts, and once
+    with the number of dropped datagrams when it stops.
+
+    Parameters
+    ----------
+    sink : callable
+        Called with each parsed data point.
+    is_full : callable, optional
+        Returns ``True`` if data points can't be written right now.
+    """
+    def __init__(self, sink, is_full=None):
+        self.sink = sink
+        self.is_full = is_full
+        self.dropped = 0
+
+    def datagram_received(self, data, addr):
+        if self.is_full is not None and self.is_full():
+            if self.dropped == 0:
+                logger.warning("UDP: too many data points waiting to be"
+                               " written, dropping datagrams.")
+            self.dropped += 1
+            return
+        if self.dropped:
+            logger.warning("UDP: dropped %s datagrams." % self.dropped)
+            self.dropped = 0
+        for line in data.splitlines():
+            point = parse_line(line)
+            if point is not None:
+                self.sink(point)
+
+    def error_received(self, exc):
+        logger.error("UDP: %s" % exc)
+
+
+async def start_udp_server(host, port, sink, is_full=None):
+    """
+    Start listening for plaintext protocol data over UDP.
+
+    Parameters
+    ----------
+    host : str
+    port : int
+    sink : callable
+        Called with each parsed data point.
+    is_full : callable, optional
+        See :class:`UDPProtocol`.
+
+    Returns
+    -------
+    transport : :class:`asyncio.DatagramTransport`
+    """
+    loop = asyncio.get_event_loop()
+    logger.info("Listening for UDP on %s:%s" % (host, port))
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: UDPProtocol(sink, is_full),
+        local_addr=(host, port),
+    )
+    sock = transport.get_extra_info('socket')
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                        UDP_RECEIVE_BUFFER)
+    except OSError as err:
+        logger.warning("UDP: unable to set the receive buffer size: %s" % err)
+    return transport
+
+
+class Batcher(object):
+    """
+    Collect data points and hand them on in batches.
+
+    A batch is flushed once it holds ``max_size`` points, or ``max_delay``
+    seconds after its first point arrived, whichever comes first.
+
+    Must be used from within the event loop's thread.
+
+    Parameters
+    ----------
+    flush : callable
+        Called with each batch, a list of data point dicts. Must not block.
+    max_size : int
+        The most data points to put in one batch.
+    max_delay : float
+        The longest time, in seconds, that a data point waits in a batch.
+    loop : :class:`asyncio.AbstractEventLoop`
+    """
+    def __init__(self, flush, max_size, max_delay, loop):
+        self._flush = flush
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.loop = loop
+        self._batch = []
+        self._timer = None
+
+    def __call__(self, point):
+        """
+        Add a data point. This is the sink interface.
+        """
+        self._batch.append(point)
+        if len(self._batch) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(self.max_delay, self.flush)
+
+    def __len__(self):
+        return len(self._batch)
+
+    def flush(self):
+        """
+        Hand on the current batch now, if there is one.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        logger.debug("Flushing %s data points." % len(batch))
+        self._flush(batch)
+
+
+class _PoolWriter(abc.ABC):
+    """
+    Hand batches of data points to a thread pool, without ever blocking.
+
+    The writer is :meth:`full` while ``max_pending`` batches are waiting or
+    being written. Listeners check that before handing over more data: TCP
+    connections await :meth:`drain`, which stops reading from them, and UDP
+    datagrams are dropped. See :func:`handle_tcp_connection` and
+    :class:`UDPProtocol`.
+
+    Subclasses write a batch in :meth:`_write`, which runs on the pool.
+
+    Must be used from within the event loop's thread.
+
+    Parameters
+    ----------
+    loop : :class:`asyncio.AbstractEventLoop`
+    max_workers : int
+        The number of batches to write at the same time.
+    max_pending : int
+        The number of pending batches at which the writer is full.
+    """
+    def __init__(self, loop, max_workers, max_pending):
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_pending = max_pending
+        self._pending = 0
+        self._waiters = []
+
+    def __call__(self, batch):
+        self._pending += 1
+        future = self.loop.run_in_executor(self.executor, self._write, batch)
+        future.add_done_callback(self._done)
+
+    def full(self):
+        """
+        Return ``True`` if ``max_pending`` batches are pending.
+        """
+        return self._pending >= self.max_pending
+
+    async def drain(self):
+        """
+        Wait until the writer is no longer full.
+        """
+        while self.full():
+            waiter = self.loop.create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+    def _done(self, future):
+        self._pending -= 1
+        if self.full():
+            return
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @abc.abstractmethod
+    def _write(self, batch):
+        """
+        Write a batch of data points. Runs on the thread pool.
+        """
+
+
+class DatabaseWriter(_PoolWriter):
+    """
+    Write batches of data points straight into the database.
+
+    Each batch is written in a single transaction by
+    :func:`db.insert_datapoints`. All writes happen on one background
+    thread, which keeps its database connection open, so the event loop
+    is never blocked and batches are committed in the order they arrive.
+
+    A data point that can't be stored is dropped with a warning, without
+    losing the rest of its batch.
+
+    The database must have been set up with :func:`orm.open_db` (or
+    :func:`orm.create_db`) first.
+
+    Parameters
+    ----------
+    loop : :class:`asyncio.AbstractEventLoop`
+    max_pending : int, optional
+        The number of pending batches at which the writer is full. See
+        :class:`_PoolWriter`.
+    """
+    def __init__(self, loop, max_pending=100):
+        super().__init__(loop, max_workers=1, max_pending=max_pending)
+
+    def _write(self, batch):
+        points = [(p['metric'], p['value'], p['time']) for p in batch]
+        try:
+            orm.db.connect(reuse_if_open=True)
+            db.insert_datapoints(points, skip_invalid=True)
+        except Exception:
+            logger.exception("Failed to write %s data points." % len(batch))
+
+    def close(self):
+        """
+        Wait for pending batches to be written, then close the connection.
+        """
+        self.executor.submit(orm.db.close)
+        self.executor.shutdown(wait=True)
+
+
+class HTTPWriter(_PoolWriter):
+    """
+    POST batches of data points to the API.
+
+    The whole batch is sent as a single request to ``/api/v1/data``. The
+    requests are sent from a thread pool so that the event loop is never
+    blocked. Each thread keeps its own :class:`requests.Session`, so
+    connections are kept alive and reused.
+
+    Parameters
+    ----------
+    url : str
+        The full URL of the ``/api/v1/data`` endpoint.
+    loop : :class:`asyncio.AbstractEventLoop`
+    max_workers : int, optional
+        The number of requests to send at the same time.
+    max_pending : int, optional
+        The number of pending batches at which the writer is full. See
+        :class:`_PoolWriter`.
+    """
+    def __init__(self, url, loop, max_workers=4, max_pending=100):
+        super().__init__(loop, max_workers=max_workers,
+                         max_pending=max_pending)
+        self.url = url
+        self._local = threading.local()
+        self._sessions = []
+
+    @property
+    def session(self):
+        """
+        The :class:`requests.Session` of the current thread.
+        """
+        try:
+            return self._local.session
+        except AttributeError:
+            session = requests.Session()
+            self._local.session = session
+            self._sessions.append(session)
+            return session
+
+    def _write(self, batch):
+        try:
+            r = self.session.post(self.url, json=batch)
+        except requests.RequestException as err:
+            logger.error("Failed to send %s data points to %s: %s"
+                         % (len(batch), self.url, err))
+            return
+        if r.ok:
+            logger.debug("POST %s: %s" % (self.url, r.status_code))
+        else:
+            logger.error("POST %s of %s data points failed: %s %s"
+                         % (self.url, len(batch), r.status_code, r.text))
+
+    def close(self):
+        """
+        Wait for pending batches to be sent, then close the sessions.
+        """
+        self.executor.shutdown(wait=True)
+        for session in self._sessions:
+            session.close()
+
+
+def serve_forever(host, tcp_port=None, udp_port=None, writer="database",
+                  database=None, url=None, batch_size=1000, batch_delay=1.0,
+                  pragmas=None, metric_id_cache_ttl=10, max_pending=100):
+    """
+    Run the listeners until the process is stopped.
+
+    Parameters
+    ----------
+    host : str
+        The address to listen on.
+    tcp_port : int, optional
+        The TCP port to listen on. If ``None``, don't listen for TCP.
+    udp_port : int, optional
+        The UDP port to listen on. If ``None``, don't listen for UDP.
+    writer : "database" or "http", optional
+        How to store the data points: write them straight into the
+        ``database`` file, or send them to the API at ``url``.
+    database : str, optional
+        The database file. Required if ``writer`` is "database".
+    url : str, optional
+        The full URL of the ``/api/v1/data`` endpoint. Required if
+        ``writer`` is "http".
+    batch_size : int, optional
+        The most data points to write at once.
+    batch_delay : float, optional
+        The longest time, in seconds, to hold on to a data point before
+        writing it.
+    pragmas : dict, optional
+        The SQLite pragmas to use if ``writer`` is "database". See
+        :func:`orm.get_pragmas`.
+    metric_id_cache_ttl : float, optional
+        If ``writer`` is "database", how many seconds to cache each metric
+        id for. Metrics renamed or deleted by another process are only
+        noticed once their cached id expires.
+    max_pending : int, optional
+        The most batches to hold on to while they are written. While that
+        many are pending, TCP connections aren't read and UDP datagrams are
+        dropped.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    if writer == "database":
+        orm.open_db(database, pragmas=pragmas)
+        db.metric_id_cache.ttl = metric_id_cache_ttl
+        db.metric_id_cache.clear()
+        write = DatabaseWriter(loop, max_pending=max_pending)
+    elif writer == "http":
+        write = HTTPWriter(url, loop, max_pending=max_pending)
+    else:
+        raise ValueError("Unknown writer '%s'" % writer)
+    logger.info("Writing data points using the '%s' writer." % writer)
+
+    batcher = Batcher(write, batch_size, batch_delay, loop)
+
+    tcp_server = udp_transport = None
+    if tcp_port is not None:
+        tcp_server = loop.run_until_complete(
+            start_tcp_server(host, tcp_port, batcher, drain=write.drain)
+        )
+    if udp_port is not None:
+        udp_transport = loop.run_until_complete(
+            start_udp_server(host, udp_port, batcher, is_full=write.full)
+        )
+
+    try:
+        loop.run_forever()
+    finally:
+        if tcp_server is not None:
+            tcp_server.close()
+            loop.run_until_complete(tcp_server.wait_closed())
+        if udp_transport is not None:
+            udp_transport.close()
+        batcher.flush()
+        write.close()
+        loop.close()
@@ -1,17 +1,23 @@
 # -*- coding: utf-8 -*-
-import shutil
+import math
+import os
+import sqlite3
+import zlib
 from datetime import datetime
+from datetime import timezone
 from pathlib import Path
+from urllib.request import pathname2url
 
-from peewee import SqliteDatabase
 from peewee import Model
 from peewee import IntegerField
 from peewee import FloatField
 from peewee import TimestampField
 from peewee import ForeignKeyField
 from peewee import CharField
+from peewee import CompositeKey
 from peewee import OperationalError
 from peewee_moves import DatabaseManager
+from playhouse.pool import PooledSqliteDatabase
 from playhouse.sqlite_ext import AutoIncrementField
 
 from trendlines import logger
@@ -27,7 +33,174 @@ DB_OPTS = {
     'synchronous': 0,
 }
 
-db = SqliteDatabase(None)
+# The rollup resolutions, in seconds. Each divides the next, so that a day's
+# data can be rolled up at every resolution at once.
+ROLLUP_RESOLUTIONS = {
+    'minute': 60,
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+}
+
+# Where to look for migrations, in order. The docker container doesn't run
+# from the project directory, so it needs the 2nd one.
+MIGRATION_DIRS = ("migrations", "/trendlines/migrations")
+
+# The pragmas that set each durability mode. See `get_pragmas`.
+# The pragmas that are applied to read-only connections. The others, such as
+# `journal_mode` or `synchronous`, would try to change the database or only
+# matter to writers.
+READ_ONLY_PRAGMAS = frozenset([
+    'busy_timeout',
+    'cache_size',
+    'case_sensitive_like',
+    'mmap_size',
+    'temp_store',
+])
+
+DURABILITY_MODES = {
+    # Commits are never synced to disk. An OS crash or power loss can lose
+    # recent commits or even corrupt the database.
+    'fast': {'journal_mode': 'wal', 'synchronous': 0},
+    # Commits are durable against application crashes. An OS crash or
+    # power loss can lose the most recent commits, but can't corrupt the
+    # database.
+    'balanced': {'journal_mode': 'wal', 'synchronous': 1},
+    # Every commit is synced to disk before it returns.
+    'durable': {'journal_mode': 'wal', 'synchronous': 2},
+}
+
+
+class PoolableSqliteDatabase(PooledSqliteDatabase):
+    """
+    An SQLite database that can keep its connections open for reuse.
+
+    When :attr:`pooled` is ``True``, :meth:`close` hands the connection
+    back to a pool instead of closing it, and the next :meth:`connect` (from
+    any thread) takes it from there. Pragmas are only applied when a
+    connection is first opened, so reused connections keep a warm page
+    cache.
+
+    When :attr:`pooled` is ``False``, connections are opened and closed
+    like those of a plain :class:`peewee.SqliteDatabase`.
+
+    ``connect(read_only=True)`` gives the calling thread a read-only
+    connection instead (opened with ``mode=ro`` and ``query_only``).
+    Read-only connections are pooled separately from the others, and only
+    get the pragmas in :data:`READ_ONLY_PRAGMAS`.
+
+    Parameters
+    ----------
+    database : str or None
+    pooled : bool, optional
+    **kwargs :
+        Passed on to :class:`playhouse.pool.PooledSqliteDatabase`.
+    """
+    def __init__(self, database, pooled=False, **kwargs):
+        self.pooled = pooled
+        # Idle read-only connections, and those in use by their key.
+        self._readers = []
+        self._readers_in_use = {}
+        # Pooled connections are handed to whichever thread asks next.
+        kwargs.setdefault('check_same_thread', False)
+        super().__init__(database, **kwargs)
+
+    def init(self, database, **kwargs):
+        # Pooled connections are to the old file, so they can't be reused.
+        # There's nothing to close if we were never initialized.
+        if not getattr(self, "deferred", True):
+            self.close_all()
+        super().init(database, **kwargs)
+
+    def connect(self, reuse_if_open=False, read_only=False):
+        """
+        Open a connection for the calling thread.
+
+        Parameters
+        ----------
+        reuse_if_open : bool, optional
+            Don't raise if the thread already has a connection open. That
+            connection is kept, whatever its ``read_only`` setting.
+        read_only : bool, optional
+            Open a connection that can't change the database.
+        """
+        if self.is_closed():
+            self._state.read_only = read_only
+        return super().connect(reuse_if_open)
+
+    def set_pooled(self, pooled):
+        """
+        Turn connection pooling on or off.
+
+        Turning it off closes any idle connections. Connections in use are
+        closed when they're given back.
+        """
+        self.pooled = pooled
+        if not pooled:
+            self.close_idle()
+
+    def close_idle(self):
+        super().close_idle()
+        with self._lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers = []
+
+    def close_all(self):
+        super().close_all()
+        with self._lock:
+            for conn in self._readers + list(self._readers_in_use.values()):
+                conn.close()
+            self._readers = []
+            self._readers_in_use = {}
+
+    def _connect(self):
+        if not getattr(self._state, "read_only", False):
+            return super()._connect()
+        try:
+            conn = self._readers.pop()
+        except IndexError:
+            conn = self._connect_read_only()
+        self._readers_in_use[self.conn_key(conn)] = conn
+        return conn
+
+    def _connect_read_only(self):
+        uri = "file:{}?mode=ro".format(pathname2url(self.database))
+        conn = sqlite3.connect(uri, uri=True, timeout=self._timeout,
+                               **self.connect_params)
+        conn.isolation_level = None
+        try:
+            self._add_conn_hooks(conn)
+            conn.execute("PRAGMA query_only = 1")
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def _set_pragmas(self, conn):
+        if not getattr(self._state, "read_only", False):
+            return super()._set_pragmas(conn)
+        cursor = conn.cursor()
+        for pragma, value in self._pragmas:
+            if pragma in READ_ONLY_PRAGMAS:
+                cursor.execute('PRAGMA %s = %s;' % (pragma, value))
+        cursor.close()
+
+    def _close(self, conn, close_conn=False):
+        key = self.conn_key(conn)
+        if key in self._readers_in_use:
+            del self._readers_in_use[key]
+            if self.pooled and not close_conn:
+                self._readers.append(conn)
+            else:
+                conn.close()
+            return
+        if not self.pooled:
+            self._in_use.pop(key, None)
+            close_conn = True
+        super()._close(conn, close_conn)
+
+
+db = PoolableSqliteDatabase(None, max_connections=None)
 
 
 class BaseModel(Model):
@@ -66,6 +239,9 @@ class Metric(InternalModel):
     units = CharField(max_length=24, null=True)
     upper_limit = FloatField(null=True)
     lower_limit = FloatField(null=True)
+    # See :func:`db.apply_retention`. ``None`` uses the global default.
+    retention_days = FloatField(null=True)
+    retention_points = IntegerField(null=True)
 
     def __repr__(self):
         s = "<Metric: {id}, {name}, units={units}>"
@@ -89,10 +265,26 @@ class DataPoint(DataModel):
     value = FloatField()
     timestamp = TimestampField(utc=True)
 
+    class Meta(object):
+        # See migration 0007. Tables and indexes are created by migrations;
+        # this is only here so that the model matches the database.
+        indexes = (
+            (('metric', 'timestamp', 'value'), False),
+        )
+
     def __repr__(self):
+        # Only use the metric name if the metric was already loaded (for
+        # example via a JOIN). Accessing `self.metric` otherwise runs a
+        # query, which is not something a repr should do.
+        metric = self.__rel__.get('metric')
+        if metric is not None:
+            metric = metric.name
+        else:
+            metric = self.metric_id
+
         s = "<DataPoint: {id}, {metric}, {value}, {timestamp}>"
         return s.format(id=self.datapoint_id,
-                        metric=self.metric.name,
+                        metric=metric,
                         value=self.value,
                         timestamp=self.timestamp)
 
@@ -100,17 +292,193 @@ class DataPoint(DataModel):
         return repr(self)
 
 
-def create_db(name):
+class Rollup(DataModel):
+    """
+    Table holding per-bucket summaries of each metric's data.
+
+    Each row summarizes the data points of one metric in the ``resolution``
+    seconds starting at ``bucket``. The rows are kept up to date by the
+    functions in :mod:`db` that change data points. See migration 0008.
+    """
+
+    metric = ForeignKeyField(Metric, backref="rollups", on_delete="CASCADE")
+    resolution = IntegerField()
+    # A POSIX timestamp. Not a TimestampField because that reads 0 (the
+    # first bucket of 1970-01-01) back as None. See peewee#1875.
+    bucket = IntegerField()
+    count = IntegerField()
+    total = FloatField()
+    minimum = FloatField()
+    maximum = FloatField()
+    first = FloatField()
+    first_timestamp = IntegerField()
+    last = FloatField()
+    last_timestamp = IntegerField()
+
+    class Meta(object):
+        primary_key = CompositeKey('metric', 'resolution', 'bucket')
+        without_rowid = True
+
+    @property
+    def timestamp(self):
+        """
+        The start of the bucket, as a naive UTC :class:`datetime.datetime`.
+        """
+        dt = datetime.fromtimestamp(self.bucket, tz=timezone.utc)
+        return dt.replace(tzinfo=None)
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+    def __repr__(self):
+        s = "<Rollup: {metric}, {resolution}s, {bucket}, count={count}>"
+        return s.format(metric=self.metric_id,
+                        resolution=self.resolution,
+                        bucket=self.bucket,
+                        count=self.count)
+
+    def __str__(self):
+        return repr(self)
+
+
+class MetricStats(DataModel):
+    """
+    Table holding summary statistics of each metric's data.
+
+    There is one row per metric that has data. The rows are kept up to date
+    by the functions in :mod:`db` that change data points. See migration
+    0010.
+    """
+
+    metric = ForeignKeyField(Metric, primary_key=True, backref="stats",
+                             on_delete="CASCADE")
+    count = IntegerField()
+    total = FloatField()
+    total_squares = FloatField()
+    minimum = FloatField()
+    maximum = FloatField()
+    # POSIX timestamps. See `Rollup.bucket`.
+    first_timestamp = IntegerField()
+    last_timestamp = IntegerField()
+    last_value = FloatField()
+
+    class Meta(object):
+        table_name = "metric_stats"
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+    @property
+    def std(self):
+        """
+        The population standard deviation.
+        """
+        variance = self.total_squares / self.count - self.mean ** 2
+        # Rounding errors can make a zero variance slightly negative.
+        return math.sqrt(max(variance, 0))
+
+    def __repr__(self):
+        s = "<MetricStats: {metric}, count={count}>"
+        return s.format(metric=self.metric_id, count=self.count)
+
+    def __str__(self):
+        return repr(self)
+
+
+def get_pragmas(durability="fast", cache_size=None, extra=None):
+    """
+    Build the SQLite pragmas for the database connection.
+
+    Parameters
+    ----------
+    durability : str, optional
+        One of the keys of :data:`DURABILITY_MODES`: "fast", "balanced" or
+        "durable".
+    cache_size : int, optional
+        The page cache size, in KiB. Defaults to 64000 (64MB).
+    extra : dict, optional
+        Any other pragmas. These take precedence over everything else.
+
+    Returns
+    -------
+    pragmas : dict
+
+    Raises
+    ------
+    ValueError
+        ``durability`` is not a known mode.
+    """
+    try:
+        mode = DURABILITY_MODES[durability]
+    except KeyError:
+        msg = "Unknown durability mode '{}'. Valid options are: {}"
+        raise ValueError(msg.format(durability, sorted(DURABILITY_MODES)))
+
+    pragmas = dict(DB_OPTS)
+    pragmas.update(mode)
+    if cache_size is not None:
+        pragmas['cache_size'] = -1 * cache_size
+    if extra:
+        pragmas.update(extra)
+    return pragmas
+
+
+def schema_version(migrations):
+    """
+    Return a number that identifies a set of migrations.
+
+    :func:`create_db` stores this in the database's ``user_version`` pragma
+    once all migrations have been applied, so that later startups can tell
+    that the database is up to date without reading the migration history.
+
+    Parameters
+    ----------
+    migrations : iterable of str
+        The migration names, such as ``"0001_create_table_metric"``.
+
+    Returns
+    -------
+    int
+        A positive 31-bit number. ``user_version`` is a signed 32-bit
+        integer and 0 means that it was never set.
+    """
+    data = "\n".join(sorted(migrations)).encode("utf-8")
+    return (zlib.crc32(data) & 0x7fffffff) or 1
+
+
+def _packaged_migrations():
+    """
+    Return the names of the migrations on disk, or ``None`` if not found.
+    """
+    for directory in MIGRATION_DIRS:
+        try:
+            files = os.listdir(directory)
+        except OSError:
+            continue
+        return [f[:-len(".py")] for f in files if f.endswith(".py")]
+    return None
+
+
+def create_db(name, pragmas=None):
     """
     Create the database and the tables.
 
     Applies any missing migrations. Does nothing if all migrations
     have been applied.
 
+    If the schema version stored by a previous call matches the migrations
+    on disk (see :func:`schema_version`), the database is known to be up to
+    date and the migration history isn't checked at all.
+
     Parameters
     ----------
     name : str
         The name/path of the database, as given by ``app.config['DATABASE']``.
+    pragmas : dict, optional
+        The SQLite pragmas to use, as returned by :func:`get_pragmas`.
+        Defaults to :data:`DB_OPTS`.
     """
     #  import pdb; pdb.set_trace()
     # Convert to a Path object because I like working with those better.
@@ -122,7 +490,9 @@ def create_db(name):
     else:
         logger.debug("Creating new database: '%s'" % full_path)
 
-    db.init(str(full_path), pragmas=DB_OPTS)
+    if pragmas is None:
+        pragmas = DB_OPTS
+    db.init(str(full_path), pragmas=pragmas)
 
     try:
         # This will create the file if it doesn't exist.
@@ -140,15 +510,19 @@ def create_db(name):
         logger.error("Unable to create/open database file '%s'" % full_path)
         raise
 
-    # Either way, we want to run migrations. However, we only need to make a
-    # backup if the file already exists.
+    # Fast path: if the stored schema version matches the migrations on
+    # disk then there's nothing to do, and we don't need to build the
+    # migration manager at all.
     if file_exists:
-        # Create a backup before doing anything.
-        backup_file = utils.backup_file(full_path)
-        logger.debug("Created database backup file: {}".format(backup_file))
+        migrations = _packaged_migrations()
+        version = db.pragma("user_version")
+        if migrations and version == schema_version(migrations):
+            logger.info("Database is up to date. No migrations to apply.")
+            db.close()
+            return
 
     # This will edit the database file, creating the `migration_history`
-    # table if needed. Hence why we do it *after* the backup.
+    # table if needed.
     try:
         manager = DatabaseManager(db)
     except PermissionError:
@@ -158,7 +532,7 @@ def create_db(name):
         # close the db connection
         try:
             msg = "Failed to open default migration directory, trying '%s'"
-            alt_dir = "/trendlines/migrations"
+            alt_dir = MIGRATION_DIRS[1]
             logger.debug(msg % alt_dir)
             manager = DatabaseManager(db, directory=alt_dir)
             logger.debug("Success")
@@ -175,16 +549,25 @@ def create_db(name):
     if needs_migrations:
         logger.info("Missing migrations: {}".format(manager.diff))
 
+        # Only existing files need a backup, and only when we're about to
+        # change them. Copying a large database is slow, so we don't want
+        # to do it on every startup.
+        if file_exists:
+            backup_file = utils.backup_sqlite(full_path)
+            logger.debug("Created database backup file: {}".format(backup_file))
+
         # Apply the migrations
         success = manager.upgrade()
         if success:
             logger.info("Successfully applied database migrations.")
+            _store_schema_version(manager)
         elif file_exists:
             # revert our changes by restoring the backup
             msg = ("Failed to apply database migrations. Reverting to backup"
                    " file. Please submit an issue at {} with details.")
             logger.critical(msg.format(__project_url__))
-            shutil.copy(str(backup_file), str(full_path))
+            db.close_all()
+            utils.copy_sqlite(backup_file, full_path)
         else:
             # It's a new file, so no backup was made.
             msg = ("Failed to apply database migrations to the new file."
@@ -192,14 +575,48 @@ def create_db(name):
             logger.critical(msg)
     else:
         logger.info("Database is up to date. No migrations to apply.")
-        # Since we didn't make any changes, we can remove the backup file.
-        # Is it possible to ever have backup_file not exist if we didn't
-        # apply migrations?
-        # No, because not applying migrations implies that the file already
-        # existed, and if the file already existed then a backup was made.
-        # Thus we don't need to check for FileNotFoundError.
-        backup_file.unlink()
-        logger.debug("Removed superfluous backup file: %s" % backup_file)
+        _store_schema_version(manager)
 
     # Make sure to close the database if things went well.
     db.close()
+
+
+def _store_schema_version(manager):
+    """
+    Record that all of the manager's migrations have been applied.
+    """
+    version = schema_version(manager.migration_files)
+    db.pragma("user_version", version)
+    logger.debug("Stored schema version %s." % version)
+
+
+def open_db(name, pragmas=None):
+    """
+    Open an existing database without checking or applying migrations.
+
+    For processes other than the web app, such as the socket listeners,
+    which rely on the web app to create and migrate the database.
+
+    Parameters
+    ----------
+    name : str
+        The name/path of the database, as given by ``app.config['DATABASE']``.
+    pragmas : dict, optional
+        The SQLite pragmas to use, as returned by :func:`get_pragmas`.
+        Defaults to :data:`DB_OPTS`.
+
+    Raises
+    ------
+    FileNotFoundError
+        The database file does not exist.
+    """
+    full_path = Path(name).resolve()
+    if not full_path.exists():
+        msg = "Database file '%s' does not exist."
+        logger.error(msg % full_path)
+        raise FileNotFoundError(msg % full_path)
+
+    logger.debug("Opening existing database: '%s'." % full_path)
+    if pragmas is None:
+        pragmas = DB_OPTS
+    db.init(str(full_path), pragmas=pragmas)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import itertools
 import json
 from datetime import datetime
 from datetime import timezone
@@ -7,9 +8,13 @@ from functools import partial
 
 from marshmallow_peewee import ModelSchema
 from flask import Blueprint as FlaskBlueprint
+from flask import current_app
+from flask import json as flask_json
 from flask import jsonify
 from flask import render_template as _render_template
 from flask import request
+from flask import stream_with_context
+from flask import url_for
 from flask.views import MethodView
 
 from flask_rest_api import Api as _Api
@@ -89,14 +94,211 @@ def index(metric=None):
             # We couldn't parse as an int, so it's a metric name instead.
             metric_name = metric
 
-    metric_list = db.get_metrics()
-    tree_data = utils.build_jstree_data(metric_list)
-
+    # The tree itself is loaded by the page, one level at a time, from
+    # the /api/v1/tree endpoint.
     return render_template('trendlines/index.html',
-                           tree_data=tree_data,
                            metric_id=metric_name)
 
 
+def _get_int_arg(name):
+    """
+    Return the positive integer query parameter ``name``, or ``None``.
+
+    Raises
+    ------
+    ValueError
+        The parameter is not a positive integer. The exception args are
+        ``(name, reason)``.
+    """
+    value = request.args.get(name, None)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(name, "must be an integer.")
+    if value < 1:
+        raise ValueError(name, "must be greater than zero.")
+    return value
+
+
+def _get_bool_arg(name):
+    """
+    Return the boolean query parameter ``name``. Defaults to ``False``.
+
+    Raises
+    ------
+    ValueError
+        The parameter is not a boolean. The exception args are
+        ``(name, reason)``.
+    """
+    value = request.args.get(name, "false").lower()
+    if value in ("1", "true", "yes"):
+        return True
+    if value in ("0", "false", "no"):
+        return False
+    raise ValueError(name, "must be 'true' or 'false'.")
+
+
+def _stream_json(head, rows, tail=None):
+    """
+    Return a streaming JSON response of the form ``{**head, "rows": [...]}``.
+
+    The response body is encoded while it is sent, so only a small chunk
+    of ``rows`` is held in memory at any time, no matter how many there are.
+
+    Parameters
+    ----------
+    head : list of (key, value) tuples
+        The members to send before the array.
+    rows : tuple of (str, iterable)
+        The key and items of the array. The items are consumed lazily.
+    tail : callable, optional
+        Called after ``rows`` is exhausted. Returns a list of ``(key, value)``
+        tuples to send after the array.
+    """
+    key, items = rows
+    # Match the compact separators used by `jsonify`.
+    dumps = partial(flask_json.dumps, separators=(",", ":"))
+
+    def generate():
+        yield "{"
+        for k, v in head:
+            yield "{}:{},".format(dumps(k), dumps(v))
+        yield "{}:".format(dumps(key))
+        for chunk in utils.iter_json_array(items, dumps=dumps):
+            yield chunk
+        if tail is not None:
+            for k, v in tail():
+                yield ",{}:{}".format(dumps(k), dumps(v))
+        yield "}"
+
+    return current_app.response_class(
+        stream_with_context(generate()),
+        mimetype=current_app.config['JSONIFY_MIMETYPE'],
+    )
+
+
+def _get_timestamp_arg(name):
+    """
+    Return the timestamp query parameter ``name`` as POSIX time, or ``None``.
+
+    Raises
+    ------
+    ValueError
+        The parameter is not a valid timestamp. The exception args are
+        ``(name, reason)``.
+    """
+    try:
+        return utils.parse_timestamp(request.args.get(name, None))
+    except ValueError as err:
+        raise ValueError(name, str(err))
+
+
+def _get_duration_arg(name):
+    """
+    Return the duration query parameter ``name`` in seconds, or ``None``.
+
+    Raises
+    ------
+    ValueError
+        The parameter is not a valid duration. The exception args are
+        ``(name, reason)``.
+    """
+    try:
+        return utils.parse_duration(request.args.get(name, None))
+    except ValueError as err:
+        raise ValueError(name, str(err))
+
+
+def _get_aggregates_arg(name):
+    """
+    Return the list of aggregates in query parameter ``name``.
+
+    Defaults to ``["mean"]``.
+
+    Raises
+    ------
+    ValueError
+        An aggregate is not recognized. The exception args are
+        ``(name, reason)``.
+    """
+    try:
+        return utils.parse_aggregates(request.args.get(name, "mean"))
+    except ValueError as err:
+        raise ValueError(name, str(err))
+
+
+def _paginate(fetch, key):
+    """
+    Return one page of a keyset-paginated listing.
+
+    Reads the ``after``, ``before`` and ``limit`` query parameters.
+
+    Parameters
+    ----------
+    fetch : callable
+        Called as ``fetch(after=..., before=..., limit=...)``. See
+        :func:`db.paginate`.
+    key : str
+        The name of the attribute used as the pagination cursor.
+
+    Returns
+    -------
+    page : dict
+        With ``count``, ``prev``, ``next`` and ``results`` keys. ``prev``
+        and ``next`` are URLs to the adjacent pages, or ``None``.
+
+    Raises
+    ------
+    ValueError
+        A query parameter is invalid. The exception args are
+        ``(name, reason)``.
+    """
+    after = _get_int_arg('after')
+    before = _get_int_arg('before')
+    limit = _get_int_arg('limit')
+
+    if after is not None and before is not None:
+        raise ValueError('before', "cannot be combined with 'after'.")
+
+    max_limit = current_app.config['MAX_PAGE_SIZE']
+    if limit is None:
+        limit = current_app.config['PAGE_SIZE']
+    elif limit > max_limit:
+        raise ValueError('limit', "must be at most {}.".format(max_limit))
+
+    # Fetch one extra row to find out if there is another page.
+    rows = list(fetch(after=after, before=before, limit=limit + 1))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before is not None:
+        # Backwards pages are fetched in descending order.
+        rows.reverse()
+
+    def link(**kwargs):
+        return url_for(request.endpoint, limit=limit, **kwargs)
+
+    prev_url = next_url = None
+    if rows:
+        first = getattr(rows[0], key)
+        last = getattr(rows[-1], key)
+        if before is not None:
+            next_url = link(after=last)
+            if has_more:
+                prev_url = link(before=first)
+        else:
+            if has_more:
+                next_url = link(after=last)
+            if after is not None:
+                prev_url = link(before=first)
+
+    return {"count": len(rows),
+            "prev": prev_url,
+            "next": next_url,
+            "results": [model_to_dict(m) for m in rows]}
+
+
 @api.route("/api/v1/data")
 class Data(MethodView):
     def post(self):
@@ -106,12 +308,30 @@ class Data(MethodView):
         Expected JSON payload has the following key/value pairs::
 
           metric: string
-          value: numeric
+          value: finite numeric
           time: integer or missing
+
+        Many values can be added at once by sending a list of such objects,
+        either directly or as the ``points`` key of an object::
+
+          [{"metric": "foo", "value": 1}, {"metric": "bar", "value": 2}]
+          {"points": [{"metric": "foo", "value": 1}, ...]}
+
+        The whole batch is written in a single transaction. Invalid items
+        are skipped and reported in the response.
+
+        If ``WRITE_BUFFER_ENABLED`` is set, valid data is buffered and
+        written shortly afterwards, and ``202`` is returned instead of
+        ``201``.
         """
         data = request.get_json()
         logger.debug("Received POST /api/v1/data: {}".format(data))
 
+        if isinstance(data, dict) and 'points' in data:
+            return self._post_many(data['points'])
+        if isinstance(data, list):
+            return self._post_many(data)
+
         try:
             metric = data['metric']
             value = data['value']
@@ -119,15 +339,90 @@ class Data(MethodView):
             logger.warning("Missing JSON keys 'metric' or 'value'.")
             return "Missing required key. Required keys are:", 400
 
-        time = data.get('time', None)
+        try:
+            metric, value, time = utils.parse_data_point(data)
+        except ValueError as err:
+            logger.warning(str(err))
+            return str(err), 400
+
+        if db.write_buffer is not None:
+            db.write_buffer.add(metric, value, time)
+            msg = "Queued DataPoint for Metric '{}'\n".format(metric)
+            return msg, 202
 
-        db.add_metric(metric)
-        new = db.insert_datapoint(metric, value, time)
+        # Creates the metric if needed, and recovers if its cached id is
+        # stale because another process deleted it.
+        db.insert_datapoints([(metric, value, time)])
 
-        msg = "Added DataPoint to Metric {}\n".format(new.metric)
+        msg = "Added DataPoint to Metric '{}'\n".format(metric)
         logger.info("Added value %s to metric '%s'" % (value, metric))
         return msg, 201
 
+    def _post_many(self, items):
+        """
+        Add a batch of values, creating metrics as needed.
+
+        Returns ``201`` (``202`` if buffered) if at least one item was
+        accepted, otherwise ``400``.
+        The returned JSON has the following keys::
+
+          accepted: integer
+          rejected: integer
+          errors: list of {"index": integer, "detail": string}
+        """
+        if not isinstance(items, list):
+            items = [items]
+
+        points = []
+        errors = []
+        for n, item in enumerate(items):
+            try:
+                points.append(utils.parse_data_point(item))
+            except ValueError as err:
+                errors.append({"index": n, "detail": str(err)})
+
+        if db.write_buffer is not None:
+            for point in points:
+                db.write_buffer.add(*point)
+            accepted = len(points)
+            ok_status = 202
+        else:
+            accepted = db.insert_datapoints(points)
+            ok_status = 201
+
+        if errors:
+            logger.warning("Rejected %s of %s data points."
+                           % (len(errors), len(items)))
+
+        status = ok_status if accepted > 0 else 400
+        return jsonify({"accepted": accepted,
+                        "rejected": len(errors),
+                        "errors": errors}), status
+
+
+@api.route("/api/v1/tree")
+class Tree(MethodView):
+    def get(self):
+        """
+        Return the direct children of a node in the metric tree.
+
+        This is the format expected by jsTree's AJAX mode, so that the
+        tree can be loaded as nodes are opened instead of all at once.
+
+        Query parameters:
+
+        id : str, optional
+            The id of the node, which is the (possibly partial) dotted
+            metric name. Defaults to the root node, ``#``.
+        """
+        node_id = request.args.get('id', '#')
+        logger.debug("GET /api/v1/tree?id=%s" % node_id)
+        try:
+            children = db.get_metric_tree_children(node_id)
+        except KeyError:
+            return ErrorResponse.tree_node_not_found(node_id)
+        return jsonify(children)
+
 
 @api.route("/api/v1/data/<metric>")
 class DataByName(MethodView):
@@ -139,9 +434,77 @@ class DataByName(MethodView):
         ----------
         metric : str or int
             The metric name or the metric internal id (int) to get data for.
+
+        The following optional query parameters restrict what is returned.
+        They are all applied by the database query itself:
+
+        start : POSIX timestamp or ISO 8601 UTC datetime
+            Only return data at or after this time.
+        end : POSIX timestamp or ISO 8601 UTC datetime
+            Only return data before this time.
+        limit : int
+            Return at most this many data points, starting from the oldest
+            (or newest if ``order=desc``).
+        last : int
+            Return only the most recent ``last`` data points. Cannot be
+            combined with ``limit``.
+        order : "asc" or "desc"
+            Sort order by timestamp. Defaults to ``asc``.
+        max_points : int
+            Downsample the result to at most this many points with the
+            Largest-Triangle-Three-Buckets algorithm. The ``n`` value of
+            each row is its position in the full series. Must be at
+            least 3.
+
+            Unless ``limit`` or ``last`` is given, long series are read
+            from the minute, hour or day rollups instead of the raw data:
+            the coarsest resolution that still has ``max_points`` buckets
+            over the time window is used.
+            Each row is then a bucket, whose ``value`` is the mean, with
+            ``min``, ``max`` and ``count`` added. The response has a
+            ``resolution`` key.
+        stream : bool
+            Stream the response while reading from the database instead
+            of building it in memory first. The content is the same.
+        format : "rows" or "columnar"
+            ``rows`` (the default) returns one object per data point.
+            ``columnar`` returns ``timestamps``, ``values`` and ``ids``
+            arrays instead (plus ``n`` when downsampled). Cannot be
+            combined with ``stream``.
         """
         logger.debug("GET /api/v1/data/%s" % metric)
 
+        try:
+            start = _get_timestamp_arg('start')
+            end = _get_timestamp_arg('end')
+            limit = _get_int_arg('limit')
+            last = _get_int_arg('last')
+            max_points = _get_int_arg('max_points')
+            stream = _get_bool_arg('stream')
+        except ValueError as err:
+            return ErrorResponse.invalid_query_parameter(*err.args)
+
+        if max_points is not None and max_points < 3:
+            return ErrorResponse.invalid_query_parameter(
+                'max_points', "must be at least 3.")
+
+        order = request.args.get('order', 'asc')
+        if order not in ('asc', 'desc'):
+            return ErrorResponse.invalid_query_parameter(
+                'order', "must be 'asc' or 'desc'.")
+        if limit is not None and last is not None:
+            return ErrorResponse.invalid_query_parameter(
+                'last', "cannot be combined with 'limit'.")
+
+        fmt = request.args.get('format', 'rows')
+        if fmt not in ('rows', 'columnar'):
+            return ErrorResponse.invalid_query_parameter(
+                'format', "must be 'rows' or 'columnar'.")
+        columnar = fmt == 'columnar'
+        if columnar and stream:
+            return ErrorResponse.invalid_query_parameter(
+                'stream', "cannot be combined with 'format=columnar'.")
+
         # Support both metric_id and metric_name
         try:
             metric_id = int(metric)
@@ -151,16 +514,214 @@ class DataByName(MethodView):
             metric_name = metric
 
         try:
-            raw_data = db.get_data(metric_name)
+            # Cheaper than finding out by querying the data.
+            if db.get_metric_stats(metric_name) is None:
+                return ErrorResponse.metric_has_no_data(metric_name)
+
+            resolution = None
+            if max_points is not None and limit is None and last is None:
+                resolution = db.choose_resolution(metric_name, start, end,
+                                                  max_points)
+            if resolution is not None:
+                units = db.get_units(metric_name)
+                rollups = db.get_rollups(metric_name, resolution, start, end,
+                                         descending=(order == 'desc'))
+                return _rollup_response(list(rollups), units, resolution,
+                                        max_points, columnar)
+
+            if last is not None:
+                # The newest `last` points, pulled from the end of the index.
+                raw_data = db.get_data(metric_name, start, end, limit=last,
+                                       descending=True)
+            else:
+                raw_data = db.get_data(metric_name, start, end, limit=limit,
+                                       descending=(order == 'desc'))
+            if columnar:
+                # Skip building a model instance for every row.
+                raw_data = raw_data.select(orm.DataPoint.timestamp,
+                                           orm.DataPoint.value,
+                                           orm.DataPoint.datapoint_id)
+                raw_data = raw_data.tuples()
+            if last is not None and order == 'asc':
+                raw_data = list(reversed(raw_data))
             units = db.get_units(metric_name)
         except DoesNotExist:
             return ErrorResponse.metric_not_found(metric_name)
 
+        if stream and max_points is None:
+            # Don't let peewee cache the rows: they're discarded once sent.
+            if not isinstance(raw_data, list):
+                raw_data = raw_data.iterator()
+            rows = iter(raw_data)
+            first = next(rows, None)
+            if first is None:
+                return ErrorResponse.metric_has_no_data(metric_name)
+            rows = itertools.chain([first], rows)
+            return _stream_json([("units", units)],
+                                ("rows", utils.iter_format_data(rows)))
+
         if len(raw_data) == 0:
+            # Nothing in the time window.
             return ErrorResponse.metric_has_no_data(metric_name)
 
-        data = utils.format_data(raw_data, units)
+        indices = None
+        if max_points is not None and len(raw_data) > max_points:
+            raw_data = list(raw_data)
+            if columnar:
+                values = [row[1] for row in raw_data]
+            else:
+                values = [row.value for row in raw_data]
+            indices = utils.lttb(values, max_points)
+            raw_data = [raw_data[i] for i in indices]
+
+        if columnar:
+            data = utils.format_columnar(raw_data, units, indices)
+        else:
+            data = utils.format_data(raw_data, units, indices)
+
+        return jsonify(data)
+
+
+def _rollup_response(rollups, units, resolution, max_points, columnar):
+    """
+    Build the response of :class:`DataByName` for rollup data.
+    """
+    # The `n` of each bucket is the position of its first data point.
+    indices = list(itertools.accumulate([0] + [r.count for r in rollups]))
+    indices = indices[:-1]
+    if len(rollups) > max_points:
+        keep = utils.lttb([r.mean for r in rollups], max_points)
+        rollups = [rollups[i] for i in keep]
+        indices = [indices[i] for i in keep]
+
+    names = {seconds: name for name, seconds in orm.ROLLUP_RESOLUTIONS.items()}
+    if columnar:
+        data = utils.format_rollups_columnar(rollups, units, indices,
+                                             names[resolution])
+    else:
+        data = utils.format_rollups(rollups, units, indices, names[resolution])
+    return jsonify(data)
+
+
+@api.route("/api/v1/data/<metric>/latest")
+class LatestByName(MethodView):
+    def get(self, metric):
+        """
+        Return the newest data point of a metric.
+
+        Parameters
+        ----------
+        metric : str or int
+            The metric name or the metric internal id (int).
+
+        This is read from the metric's summary statistics, so it doesn't
+        depend on how much data the metric has. See
+        :func:`utils.format_latest` for the format.
+        """
+        logger.debug("GET /api/v1/data/%s/latest" % metric)
+        try:
+            try:
+                metric_id = int(metric)
+            except ValueError:
+                metric_id = db.get_metric_id(metric)
+            stats = db.get_metric_stats(metric_id)
+        except DoesNotExist:
+            return ErrorResponse.metric_not_found(metric)
 
+        if stats is None:
+            return ErrorResponse.metric_has_no_data(metric)
+
+        data = utils.format_latest(stats.metric.name, stats.metric.units,
+                                   stats.last_timestamp, stats.last_value)
+        return jsonify(data)
+
+
+@api.route("/api/v1/latest")
+class Latest(MethodView):
+    def get(self):
+        """
+        Return the newest data point of many metrics at once.
+
+        Query parameters:
+
+        prefix : str, optional
+            Only include the metrics whose name starts with this string,
+            such as ``foo.``. Defaults to all metrics.
+
+        Metrics without data are left out. The ``rows`` are ordered by
+        metric name; see :func:`utils.format_latest` for their format.
+        """
+        prefix = request.args.get('prefix')
+        logger.debug("GET /api/v1/latest?prefix=%s" % prefix)
+        rows = [utils.format_latest(*row) for row in db.get_latest(prefix)]
+        return jsonify({"rows": rows})
+
+
+@api.route("/api/v1/data/<metric>/aggregate")
+class AggregateByName(MethodView):
+    def get(self, metric):
+        """
+        Return a metric's data aggregated over fixed time buckets.
+
+        Parameters
+        ----------
+        metric : str or int
+            The metric name or the metric internal id (int).
+
+        Query parameters:
+
+        bucket : duration
+            Required. The bucket size, in seconds (``90``) or with a unit
+            (``15m``, ``1h``, ``1d``, ``1w``). Buckets are aligned to the
+            UTC epoch.
+        agg : str, optional
+            A comma-separated list of ``count``, ``sum``, ``mean``, ``min``,
+            ``max``, ``std``, ``median`` and percentiles such as ``p95``.
+            Defaults to ``mean``.
+        start, end : POSIX timestamp or ISO 8601 UTC datetime, optional
+            The time window. See :class:`DataByName`. With percentiles, the
+            window may hold at most ``AGGREGATE_MAX_PERCENTILE_POINTS``
+            data points.
+
+        The result is columnar: a ``timestamps`` array holds the start of
+        each bucket that has data, and each aggregate gets an array of the
+        same length. See :func:`db.aggregate`.
+        """
+        logger.debug("GET /api/v1/data/%s/aggregate" % metric)
+        try:
+            bucket = _get_duration_arg('bucket')
+            start = _get_timestamp_arg('start')
+            end = _get_timestamp_arg('end')
+            aggregates = _get_aggregates_arg('agg')
+        except ValueError as err:
+            return ErrorResponse.invalid_query_parameter(*err.args)
+        if bucket is None:
+            return ErrorResponse.invalid_query_parameter(
+                'bucket', "is required.")
+
+        try:
+            try:
+                metric_id = int(metric)
+            except ValueError:
+                metric_id = db.get_metric_id(metric)
+            stats = db.get_metric_stats(metric_id)
+        except DoesNotExist:
+            return ErrorResponse.metric_not_found(metric)
+
+        if stats is None:
+            return ErrorResponse.metric_has_no_data(metric)
+
+        # Percentiles need all of the window's data in memory at once.
+        max_points = current_app.config['AGGREGATE_MAX_PERCENTILE_POINTS']
+        needs_data = any(a not in utils.SQL_AGGREGATES for a in aggregates)
+        if (needs_data and stats.count > max_points
+                and db.count_data(stats.metric.name, start, end) > max_points):
+            return ErrorResponse.window_too_large(max_points)
+
+        buckets, columns = db.aggregate(stats.metric.name, bucket, aggregates,
+                                        start, end)
+        data = utils.format_aggregates(buckets, columns, stats.metric.units,
+                                       bucket)
         return jsonify(data)
 
 
@@ -170,20 +731,56 @@ class DataPoint(MethodView):
     def get(self):
         """
         Return all of the data for all metrics.
+
+        Results are paginated: use the ``after``, ``before`` and ``limit``
+        query parameters, or simply follow the ``next`` and ``prev`` links.
+
+        With ``stream=true``, all datapoints after the ``after`` cursor (or
+        the first ``limit`` of them) are streamed in a single response
+        instead. ``count`` is then sent after the results.
         """
         logger.debug("api: GET all datapoints")
-        raw_data = db.get_datapoints()
-        if len(raw_data) == 0:
-            # do a thing.
+        try:
+            if _get_bool_arg('stream'):
+                return self._stream()
+            page = _paginate(db.get_datapoints, 'datapoint_id')
+        except ValueError as err:
+            return ErrorResponse.invalid_query_parameter(*err.args)
+
+        is_first_page = not ('after' in request.args
+                             or 'before' in request.args)
+        if page['count'] == 0 and is_first_page:
             return ErrorResponse.no_data()
 
-        data = [model_to_dict(m) for m in raw_data]
+        return jsonify(page)
+
+    def _stream(self):
+        """
+        Stream all datapoints, starting after the ``after`` cursor.
+        """
+        after = _get_int_arg('after')
+        limit = _get_int_arg('limit')
+        if 'before' in request.args:
+            raise ValueError('before', "cannot be combined with 'stream'.")
+
+        rows = db.get_datapoints(after=after, limit=limit).iterator()
+        first = next(rows, None)
+        if first is None and after is None:
+            return ErrorResponse.no_data()
+        if first is not None:
+            rows = itertools.chain([first], rows)
 
-        # For now, fill in dummy values.
-        return jsonify({"count": len(data),
-                        "prev": None,
-                        "next": None,
-                        "results": data})
+        count = 0
+
+        def results():
+            nonlocal count
+            for row in rows:
+                count += 1
+                yield model_to_dict(row)
+
+        return _stream_json([("prev", None), ("next", None)],
+                            ("results", results()),
+                            lambda: [("count", count)])
 
     @api_datapoint.response(DataPointSchema, code=201)
     def post(self):
@@ -285,8 +882,8 @@ class DataPointById(MethodView):
         logger.debug("'api: DELETE datapoint '%s'" % datapoint_id)
 
         try:
-            found = db.DataPoint.get(db.DataPoint.datapoint_id == datapoint_id)
-            found.delete_instance()
+            # Also updates the metric's rollups and summary statistics.
+            db.delete_datapoint(db.get_datapoint(datapoint_id))
         except DoesNotExist:
             return ErrorResponse.datapoint_not_found(datapoint_id)
         else:
@@ -299,20 +896,22 @@ class Metric(MethodView):
     def get(self):
         """
         Return a list of all metrics in the database.
+
+        Results are paginated: use the ``after``, ``before`` and ``limit``
+        query parameters, or simply follow the ``next`` and ``prev`` links.
         """
         logger.debug("api: GET all metrics")
-        raw_data = db.get_metrics()
-        if len(raw_data) == 0:
-            # do a thing.
-            return ErrorResponse.no_data()
+        try:
+            page = _paginate(db.get_metrics, 'metric_id')
+        except ValueError as err:
+            return ErrorResponse.invalid_query_parameter(*err.args)
 
-        data = [model_to_dict(m) for m in raw_data]
+        is_first_page = not ('after' in request.args
+                             or 'before' in request.args)
+        if page['count'] == 0 and is_first_page:
+            return ErrorResponse.no_data()
 
-        # For now, fill in dummy values.
-        return jsonify({"count": len(data),
-                        "prev": None,
-                        "next": None,
-                        "results": data})
+        return jsonify(page)
 
     @api_metric.response(MetricSchema, code=201)
     def post(self):
@@ -327,10 +926,13 @@ class Metric(MethodView):
              "units": string, optional,
              "upper_limit": {float, optional},
              "lower_limit": {float, optional},
+             "retention_days": {float > 0, optional},
+             "retention_points": {int >= 1, optional},
            }
 
         Returns ``201`` on success, ``400`` on malformed JSON data (such as when
-        ``name`` is missing), or ``409`` if the metric already exists.
+        ``name`` is missing) or invalid values, or ``409`` if the metric
+        already exists.
 
         See Also
         --------
@@ -354,9 +956,16 @@ class Metric(MethodView):
         units = data.get('units', None)
         lower_limit = data.get('lower_limit', None)
         upper_limit = data.get('upper_limit', None)
+        retention_days = data.get('retention_days', None)
+        retention_points = data.get('retention_points', None)
 
-        new = db.add_metric(metric, units=units, lower_limit=lower_limit,
-                            upper_limit=upper_limit)
+        try:
+            new = db.add_metric(metric, units=units, lower_limit=lower_limit,
+                                upper_limit=upper_limit,
+                                retention_days=retention_days,
+                                retention_points=retention_points)
+        except (TypeError, ValueError) as err:
+            return ErrorResponse.invalid_metric(str(err))
 
         # Our `db.add_metric` fuction doesn't pull the new metric_id, so we
         # grab that separately.
@@ -371,6 +980,9 @@ class MetricById(MethodView):
     def get(self, metric_id):
         """
         Return metric information as JSON
+
+        The ``stats`` key holds summary statistics of the metric's data:
+        see :func:`utils.format_metric_stats`.
         """
         logger.debug("API: get metric '%s'" % metric_id)
 
@@ -380,6 +992,8 @@ class MetricById(MethodView):
             return ErrorResponse.metric_not_found(metric_id)
 
         data = model_to_dict(raw_data)
+        stats = db.get_metric_stats(raw_data.metric_id)
+        data['stats'] = utils.format_metric_stats(stats)
 
         return jsonify(data)
 
@@ -390,7 +1004,9 @@ class MetricById(MethodView):
 
         This function cannot change the ``metric_id`` value.
 
-        Keys not given are assumed to be ``None``.
+        Keys not given are assumed to be ``None``, so leaving out
+        ``retention_days`` and ``retention_points`` removes the metric's own
+        retention policy.
 
         Accepts JSON data with the following format:
 
@@ -400,6 +1016,8 @@ class MetricById(MethodView):
              "units": {string, optional},
              "upper_limit": {float, optional},
              "lower_limit": {float, optional},
+             "retention_days": {float > 0, optional},
+             "retention_points": {int >= 1, optional},
            }
 
         Returns
@@ -407,7 +1025,8 @@ class MetricById(MethodView):
         204 :
             Success.
         400 :
-            Malformed JSON data (such as when ``name`` is missing)
+            Malformed JSON data (such as when ``name`` is missing), or an
+            invalid retention policy.
         404 :
             The requested metric is not found.
         409 :
@@ -444,12 +1063,19 @@ class MetricById(MethodView):
         # that peewee's `save` method performs an UPDATE instead of INSERT.
         metric.metric_id = old['metric_id']
 
+        try:
+            db.check_retention(metric.retention_days, metric.retention_points)
+        except (TypeError, ValueError) as err:
+            return ErrorResponse.invalid_metric(str(err))
+
         try:
             metric.save()
         except IntegrityError:
             # Failed the unique constraint on Metric.name
             return ErrorResponse.unique_metric_name_required(old['name'], name)
 
+        db.invalidate_metric_cache(old['name'])
+
         return 204
 
     @api_metric.response(code=204)
@@ -466,7 +1092,9 @@ class MetricById(MethodView):
              "name": {string, optional},
              "units": {string, optional},
              "upper_limit": {float, optional},
-             "lower_limit": {float, optional}
+             "lower_limit": {float, optional},
+             "retention_days": {float > 0, optional},
+             "retention_points": {int >= 1, optional}
            }
 
         Returns
@@ -499,20 +1127,28 @@ class MetricById(MethodView):
 
         metric = update_model_from_dict(metric, data)
 
+        try:
+            db.check_retention(metric.retention_days, metric.retention_points)
+        except (TypeError, ValueError) as err:
+            return ErrorResponse.invalid_metric(str(err))
+
         try:
             metric.save()
         except IntegrityError:
             # Failed the unique constraint on Metric.name
             return ErrorResponse.unique_metric_name_required(old['name'], metric.name)
 
+        db.invalidate_metric_cache(old['name'])
+
         return 204
 
     @api_metric.response(code=204)
     def delete(self, metric_id):
         logger.debug("'api: DELETE '%s'" % metric_id)
 
+        # Delete the data in chunks rather than letting it cascade, so that
+        # a large metric doesn't lock out writers until it's gone.
         try:
-            found = db.Metric.get(db.Metric.metric_id == metric_id)
-            found.delete_instance()
+            db.delete_metric(metric_id)
         except DoesNotExist:
             return ErrorResponse.metric_not_found(metric_id)
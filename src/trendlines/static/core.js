@@ -1,14 +1,30 @@
+// The most points to request for a plot. Longer series are downsampled by
+// the server, which keeps both the payload and Plotly responsive.
+var MAX_PLOT_POINTS = 5000;
+
+
 /**
  * Populate the JSTree tree.
+ *
+ * Nodes are loaded from the API as they are opened, so only the expanded
+ * parts of the tree are ever sent to the browser.
  */
-function populateTree(data, metricId, urlPrefix) {
+function populateTree(metricId, urlPrefix) {
   var tree = $('#jstree-div');
 
+  // urlPrefix can be `null`. See `treeChanged`.
+  urlPrefix = urlPrefix || ""
+
   // Create an instance when the DOM is ready.
   tree.jstree(
     {
       'core': {
-        'data' : data
+        'data' : {
+          'url': urlPrefix + "/api/v1/tree",
+          'data': function (node) {
+            return { 'id': node.id };
+          }
+        }
       }
     }
   );
@@ -28,11 +44,6 @@ function populateTree(data, metricId, urlPrefix) {
   tree.on("changed.jstree", function (e, data) {
   });
 
-  // Open all of the nodes by default
-  tree.on("loaded.jstree", function () {
-    tree.jstree('open_all');
-  });
-
   // Update the plot or toggle the node open/closed.
   tree.on('select_node.jstree', function(e, data) {
     treeChanged(e, data, urlPrefix);
@@ -52,7 +63,8 @@ function treeChanged(e, data, urlPrefix) {
     // with a string, gets cast to the string 'null'. So we get "null/api/..."
     urlPrefix = urlPrefix || ""
 
-    var expected = urlPrefix + "/api/v1/data/" + data.node.original.metric_id;
+    var expected = urlPrefix + "/api/v1/data/" + data.node.original.metric_id
+      + "?format=columnar&max_points=" + MAX_PLOT_POINTS;
     // grab the plot data from the api
     $.getJSON(expected)
       .done(function(jsonData) {
@@ -79,11 +91,32 @@ function treeChanged(e, data, urlPrefix) {
  *   (b) the jsTree object has fully loaded.
  */
 function selectNodeById(tree, metricId) {
-  if (typeof metricId !== 'undefined') {
-    // We were given a metric ID, so let's select it in the jstree
-    tree.jstree('select_node', metricId);
+  if (typeof metricId !== 'undefined' && metricId !== null) {
+    // We were given a metric ID, so let's select it in the jstree. Its
+    // ancestors have to be loaded and opened first, one level at a time.
+    var parts = metricId.split(".");
+    var ancestors = [];
+    for (var i = 1; i < parts.length; i++) {
+      ancestors.push(parts.slice(0, i).join("."));
+    }
+    openNodes(tree, ancestors, function () {
+      tree.jstree('select_node', metricId);
+    });
   }
+}
+
 
+/*
+ * Open each of the given tree nodes in order, then call `done`.
+ */
+function openNodes(tree, nodeIds, done) {
+  if (nodeIds.length === 0) {
+    done();
+    return;
+  }
+  tree.jstree('open_node', nodeIds[0], function () {
+    openNodes(tree, nodeIds.slice(1), done);
+  });
 }
 
 
@@ -97,12 +130,17 @@ function makePlot(data) {
   // trace being appended.
   Plotly.purge(TESTER);
 
-  // I think Plotly only accepts 1D arrays of data, so split things out.
-  var x = data.rows.map(function (obj) {return obj.timestamp});
-  var y = data.rows.map(function (obj) {return obj.value});
-  var n = data.rows.map(function (obj) {return obj.n});
+  // The data is columnar, which is what Plotly wants.
+  var x = data.timestamps;
+  var y = data.values;
   var units = data.units;
 
+  // `n` is only sent if the data was downsampled. Otherwise it's 0, 1, 2...
+  var n = data.n;
+  if (typeof n === 'undefined') {
+    n = y.map(function (value, index) {return index});
+  }
+
   trace1 = {
     x: n,
     y: y,
@@ -1,12 +1,20 @@
 # -*- coding: utf-8 -*-
 """
 """
+import calendar
+import json
+import math
 import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from contextlib import contextmanager
 from datetime import datetime
 from datetime import timezone
 from pathlib import Path
 
+import numpy as np
 from flask import current_app
 from flask import jsonify
 from flask import url_for
@@ -31,6 +39,146 @@ def adjust_jsonify_mimetype(new_type):
     current_app.config[var_name] = old
 
 
+class LRUCache(object):
+    """
+    A small, thread-safe, size-bounded Least Recently Used cache.
+
+    Once ``maxsize`` items are stored, adding a new item evicts the item
+    that was used least recently.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of items to keep.
+    ttl : float, optional
+        Forget each item this many seconds after it was stored. If ``None``,
+        items are kept until they are evicted or discarded.
+    """
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (value, expiry time or None)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and not self._expired(item)
+
+    def get(self, key, default=None):
+        """
+        Return the value for ``key``, marking it as recently used.
+        """
+        with self._lock:
+            try:
+                item = self._data[key]
+            except KeyError:
+                return default
+            if self._expired(item):
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value):
+        """
+        Store ``value`` under ``key``, evicting old items if needed.
+        """
+        with self._lock:
+            expires = None
+            if self.ttl is not None:
+                expires = time.monotonic() + self.ttl
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            self._evict()
+
+    def discard(self, key):
+        """
+        Remove ``key`` from the cache. Does nothing if it's not cached.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all items from the cache.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def resize(self, maxsize):
+        """
+        Change the maximum size of the cache, evicting items if needed.
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    @staticmethod
+    def _expired(item):
+        expires = item[1]
+        return expires is not None and time.monotonic() >= expires
+
+    def _evict(self):
+        while len(self._data) > max(self.maxsize, 0):
+            self._data.popitem(last=False)
+
+
+class CachedValue(object):
+    """
+    A thread-safe cache for a single value that is expensive to compute.
+
+    Parameters
+    ----------
+    ttl : float, optional
+        Recompute the value once it is this many seconds old. If ``None``,
+        the value is kept until :meth:`invalidate` is called.
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._value = None
+        self._expires = None
+        self._valid = False
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, func):
+        """
+        Return the cached value, calling ``func()`` to compute it if needed.
+        """
+        with self._lock:
+            if self._valid and (self._expires is None
+                                or time.monotonic() < self._expires):
+                return self._value
+            generation = self._generation
+
+        value = func()
+
+        with self._lock:
+            # Don't store a value that was invalidated while computing it.
+            if generation == self._generation:
+                self._value = value
+                self._valid = True
+                if self.ttl is None:
+                    self._expires = None
+                else:
+                    self._expires = time.monotonic() + self.ttl
+        return value
+
+    def invalidate(self):
+        """
+        Drop the cached value.
+        """
+        with self._lock:
+            self._generation += 1
+            self._value = None
+            self._valid = False
+
+
 def get_metric_parent(metric):
     """
     Determine the parent of a metric.
@@ -147,34 +295,57 @@ def build_jstree_data(metrics):
     """
     # First go through and make all of our existing links
     data = [format_metric_for_jstree(m) for m in metrics]
+    known = set(m['id'] for m in data)
 
-    # then search through that data and find any missing parents.
-    for m in data:
+    # then walk up from each node, creating missing parents until we reach
+    # the root or a node that already exists. Each node is created once, so
+    # this is linear in the number of nodes.
+    for m in list(data):
         parent = m["parent"]
-
-        # ignore root nodes and parents that already exist.
-        if parent == "#" or parent in (x['id'] for x in data):
-            continue
-
-        # Create the grandparent
-        new_parent = get_metric_parent(parent)
-
-        # Add the new, non-linked item to our data. Yes we're intentionally
-        # modifying the array we're looping over so that we make sure to
-        # get all parents no matter how deep.
-        new = {"id": m['parent'],
-               "parent": new_parent,
-               "text": m['parent'],
-               "metric_id": None,
-               }
-        data.append(new)
+        while parent != "#" and parent not in known:
+            new_parent = get_metric_parent(parent)
+            new = {"id": parent,
+                   "parent": new_parent,
+                   "text": parent,
+                   "metric_id": None,
+                   }
+            data.append(new)
+            known.add(parent)
+            parent = new_parent
 
     # Lastly sort things in a predictable fashion.
     data.sort(key=lambda d: d['id'])
     return data
 
 
-def format_data(data, units=None):
+def build_jstree_children(tree):
+    """
+    Group jsTree data by parent, for loading the tree one level at a time.
+
+    Parameters
+    ----------
+    tree : list of dict
+        As returned by :func:`build_jstree_data`.
+
+    Returns
+    -------
+    children : dict of {str: list of dict}
+        Maps each node id, including the root ``#``, to its direct children.
+        Each child is a copy of its node without the ``parent`` key but with
+        a ``children`` key, which is ``True`` if the child has children of
+        its own. This is the format expected by jsTree's AJAX mode.
+    """
+    has_children = set(node['parent'] for node in tree)
+    children = {"#": []}
+    for node in tree:
+        new = {k: v for k, v in node.items() if k != "parent"}
+        new['children'] = node['id'] in has_children
+        children.setdefault(node['parent'], []).append(new)
+        children.setdefault(node['id'], [])
+    return children
+
+
+def format_data(data, units=None, indices=None):
     """
     Helper function: format data for template consumption.
 
@@ -187,17 +358,597 @@ def format_data(data, units=None):
         The units of the data, if any. The :meth:`db.get_units` function can
         be used to get this value.
 
+    indices : iterable of int, optional
+        The position of each row within the full series, used as the ``n``
+        value. Needed when ``data`` has been downsampled. Defaults to
+        ``0, 1, 2, ...``.
+
     Returns
     -------
     data : dict
         Dictionary of data where ``timestamp`` is an ISO 8601 string.
     """
-    data = [{'timestamp': row.timestamp.isoformat(),
-             'value': row.value,
-             'id': row.datapoint_id,
-             'n': n}
-            for n, row in enumerate(data)]
-    return {'rows': data, "units": units}
+    return {'rows': list(iter_format_data(data, indices)), "units": units}
+
+
+def iter_format_data(data, indices=None):
+    """
+    Lazily format data rows. See :func:`format_data`.
+
+    Parameters
+    ----------
+    data : iterable of :class:`orm.DataPoint`
+    indices : iterable of int, optional
+
+    Yields
+    ------
+    row : dict
+    """
+    if indices is None:
+        rows = enumerate(data)
+    else:
+        rows = zip((int(i) for i in indices), data)
+
+    for n, row in rows:
+        yield {'timestamp': row.timestamp.isoformat(),
+               'value': row.value,
+               'id': row.datapoint_id,
+               'n': n}
+
+
+def format_columnar(data, units=None, indices=None):
+    """
+    Format data as parallel columns instead of one object per row.
+
+    This is about half the size of :func:`format_data` and can be handed
+    to a plotting library as-is.
+
+    Parameters
+    ----------
+    data : iterable of (timestamp, value, datapoint_id) tuples
+        For example :func:`db.get_data` with ``.tuples()`` applied.
+    units : str, optional
+        The units of the data, if any.
+    indices : iterable of int, optional
+        The position of each row within the full series. Only needed when
+        ``data`` has been downsampled, in which case it is returned as the
+        ``n`` column.
+
+    Returns
+    -------
+    data : dict
+        With ``timestamps`` (ISO 8601 strings), ``values``, ``ids`` and
+        ``units`` keys, plus ``n`` if ``indices`` was given.
+    """
+    columns = list(zip(*data)) or [(), (), ()]
+    timestamps, values, ids = columns
+    rv = {
+        "timestamps": [t.isoformat() for t in timestamps],
+        "values": list(values),
+        "ids": list(ids),
+        "units": units,
+    }
+    if indices is not None:
+        rv["n"] = [int(i) for i in indices]
+    return rv
+
+
+def format_rollups(rollups, units=None, indices=None, resolution=None):
+    """
+    Format rollups like :func:`format_data`.
+
+    Each row's ``value`` is the mean of its bucket, and its ``timestamp``
+    is the start of the bucket. ``min``, ``max`` and ``count`` are added,
+    and ``id`` is always ``None``.
+
+    Parameters
+    ----------
+    rollups : iterable of :class:`orm.Rollup`
+    units : str, optional
+    indices : iterable of int
+        The position of the first data point of each bucket within the
+        full series, used as the ``n`` value.
+    resolution : str, optional
+        The name of the rollup resolution, such as ``"hour"``.
+
+    Returns
+    -------
+    data : dict
+    """
+    rows = [{'timestamp': row.timestamp.isoformat(),
+             'value': row.mean,
+             'min': row.minimum,
+             'max': row.maximum,
+             'count': row.count,
+             'id': None,
+             'n': int(n)}
+            for n, row in zip(indices, rollups)]
+    return {'rows': rows, 'units': units, 'resolution': resolution}
+
+
+def format_rollups_columnar(rollups, units=None, indices=None,
+                            resolution=None):
+    """
+    Format rollups like :func:`format_columnar`.
+
+    ``values`` holds the mean of each bucket and ``timestamps`` the start of
+    each bucket. There's no ``ids`` column, but there are ``mins``,
+    ``maxs`` and ``counts`` columns. ``n`` is always included.
+
+    Parameters
+    ----------
+    rollups : iterable of :class:`orm.Rollup`
+    units : str, optional
+    indices : iterable of int
+        See :func:`format_rollups`.
+    resolution : str, optional
+        See :func:`format_rollups`.
+
+    Returns
+    -------
+    data : dict
+    """
+    rollups = list(rollups)
+    return {
+        "timestamps": [row.timestamp.isoformat() for row in rollups],
+        "values": [row.mean for row in rollups],
+        "mins": [row.minimum for row in rollups],
+        "maxs": [row.maximum for row in rollups],
+        "counts": [row.count for row in rollups],
+        "n": [int(i) for i in indices],
+        "units": units,
+        "resolution": resolution,
+    }
+
+
+def format_metric_stats(stats):
+    """
+    Format the summary statistics of a metric.
+
+    Parameters
+    ----------
+    stats : :class:`orm.MetricStats` or None
+        ``None`` means that the metric has no data.
+
+    Returns
+    -------
+    data : dict
+        With ``count``, ``min``, ``max``, ``sum``, ``mean``, ``std`` (the
+        population standard deviation), ``first`` and ``last`` (ISO 8601
+        timestamps) and ``last_value`` keys. All but ``count`` are ``None``
+        if there is no data.
+    """
+    if stats is None:
+        keys = ("min", "max", "sum", "mean", "std", "first", "last",
+                "last_value")
+        return dict(count=0, **{k: None for k in keys})
+
+    return {
+        "count": stats.count,
+        "min": stats.minimum,
+        "max": stats.maximum,
+        "sum": stats.total,
+        "mean": stats.mean,
+        "std": stats.std,
+        "first": _isoformat(stats.first_timestamp),
+        "last": _isoformat(stats.last_timestamp),
+        "last_value": stats.last_value,
+    }
+
+
+def format_latest(metric, units, timestamp, value):
+    """
+    Format the newest data point of a metric.
+
+    Parameters
+    ----------
+    metric : str
+        The metric name.
+    units : str or None
+    timestamp : int
+        The POSIX timestamp of the data point.
+    value : float
+
+    Returns
+    -------
+    data : dict
+        With ``metric``, ``timestamp`` (an ISO 8601 string), ``value`` and
+        ``units`` keys.
+    """
+    return {
+        "metric": metric,
+        "timestamp": _isoformat(timestamp),
+        "value": value,
+        "units": units,
+    }
+
+
+def format_aggregates(buckets, columns, units=None, bucket=None):
+    """
+    Format the result of :func:`db.aggregate` as parallel columns.
+
+    Parameters
+    ----------
+    buckets : list of int
+        The POSIX timestamp of the start of each bucket.
+    columns : dict
+        Maps each aggregate name to its list of values.
+    units : str, optional
+    bucket : int, optional
+        The bucket size in seconds.
+
+    Returns
+    -------
+    data : dict
+        With ``timestamps`` (ISO 8601 strings), one list per aggregate, and
+        ``units`` and ``bucket`` keys.
+    """
+    rv = {"timestamps": [_isoformat(b) for b in buckets]}
+    rv.update(columns)
+    rv["units"] = units
+    rv["bucket"] = bucket
+    return rv
+
+
+def _isoformat(timestamp):
+    """
+    Format a POSIX timestamp like the naive UTC datetimes of the data.
+    """
+    dt = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    return dt.replace(tzinfo=None).isoformat()
+
+
+def iter_json_array(items, dumps=json.dumps, chunk_size=500):
+    """
+    Encode ``items`` as a JSON array, a few items at a time.
+
+    Used for streaming responses: only ``chunk_size`` items are held in
+    memory at once.
+
+    Parameters
+    ----------
+    items : iterable
+        The JSON-serializable items of the array.
+    dumps : callable, optional
+        The function used to encode each item.
+    chunk_size : int, optional
+        The number of items encoded into each yielded string.
+
+    Yields
+    ------
+    chunk : str
+        Pieces of the array. Joined together they are valid JSON.
+    """
+    yield "["
+    chunk = []
+    sep = ""
+    for item in items:
+        chunk.append(dumps(item))
+        if len(chunk) >= chunk_size:
+            yield sep + ",".join(chunk)
+            sep = ","
+            chunk = []
+    if chunk:
+        yield sep + ",".join(chunk)
+    yield "]"
+
+
+def lttb(y, n_out, x=None):
+    """
+    Downsample a series with the Largest-Triangle-Three-Buckets algorithm.
+
+    LTTB keeps the first and last points and picks one point from each of
+    ``n_out - 2`` equally-sized buckets in between: the point that forms
+    the largest triangle with the previously selected point and the
+    average of the next bucket. This keeps the visual shape of the series,
+    including its peaks, which plain decimation would lose.
+
+    See Sveinn Steinarsson, "Downsampling Time Series for Visual
+    Representation", 2013.
+
+    Parameters
+    ----------
+    y : array-like
+        The values of the series.
+    n_out : int
+        The number of points to keep. Must be at least 3.
+    x : array-like, optional
+        The x coordinate of each value. Defaults to ``0, 1, 2, ...``.
+
+    Returns
+    -------
+    indices : :class:`numpy.ndarray` of int
+        The sorted indices of the selected points. If the series already
+        has ``n_out`` points or fewer, all indices are returned.
+    """
+    if n_out < 3:
+        raise ValueError("n_out must be at least 3.")
+
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n <= n_out:
+        return np.arange(n)
+
+    if x is None:
+        x = np.arange(n, dtype=float)
+    else:
+        x = np.asarray(x, dtype=float)
+
+    # Bucket `i` holds the interior points edges[i]:edges[i + 1]. Each
+    # bucket has at least one point since n - 2 > n_out - 2.
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    counts = np.diff(edges)
+    mean_x = np.add.reduceat(x[:n - 1], edges[:-1]) / counts
+    mean_y = np.add.reduceat(y[:n - 1], edges[:-1]) / counts
+
+    # The third corner of each triangle: the average of the next bucket,
+    # or the last point for the last bucket.
+    next_x = np.append(mean_x[1:], x[-1])
+    next_y = np.append(mean_y[1:], y[-1])
+
+    indices = np.empty(n_out, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        bx = x[start:stop]
+        by = y[start:stop]
+        # Twice the triangle area; the factor doesn't change the argmax.
+        area = np.abs((x[a] - next_x[i]) * (by - y[a])
+                      - (x[a] - bx) * (next_y[i] - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+
+    return indices
+
+
+def parse_data_point(item):
+    """
+    Validate a single data point as sent to ``/api/v1/data``.
+
+    Parameters
+    ----------
+    item : dict
+        Must contain ``metric`` and ``value`` keys. May contain a ``time``
+        key holding the POSIX timestamp of the data point.
+
+    Returns
+    -------
+    (metric, value, time) : tuple
+        ``time`` is ``None`` if it was not given.
+
+    Raises
+    ------
+    ValueError
+        The item is malformed. The message describes the problem.
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Expected a JSON object, got `%s`." % item)
+
+    try:
+        metric = item['metric']
+        value = item['value']
+    except KeyError:
+        raise ValueError("Missing required key. Required keys are: "
+                         "'metric', 'value'.")
+
+    return validate_data_point(metric, value, item.get('time', None))
+
+
+def validate_data_point(metric, value, time=None):
+    """
+    Check that a data point can be stored.
+
+    Parameters
+    ----------
+    metric : str
+        The full metric name.
+    value : numeric
+        Must be finite.
+    time : numeric, optional
+        The POSIX timestamp of the data point. Must be between
+        :data:`TIMESTAMP_MIN` and :data:`TIMESTAMP_MAX`.
+
+    Returns
+    -------
+    (metric, value, time) : tuple
+
+    Raises
+    ------
+    ValueError
+        The data point is invalid. The message describes the problem.
+    """
+    _numeric = (int, float)
+    if not isinstance(metric, str) or metric == "":
+        raise ValueError("'metric' must be a non-empty string.")
+    if not isinstance(value, _numeric) or isinstance(value, bool):
+        raise ValueError("'value' must be numeric.")
+    if not _isfinite(value):
+        raise ValueError("'value' must be finite, got `%s`." % value)
+
+    if time is not None:
+        if not isinstance(time, _numeric) or isinstance(time, bool):
+            raise ValueError("'time' must be a POSIX timestamp.")
+        # Also rejects NaN.
+        if not TIMESTAMP_MIN <= time <= TIMESTAMP_MAX:
+            raise ValueError("'time' `%s` is out of range." % time)
+
+    return metric, value, time
+
+
+def _isfinite(value):
+    """
+    Like :func:`math.isfinite`, but ints too large for a float aren't finite.
+    """
+    try:
+        return math.isfinite(value)
+    except OverflowError:
+        return False
+
+
+# The range of POSIX timestamps accepted by `parse_timestamp`: the same
+# years as `datetime`, 1 to 9999.
+TIMESTAMP_MIN = calendar.timegm(datetime.min.timetuple())
+TIMESTAMP_MAX = calendar.timegm(datetime.max.timetuple())
+
+
+def parse_timestamp(value):
+    """
+    Parse a timestamp given as a query parameter.
+
+    Parameters
+    ----------
+    value : str or None
+        Either a POSIX timestamp (``"1546532070"``) or an ISO 8601 UTC
+        date or datetime (``"2019-01-03"``, ``"2019-01-03T16:14:30Z"``).
+
+    Returns
+    -------
+    float or None
+        The POSIX timestamp. ``None`` if ``value`` is ``None``.
+
+    Raises
+    ------
+    ValueError
+        ``value`` is not a recognized timestamp format, or is outside of
+        :data:`TIMESTAMP_MIN` and :data:`TIMESTAMP_MAX`.
+    """
+    if value is None:
+        return None
+
+    try:
+        timestamp = float(value)
+    except ValueError:
+        pass
+    else:
+        # Also rejects NaN.
+        if not TIMESTAMP_MIN <= timestamp <= TIMESTAMP_MAX:
+            raise ValueError("Timestamp `%s` is out of range." % value)
+        return timestamp
+
+    formats = ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d")
+    for fmt in formats:
+        try:
+            dt = datetime.strptime(value.rstrip("Z"), fmt)
+        except ValueError:
+            continue
+        return float(calendar.timegm(dt.timetuple()))
+
+    raise ValueError("Unable to parse timestamp `%s`." % value)
+
+
+# Seconds per unit accepted by `parse_duration`.
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+# The longest duration accepted by `parse_duration`: the whole range of
+# timestamps accepted by `parse_timestamp`.
+DURATION_MAX = TIMESTAMP_MAX - TIMESTAMP_MIN
+
+
+def parse_duration(value):
+    """
+    Parse a duration given as a query parameter.
+
+    Parameters
+    ----------
+    value : str or None
+        A whole number of seconds (``"90"``) or of one of the
+        :data:`DURATION_UNITS` (``"15m"``, ``"1h"``, ``"7d"``).
+
+    Returns
+    -------
+    int or None
+        The duration in seconds. ``None`` if ``value`` is ``None``.
+
+    Raises
+    ------
+    ValueError
+        ``value`` is not a positive duration, or is longer than
+        :data:`DURATION_MAX`.
+    """
+    if value is None:
+        return None
+
+    number, unit = value, "s"
+    if value[-1:] in DURATION_UNITS:
+        number, unit = value[:-1], value[-1]
+    try:
+        seconds = int(number) * DURATION_UNITS[unit]
+    except ValueError:
+        raise ValueError("Unable to parse duration `%s`." % value)
+    if seconds < 1:
+        raise ValueError("Duration `%s` must be positive." % value)
+    if seconds > DURATION_MAX:
+        raise ValueError("Duration `%s` is too long." % value)
+    return seconds
+
+
+# The aggregates that `db.aggregate` calculates in SQL. Any other aggregate
+# is a percentile, see `parse_percentile`.
+SQL_AGGREGATES = ("count", "sum", "mean", "min", "max", "std")
+
+
+def parse_percentile(name):
+    """
+    Parse the name of a percentile aggregate.
+
+    Parameters
+    ----------
+    name : str
+        ``"median"``, or ``"p"`` followed by a percentile such as ``"p95"``
+        or ``"p99.9"``.
+
+    Returns
+    -------
+    float
+        The percentile, from 0 to 100.
+
+    Raises
+    ------
+    ValueError
+        ``name`` is not a percentile, or is out of range.
+    """
+    if name == "median":
+        return 50.0
+    try:
+        if not name.startswith("p"):
+            raise ValueError
+        q = float(name[1:])
+    except ValueError:
+        raise ValueError("Unknown aggregate `%s`." % name)
+    # Also rejects NaN.
+    if not 0 <= q <= 100:
+        raise ValueError("Percentile `%s` must be between 0 and 100." % name)
+    return q
+
+
+def parse_aggregates(value):
+    """
+    Parse a comma-separated list of aggregates given as a query parameter.
+
+    Parameters
+    ----------
+    value : str
+        Such as ``"mean,max,p95"``. See :data:`SQL_AGGREGATES` and
+        :func:`parse_percentile`.
+
+    Returns
+    -------
+    list of str
+        The aggregate names in the given order, without duplicates.
+
+    Raises
+    ------
+    ValueError
+        An aggregate is not recognized.
+    """
+    names = value.split(",")
+    names = sorted(set(names), key=names.index)
+    for name in names:
+        if name not in SQL_AGGREGATES:
+            parse_percentile(name)
+    return names
 
 
 def parse_socket_data(data):
@@ -215,6 +966,11 @@ def parse_socket_data(data):
     -------
     dict
         A dict suitable for sending via :module:`requests` as JSON.
+
+    Raises
+    ------
+    ValueError
+        ``data`` can't be parsed, or fails :func:`validate_data_point`.
     """
     try:
         data = data.decode("utf-8")
@@ -226,29 +982,37 @@ def parse_socket_data(data):
     try:
         metric, value = s[0], float(s[1])
     except Exception:
-        raise ValueError("Failed to parse `%s` % data")
+        raise ValueError("Failed to parse `%s`" % data)
 
     try:
         time = int(s[2])
     except IndexError:
         time = int(datetime.now(timezone.utc).timestamp())
 
+    validate_data_point(metric, value, time)
     d = {"metric": metric, "value": value, "time": time}
 
     return d
 
 
-def backup_file(path, ts_format="%Y%m%d_%H%M%S"):
+def backup_sqlite(path, ts_format="%Y%m%d_%H%M%S", pages=1024):
     """
-    Backup a file by copying it and appending a timestamp to the name.
+    Backup an SQLite database, appending a timestamp to the name.
+
+    This uses SQLite's online backup API rather than copying the file, so
+    the backup is consistent even if the database is in use or has
+    changes that are still in its write-ahead log.
 
     Parameters
     ----------
     path : :class:`pathlib.Path`
-        The file to back up.
+        The database file to back up.
     ts_format : str, optional
         The format of the timestamp to append to the name. Defaults to
         ``"%Y%m%d_%H%M%S"``: ``20190301_164832``
+    pages : int, optional
+        The number of pages to copy at a time. Other connections can use
+        the database between each step.
 
     Returns
     -------
@@ -257,5 +1021,37 @@ def backup_file(path, ts_format="%Y%m%d_%H%M%S"):
     """
     backup_file = "{}.{}".format(path, datetime.now().strftime(ts_format))
     backup_file = Path(backup_file)
-    shutil.copy(str(path), str(backup_file))
+    copy_sqlite(path, backup_file, pages=pages)
     return backup_file
+
+
+def copy_sqlite(src, dst, pages=1024):
+    """
+    Copy the contents of one SQLite database into another.
+
+    Parameters
+    ----------
+    src, dst : :class:`pathlib.Path`
+        The database files. ``dst`` is created if needed and replaced
+        otherwise.
+    pages : int, optional
+        The number of pages to copy at a time.
+    """
+    src_conn = sqlite3.connect(str(src))
+    dst_conn = sqlite3.connect(str(dst))
+    try:
+        if hasattr(src_conn, "backup"):
+            src_conn.backup(dst_conn, pages=pages)
+            return
+        # Python 3.6 doesn't expose the backup API. Move everything from
+        # the write-ahead log into the main file, then copy that.
+        src_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        dst_conn.close()
+        for suffix in ("-wal", "-shm"):
+            stale = Path(str(dst) + suffix)
+            if stale.exists():
+                stale.unlink()
+        shutil.copy(str(src), str(dst))
+    finally:
+        src_conn.close()
+        dst_conn.close()
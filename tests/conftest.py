@@ -14,6 +14,7 @@ from trendlines import db
 from trendlines import logger
 from trendlines.app_factory import create_app
 from trendlines.orm import create_db
+from trendlines.orm import db as orm_db
 from trendlines.orm import DataPoint
 from trendlines.orm import Metric
 
@@ -95,6 +96,17 @@ def raw_metric(populated_db):
     return db.Metric.get(db.Metric.name == 'foo')
 
 
+@pytest.fixture
+def query_counter(app):
+    """
+    Count the SQL statements executed through ``orm.db``.
+
+    Use the ``call_count`` attribute of the yielded mock.
+    """
+    with patch.object(orm_db, 'execute_sql', wraps=orm_db.execute_sql) as m:
+        yield m
+
+
 @pytest.fixture
 def client(app):
     """
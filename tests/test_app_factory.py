@@ -9,6 +9,7 @@ import flask
 import pytest
 
 from trendlines import app_factory
+from trendlines import orm
 
 
 @pytest.fixture(autouse=True)
@@ -64,3 +65,111 @@ def test_create_app_user_config_general_exception(caplog):
     assert isinstance(rv, flask.app.Flask)
     assert "An unknown error occured while reading from the" in caplog.text
     assert "foobar" in caplog.text
+
+
+@pytest.mark.parametrize("enabled, durability, expected", [
+    (None, "fast", False),
+    (None, "balanced", True),
+    (None, "durable", False),
+    (True, "durable", True),
+    (False, "balanced", False),
+])
+def test_setup_write_buffer_default(enabled, durability, expected):
+    app = flask.Flask(__name__)
+    app.config.from_object('trendlines.default_config')
+    app.config['WRITE_BUFFER_ENABLED'] = enabled
+    app.config['DB_DURABILITY'] = durability
+    app_factory.setup_write_buffer(app)
+    try:
+        assert (app_factory.db.write_buffer is not None) == expected
+    finally:
+        app.config['WRITE_BUFFER_ENABLED'] = False
+        app_factory.setup_write_buffer(app)
+
+
+def test_get_db_pragmas():
+    config = {"DB_DURABILITY": "balanced", "DB_CACHE_SIZE": 10,
+              "DB_PRAGMAS": {"mmap_size": 1}}
+    rv = app_factory.get_db_pragmas(config)
+    assert rv['synchronous'] == 1
+    assert rv['cache_size'] == -10
+    assert rv['mmap_size'] == 1
+
+
+def test_setup_write_buffer():
+    app = flask.Flask(__name__)
+    app.config['WRITE_BUFFER_ENABLED'] = True
+    app.config['WRITE_BUFFER_MAX_ROWS'] = 10
+    app.config['WRITE_BUFFER_MAX_LATENCY_MS'] = 50
+    app.config['WRITE_BUFFER_MAX_PENDING'] = 100
+    app_factory.setup_write_buffer(app)
+    buffer = app_factory.db.write_buffer
+    try:
+        assert buffer.max_rows == 10
+        assert buffer.max_latency == 0.05
+        assert buffer.max_pending == 100
+    finally:
+        app.config['WRITE_BUFFER_ENABLED'] = False
+        app_factory.setup_write_buffer(app)
+    assert app_factory.db.write_buffer is None
+    # The old buffer was closed.
+    with pytest.raises(RuntimeError):
+        buffer.add("foo", 1)
+
+
+# When pooled, the read-only connection opened by the first request is reused.
+@pytest.mark.parametrize("pooled, expected", [(True, 1), (False, 3)])
+def test_db_pool_reuses_connections_between_requests(app, client, pooled,
+                                                     expected):
+    orm.db.set_pooled(pooled)
+    # Pragmas are set whenever a new connection is opened.
+    with patch.object(orm.db, "_set_pragmas") as set_pragmas:
+        for _ in range(3):
+            client.get("/api/v1/metric")
+    assert set_pragmas.call_count == expected
+
+
+@pytest.mark.parametrize("method, enabled, expected", [
+    ("get", True, True),
+    ("head", True, True),
+    ("post", True, False),
+    ("get", False, False),
+])
+def test_db_read_only_get(app, client, method, enabled, expected):
+    app.config['DB_READ_ONLY_GET'] = enabled
+    with patch.object(orm.db, "connect", wraps=orm.db.connect) as connect:
+        getattr(client, method)("/api/v1/metric", json={})
+    connect.assert_called_with(read_only=expected)
+
+
+def test_backfill_rollups(app, populated_db):
+    expected = sorted(orm.Rollup.select().tuples())
+    orm.Rollup.delete().execute()
+
+    rv = app.test_cli_runner().invoke(args=["backfill-rollups"])
+    assert rv.exit_code == 0
+    assert "Rolled up 10 data points of 6 metrics." in rv.output
+    orm.db.connect(reuse_if_open=True)
+    assert sorted(orm.Rollup.select().tuples()) == expected
+
+
+def test_backfill_rollups_metric(app, populated_db):
+    orm.Rollup.delete().execute()
+    runner = app.test_cli_runner()
+    rv = runner.invoke(args=["backfill-rollups", "--metric", "foo",
+                             "--metric", "foo.bar"])
+    assert rv.exit_code == 0
+    assert "Rolled up 6 data points of 2 metrics." in rv.output
+
+    rv = runner.invoke(args=["backfill-rollups", "--metric", "missing"])
+    assert rv.exit_code != 0
+    assert "Metric 'missing' does not exist." in rv.output
+
+
+def test_apply_retention(app, populated_db):
+    app.config['RETENTION_POINTS'] = 5
+    app.config['RETENTION_DAYS'] = 1
+    rv = app.test_cli_runner().invoke(args=["apply-retention"])
+    assert rv.exit_code == 0
+    # Only "old_data" is more than a day old.
+    assert "Deleted 4 data points." in rv.output
@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
 """
 """
+import threading
+import time
 from copy import deepcopy
 from datetime import datetime
 from datetime import timezone
+from unittest.mock import MagicMock
+from unittest.mock import patch
 
+import numpy as np
 import pytest
 from freezegun import freeze_time
 from peewee import DoesNotExist
 from peewee import IntegrityError
+from peewee import OperationalError
 
 from trendlines import db
 from trendlines import orm
@@ -66,6 +72,30 @@ def test_add_metric_raises_type_error(caplog, lower, upper):
     assert "Invalid type for limits" in caplog.text
 
 
+@pytest.mark.parametrize("days, points, error", [
+    ("abc", None, TypeError),
+    (True, None, TypeError),
+    (None, 1.5, TypeError),
+    (None, "10", TypeError),
+    (0, None, ValueError),
+    (-1.5, None, ValueError),
+    (float("inf"), None, ValueError),
+    (float("nan"), None, ValueError),
+    (None, 0, ValueError),
+    (None, -1, ValueError),
+])
+def test_add_metric_invalid_retention(app, days, points, error):
+    with pytest.raises(error):
+        db.add_metric("foo", retention_days=days, retention_points=points)
+    assert db.Metric.select().count() == 0
+
+
+def test_check_retention(app):
+    db.check_retention()
+    db.check_retention(0.5, 1)
+    db.check_retention(30, None)
+
+
 def test_insert_datapoint(populated_db):
     rv = db.insert_datapoint("empty_metric", 15)
     assert rv.metric.metric_id == 1
@@ -89,6 +119,158 @@ def test_insert_datapoint_with_timestamp(populated_db):
     assert new[0].timestamp == expected
 
 
+def test_get_metric_id(populated_db):
+    db.invalidate_metric_cache()
+    assert db.get_metric_id("foo.bar") == 3
+    assert db.metric_id_cache.get("foo.bar") == 3
+
+    with pytest.raises(DoesNotExist):
+        db.get_metric_id("missing")
+    assert "missing" not in db.metric_id_cache
+
+
+def test_get_metric_id_uses_cache(populated_db):
+    db.invalidate_metric_cache()
+    db.get_metric_id("foo")
+    with patch.object(orm.Metric, "select", MagicMock(side_effect=AssertionError)):
+        assert db.get_metric_id("foo") == 2
+        db.insert_datapoint("foo", 5)
+
+
+def test_get_metric_id_create(populated_db, caplog):
+    rv = db.get_metric_id("new.metric", create=True)
+    assert rv == 7
+    assert "Metric 'new.metric' created." in caplog.text
+    # Existing metrics with units or limits are found rather than recreated.
+    assert db.get_metric_id("with_everything", create=True) == 6
+
+
+def test_metric_id_cache_ttl_sees_renames(populated_db, monkeypatch):
+    # Like the socket listeners, which can't see the web app's renames.
+    monkeypatch.setattr(db.metric_id_cache, "ttl", 10)
+    db.invalidate_metric_cache()
+    with patch("time.monotonic", return_value=100):
+        assert db.get_metric_id("foo") == 2
+    orm.Metric.update(name="renamed").where(orm.Metric.name == "foo").execute()
+    with patch("time.monotonic", return_value=105):
+        assert db.get_metric_id("foo") == 2
+    with patch("time.monotonic", return_value=110):
+        assert db.get_metric_id("foo", create=True) == 7
+
+
+def test_metric_id_cache_ttl_default(app):
+    assert db.metric_id_cache.ttl == app.config['METRIC_ID_CACHE_TTL'] == 10
+
+
+def test_insert_datapoint_deleted_metric(populated_db):
+    db.get_metric_id("foo")
+    # Deleted and recreated by someone that doesn't share our cache.
+    orm.Metric.delete().where(orm.Metric.name == "foo").execute()
+    db.add_metric("foo")
+    db.metric_id_cache.set("foo", 2)
+    db.insert_datapoint("foo", 1, 1546532100)
+    assert [d.value for d in db.get_data("foo")] == [1]
+    assert db.metric_id_cache.get("foo") == 7
+
+
+def test_invalidate_metric_cache(populated_db):
+    db.get_metric_id("foo")
+    db.get_metric_id("foo.bar")
+    db.invalidate_metric_cache("foo")
+    assert "foo" not in db.metric_id_cache
+    assert "foo.bar" in db.metric_id_cache
+    db.invalidate_metric_cache()
+    assert len(db.metric_id_cache) == 0
+
+
+def test_get_metric_tree_children(populated_db, query_counter):
+    rv = db.get_metric_tree_children("foo")
+    assert [n['id'] for n in rv] == ["foo.bar"]
+    query_counter.reset_mock()
+    assert len(db.get_metric_tree_children()) == 5
+    assert query_counter.call_count == 0
+    with pytest.raises(KeyError):
+        db.get_metric_tree_children("missing")
+
+
+@pytest.mark.parametrize("change", [
+    lambda: db.add_metric("new.metric"),
+    lambda: db.insert_datapoints([("new.metric", 1, None)]),
+    lambda: db.invalidate_metric_cache("foo"),
+])
+def test_get_metric_tree_children_invalidated(populated_db, change):
+    before = db.get_metric_tree_children()
+    change()
+    assert db.get_metric_tree_children() is not before
+
+
+def test_get_metric_tree_children_not_invalidated_by_data(populated_db):
+    before = db.get_metric_tree_children()
+    db.insert_datapoint("foo", 1)
+    db.insert_datapoints([("foo", 2, None)])
+    db.add_metric("foo")
+    assert db.get_metric_tree_children() is before
+
+
+def test_insert_datapoints(populated_db):
+    points = [
+        ("foo", 1, 1546532070),
+        ("foo.bar", 2, None),
+        ("foo", 3, 1546532071),
+    ]
+    rv = db.insert_datapoints(points)
+    assert rv == 3
+    assert len(db.get_data("foo")) == 6
+    assert len(db.get_data("foo.bar")) == 3
+    assert [d.value for d in db.get_data("foo")][:2] == [1, 3]
+
+
+def test_insert_datapoints_creates_missing_metrics(populated_db, caplog):
+    points = [("new.metric", i, None) for i in range(250)]
+    points.append(("other", 5, None))
+    rv = db.insert_datapoints(points)
+    assert rv == 251
+    assert len(db.get_data("new.metric")) == 250
+    assert len(db.get_data("other")) == 1
+    assert len(db.Metric.select()) == 8
+    assert caplog.text.count("Metric 'new.metric' created.") == 1
+
+
+def test_insert_datapoints_skip_invalid(populated_db, caplog):
+    points = [
+        ("foo", 1, 1546532070),
+        ("foo", float("nan"), None),
+        ("foo", 2, 1e300),
+        ("foo", 3, 1546532071),
+    ]
+    with pytest.raises(Exception):
+        db.insert_datapoints(points)
+    assert db.insert_datapoints(points, skip_invalid=True) == 2
+    assert [d.value for d in db.get_data("foo")][:2] == [1, 3]
+    assert caplog.text.count("Dropped data point") == 2
+
+
+def test_insert_datapoints_skip_invalid_bisects(populated_db, caplog):
+    insert = db._insert_datapoints
+
+    def fail_on_bad(points, now):
+        if any(p[1] == 13 for p in points):
+            raise ValueError("unlucky")
+        return insert(points, now)
+
+    points = [("foo", value, None) for value in range(10, 20)]
+    with patch("trendlines.db._insert_datapoints", side_effect=fail_on_bad):
+        assert db.insert_datapoints(points, skip_invalid=True) == 9
+    values = [d.value for d in db.get_data("foo")]
+    assert sorted(values[4:]) == [10, 11, 12, 14, 15, 16, 17, 18, 19]
+    assert "Dropped data point ('foo', 13, None): unlucky" in caplog.text
+
+
+def test_insert_datapoints_no_data(populated_db):
+    assert db.insert_datapoints([]) == 0
+    assert len(db.get_datapoints()) == 10
+
+
 def test_get_data(populated_db):
     rv = db.get_data("empty_metric")
     assert len(rv) == 0
@@ -99,6 +281,46 @@ def test_get_data(populated_db):
     assert rv[3].value == 9
 
 
+@pytest.mark.parametrize("start, end, expected", [
+    (None, None, [0, 1, 5, 8]),
+    (1545321236, None, [1, 5, 8]),
+    (None, 1546532003, [0, 1]),
+    (1545321236, 1546532067, [1, 5]),
+])
+def test_get_data_time_window(populated_db, start, end, expected):
+    rv = db.get_data("old_data", start, end)
+    assert [d.value for d in rv] == expected
+
+
+def test_get_data_time_window_with_datetime(populated_db):
+    start = datetime(2018, 12, 20, 15, 53, 56)
+    rv = db.get_data("old_data", start=start)
+    assert [d.value for d in rv] == [1, 5, 8]
+
+
+def test_get_data_is_ordered_by_timestamp(populated_db):
+    db.insert_datapoint("old_data", 3, 1546000000)
+    rv = db.get_data("old_data")
+    assert [d.value for d in rv] == [0, 1, 3, 5, 8]
+
+
+def test_get_data_limit_and_order(populated_db):
+    rv = db.get_data("old_data", limit=2)
+    assert [d.value for d in rv] == [0, 1]
+    rv = db.get_data("old_data", descending=True)
+    assert [d.value for d in rv] == [8, 5, 1, 0]
+    rv = db.get_data("old_data", end=1546532067, limit=2, descending=True)
+    assert [d.value for d in rv] == [5, 1]
+
+
+def test_get_data_uses_covering_index(populated_db):
+    query = db.get_data("old_data", 0, 1546532003)
+    sql, params = query.sql()
+    plan = orm.db.execute_sql("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    plan = " ".join(str(row[-1]) for row in plan)
+    assert "COVERING INDEX datapoint_metric_id_timestamp_value" in plan
+
+
 @freeze_time("2019-01-03T16:14:30Z")        # 1546532070
 def test_get_recent_data(populated_db):
     """
@@ -135,6 +357,15 @@ def test_get_metrics(populated_db):
     assert rv[3].units == "apples"
 
 
+def test_get_metrics_paginated(populated_db):
+    rv = db.get_metrics(limit=2)
+    assert [m.metric_id for m in rv] == [1, 2]
+    rv = db.get_metrics(after=2, limit=2)
+    assert [m.metric_id for m in rv] == [3, 4]
+    rv = db.get_metrics(before=4, limit=2)
+    assert [m.metric_id for m in rv] == [3, 2]
+
+
 def test_get_units(populated_db):
     rv = db.get_units("metric_with_units")
     assert rv == "apples"
@@ -151,6 +382,19 @@ def test_get_datapoints(populated_db):
     assert rv[-1].value == 8
 
 
+def test_get_datapoints_loads_metrics(populated_db, query_counter):
+    rv = list(db.get_datapoints())
+    assert [d.metric.name for d in rv[:5]] == ["foo"] * 4 + ["foo.bar"]
+    assert query_counter.call_count == 1
+
+
+def test_get_datapoints_paginated(populated_db):
+    rv = db.get_datapoints(after=8)
+    assert [d.datapoint_id for d in rv] == [9, 10]
+    rv = db.get_datapoints(after=2, before=6)
+    assert [d.datapoint_id for d in rv] == [5, 4, 3]
+
+
 def test_get_datapoints_no_data(app):
     rv = db.get_datapoints()
     assert len(rv) == 0
@@ -299,3 +543,655 @@ def test_delete_datpoint_does_not_exist(populated_db):
     missing = orm.DataPoint(value=50)
     with pytest.raises(DoesNotExist):
         db.delete_datapoint(missing)
+
+
+@pytest.fixture
+def write_buffer(populated_db):
+    buffer = db.WriteBuffer(max_rows=3, max_latency=60)
+    yield buffer
+    buffer.close()
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_write_buffer_flushes_on_size(write_buffer):
+    write_buffer.add("foo", 100, 1546532100)
+    write_buffer.add("foo", 101, 1546532101)
+    assert len(db.get_data("foo")) == 4
+    write_buffer.add("new", 102, 1546532102)
+    _wait_for(lambda: len(write_buffer) == 0)
+    _wait_for(lambda: len(db.get_data("foo")) == 6)
+    assert [d.value for d in db.get_data("new")] == [102]
+
+
+def test_write_buffer_flushes_on_latency(populated_db):
+    buffer = db.WriteBuffer(max_rows=1000, max_latency=0.05)
+    try:
+        buffer.add("foo", 100, 1546532100)
+        _wait_for(lambda: len(db.get_data("foo")) == 5)
+    finally:
+        buffer.close()
+
+
+def test_write_buffer_close_flushes(write_buffer):
+    write_buffer.add("foo", 100)
+    write_buffer.close()
+    assert len(db.get_data("foo")) == 5
+    with pytest.raises(RuntimeError):
+        write_buffer.add("foo", 101)
+    # Closing again is fine.
+    write_buffer.close()
+
+
+@freeze_time("2019-01-03T16:15:00Z")
+def test_write_buffer_uses_time_of_arrival(write_buffer):
+    write_buffer.add("new", 1)
+    with freeze_time("2019-01-03T17:00:00Z"):
+        write_buffer.flush()
+    assert db.get_data("new")[0].timestamp == datetime(2019, 1, 3, 16, 15)
+
+
+def test_write_buffer_write_error(write_buffer, caplog):
+    write_buffer.add("foo", 1)
+    with patch.object(db, "insert_datapoints",
+                      side_effect=OperationalError("database is locked")):
+        write_buffer.flush()
+    assert "Failed to write 1 buffered data points" in caplog.text
+    # The buffer still works.
+    write_buffer.add("foo", 1)
+    write_buffer.flush()
+    assert len(db.get_data("foo")) == 5
+
+
+@pytest.mark.parametrize("value, timestamp", [
+    (None, None),
+    (float("nan"), None),
+    (float("inf"), None),
+    (1, float("nan")),
+    (1, 1e300),
+])
+def test_write_buffer_add_rejects_invalid_points(write_buffer, value,
+                                                 timestamp):
+    with pytest.raises(ValueError):
+        write_buffer.add("foo", value, timestamp)
+    assert len(write_buffer) == 0
+
+
+def test_write_buffer_write_drops_only_bad_points(write_buffer, caplog):
+    insert = db._insert_datapoints
+
+    def fail_on_bad(points, now):
+        if any(p[1] == 101 for p in points):
+            raise IntegrityError("NOT NULL constraint failed")
+        return insert(points, now)
+
+    with patch.object(db, "_insert_datapoints", side_effect=fail_on_bad):
+        with write_buffer._write_lock:      # Hold off the writer thread
+            for n in range(3):
+                write_buffer.add("foo", 100 + n, 1546532100 + n)
+        write_buffer.flush()
+    values = [d.value for d in db.get_data("foo")]
+    assert len(values) == 6
+    assert 100 in values and 102 in values
+    assert "Dropped data point ('foo', 101, 1546532101)" in caplog.text
+
+
+def test_write_buffer_batches_are_at_most_max_rows(write_buffer):
+    with patch.object(db, "insert_datapoints",
+                      wraps=db.insert_datapoints) as insert:
+        with write_buffer._write_lock:      # Hold off the writer thread
+            for n in range(7):
+                write_buffer.add("foo", n, 1546532100 + n)
+        write_buffer.flush()
+        _wait_for(lambda: len(write_buffer) == 0)
+    batches = [c[0][0] for c in insert.call_args_list
+               if c[1].get('skip_invalid')]
+    assert [len(b) for b in batches] == [3, 3, 1]
+    assert len(db.get_data("foo")) == 11
+
+
+def test_write_buffer_add_blocks_when_full(populated_db):
+    buffer = db.WriteBuffer(max_rows=2, max_latency=60, max_pending=4)
+    try:
+        with buffer._write_lock:
+            for n in range(4):
+                buffer.add("foo", n, 1546532100 + n)
+            adder = threading.Thread(target=buffer.add,
+                                     args=("foo", 4, 1546532104))
+            adder.start()
+            adder.join(0.1)
+            assert adder.is_alive()
+            assert len(buffer) == 4
+        # The writer thread makes room.
+        adder.join(5)
+        assert not adder.is_alive()
+    finally:
+        buffer.close()
+    assert len(db.get_data("foo")) == 9
+
+
+def _rollups(metric_id=None):
+    """
+    Return every rollup row as a sorted list of tuples.
+    """
+    query = orm.Rollup.select()
+    if metric_id is not None:
+        query = query.where(orm.Rollup.metric == metric_id)
+    return sorted(query.tuples())
+
+
+def test_rollups_updated_on_insert(app):
+    db.add_metric("foo")
+    db.insert_datapoint("foo", 5, 1546532003)            # 2019-01-03 16:13:23
+    db.insert_datapoints([("foo", 1, 1546532010),
+                          ("foo", 9, 1546532003),        # same second
+                          ("foo", 2, 1546531999)])       # earlier
+    db.insert_datapoint("foo", 3, 1546532039)
+
+    minute = orm.Rollup.get(orm.Rollup.resolution == 60,
+                            orm.Rollup.bucket == 1546531980)
+    assert minute.count == 5
+    assert minute.total == 20
+    assert minute.mean == 4
+    assert (minute.minimum, minute.maximum) == (1, 9)
+    assert (minute.first, minute.first_timestamp) == (2, 1546531999)
+    assert (minute.last, minute.last_timestamp) == (3, 1546532039)
+    assert minute.timestamp == datetime(2019, 1, 3, 16, 13)
+
+    # Every point is in the same hour and day.
+    for resolution in (3600, 86400):
+        rollup = orm.Rollup.get(orm.Rollup.resolution == resolution)
+        assert rollup.count == 5
+        assert rollup.bucket == 1546532003 - 1546532003 % resolution
+
+
+def test_summaries_merged_without_upsert(app, query_counter):
+    # UPSERT needs SQLite 3.24, which older distributions don't have.
+    db.add_metric("foo")
+    db.insert_datapoint("foo", 5, 1546532003)
+    db.insert_datapoints([("foo", 1, 1546532010), ("foo", 2, 1546535603)])
+    statements = [c[0][0] for c in query_counter.call_args_list]
+    assert not any("ON CONFLICT" in sql for sql in statements)
+    assert [r.count for r in orm.Rollup.select().order_by(
+        orm.Rollup.resolution, orm.Rollup.bucket)] == [2, 1, 2, 1, 3]
+    stats = db.get_metric_stats("foo")
+    assert (stats.count, stats.last_value, stats.maximum) == (3, 2, 5)
+
+
+def test_rollups_first_and_last_ties(app):
+    db.insert_datapoints([("foo", 1, 1546532003), ("foo", 2, 1546532003)])
+    db.insert_datapoint("foo", 3, 1546532003)
+    minute = orm.Rollup.get(orm.Rollup.resolution == 60)
+    # Same order as `get_data`: by timestamp, then by insertion.
+    assert minute.first == 1
+    assert minute.last == 3
+
+
+def test_rollups_match_rebuild(populated_db):
+    points = [("foo", (n * 7) % 13, 1546532003 + n * 937) for n in range(500)]
+    db.insert_datapoints(points[:250])
+    for point in points[250:260]:
+        db.insert_datapoint(*point)
+    db.insert_datapoints(points[260:])
+
+    incremental = _rollups()
+    assert db.rebuild_rollups() == 510
+    assert _rollups() == incremental
+
+
+def test_rebuild_rollups_window(populated_db):
+    before = _rollups()
+    orm.Rollup.delete().execute()
+    # Only the day holding 2019-01-03T16:13:23Z, but the whole day.
+    count = db.rebuild_rollups(start=1546532003, end=1546532004)
+    assert count == 2
+    assert _rollups() == [r for r in before
+                          if 1546473600 <= r[2] < 1546560000]
+
+
+def test_rollups_updated_on_update(populated_db):
+    datapoint = db.get_data("old_data")[1]           # 1545321236
+    db.update_datapoint(datapoint, value=100, timestamp=1546532100)
+    expected = _rollups()
+    db.rebuild_rollups()
+    assert _rollups() == expected
+    day = orm.Rollup.get(orm.Rollup.resolution == 86400,
+                         orm.Rollup.bucket == 1546473600)
+    assert day.count == 3
+    assert day.maximum == 100
+
+
+def test_rollups_updated_on_update_metric(populated_db):
+    datapoint = db.get_data("foo")[0]
+    db.update_datapoint(datapoint, metric=db.get_metric_id("foo.bar"))
+    expected = _rollups()
+    db.rebuild_rollups()
+    assert _rollups() == expected
+
+
+def test_rollups_updated_on_delete(populated_db):
+    metric_id = db.get_metric_id("old_data")
+    db.delete_datapoint(db.get_data("old_data")[1])      # 2018-12-20
+    # Gone, since it was the only point that day.
+    day = orm.Rollup.get_or_none(orm.Rollup.metric == metric_id,
+                                 orm.Rollup.resolution == 86400,
+                                 orm.Rollup.bucket == 1545264000)
+    assert day is None
+    expected = _rollups()
+    db.rebuild_rollups()
+    assert _rollups() == expected
+
+
+def test_rollups_deleted_with_metric(populated_db):
+    orm.Metric.delete().where(orm.Metric.name == "foo").execute()
+    assert _rollups(1) == []
+    assert len(_rollups()) > 0
+
+
+@pytest.mark.parametrize("max_points, expected", [
+    (1000, None),       # All 720 points fit
+    (500, None),        # 120 minutes isn't enough
+    (100, 60),
+    (2, 3600),
+])
+def test_choose_resolution(app, max_points, expected):
+    # Every 10 seconds for 2 hours.
+    db.insert_datapoints(("foo", 1, 1546300800 + n * 10) for n in range(720))
+    assert db.choose_resolution("foo", max_points=max_points) == expected
+
+
+def test_choose_resolution_window(app):
+    db.insert_datapoints(("foo", 1, 1546300800 + n * 10) for n in range(720))
+    assert db.choose_resolution("foo", 1546300800, 1546304400, 30) == 60
+    # No data in the window.
+    assert db.choose_resolution("foo", 1600000000, None, 30) is None
+
+
+def test_choose_resolution_without_rollups(app):
+    db.insert_datapoints(("foo", 1, 1546300800 + n * 10) for n in range(720))
+    orm.Rollup.delete().execute()
+    assert db.choose_resolution("foo", max_points=100) is None
+
+
+def test_choose_resolution_partial_rollups(app):
+    # Like a database upgraded without running `flask backfill-rollups`.
+    db.insert_datapoints(("foo", 1, 1546300800 + n * 10) for n in range(720))
+    orm.Rollup.delete().where(orm.Rollup.bucket < 1546304400).execute()
+    assert db.choose_resolution("foo", max_points=100) is None
+    db.rebuild_rollups()
+    assert db.choose_resolution("foo", max_points=100) == 60
+
+
+def test_get_rollups(populated_db):
+    rollups = db.get_rollups("old_data", 86400)
+    assert [r.bucket for r in rollups] == [0, 1545264000, 1546473600]
+    assert [r.count for r in rollups] == [1, 1, 2]
+
+    # Whole buckets: the one holding `start` is included.
+    rollups = db.get_rollups("old_data", 86400, start=1546532003,
+                             descending=True)
+    assert [r.bucket for r in rollups] == [1546473600]
+    rollups = db.get_rollups("old_data", 86400, end=1546473600)
+    assert [r.bucket for r in rollups] == [0, 1545264000]
+
+
+def test_delete_metric(populated_db):
+    metric_id = db.get_metric_id("foo")
+    assert db.delete_metric(metric_id, chunk_size=3) == 4
+    with pytest.raises(DoesNotExist):
+        orm.Metric.get_by_id(metric_id)
+    data = orm.DataPoint.select().where(orm.DataPoint.metric == metric_id)
+    assert data.count() == 0
+    assert _rollups(metric_id) == []
+    # Other metrics are untouched.
+    assert len(db.get_data("foo.bar")) == 2
+
+
+def test_delete_metric_invalidates_cache(populated_db):
+    db.get_metric_id("foo")
+    db.delete_metric(orm.Metric.get(orm.Metric.name == "foo"))
+    assert "foo" not in db.metric_id_cache
+
+
+def test_delete_metric_does_not_exist(populated_db):
+    with pytest.raises(DoesNotExist):
+        db.delete_metric(99)
+
+
+def test_delete_metric_in_chunks(populated_db, query_counter):
+    db.insert_datapoints(("foo", n, 1546300800 + n * 600) for n in range(25))
+    metric_id = db.get_metric_id("foo")
+    query_counter.reset_mock()
+    db.delete_metric(metric_id, chunk_size=10)
+    # 29 data points, so 3 chunks of one DELETE each.
+    deletes = [c for c in query_counter.call_args_list
+               if c[0][0].startswith('DELETE FROM "datapoint"')]
+    assert len(deletes) == 3
+
+
+def test_delete_metric_does_not_pause(populated_db):
+    db.insert_datapoints(("foo", n, 1546300800 + n * 600) for n in range(25))
+    with patch("trendlines.db.time.sleep") as sleep:
+        db.delete_metric(db.get_metric_id("foo"), chunk_size=10)
+    assert sleep.call_count == 0
+
+
+def test_apply_retention_pauses_between_chunks(populated_db):
+    db.insert_datapoints(("foo", n, 1546300800 + n * 600) for n in range(25))
+    with patch("trendlines.db.time.sleep") as sleep:
+        db.apply_retention(points=1, chunk_size=10)
+    assert sleep.call_count == 2
+    sleep.assert_called_with(db._DELETE_CHUNK_PAUSE)
+
+
+@pytest.mark.parametrize("days, points, expected", [
+    (None, None, None),
+    (None, 2, 1546532003),
+    (None, 4, 0),
+    (None, 5, None),              # Fewer points than that.
+    (1, None, 1546445603),
+    (1, 2, 1546532003),           # The later of the two.
+    (30, 3, 1545321236),
+])
+def test_get_retention_cutoff(populated_db, days, points, expected):
+    metric_id = db.get_metric_id("old_data")
+    now = 1546532003
+    assert db.get_retention_cutoff(metric_id, days, points, now) == expected
+
+
+def test_apply_retention_days(populated_db):
+    db.insert_datapoint("foo.bar", 7, time.time() - 86400 * 2)
+    # Every other point is from the past few minutes, or from years ago.
+    assert db.apply_retention(days=3) == 4
+    assert [dp.value for dp in db.get_data("foo.bar")] == [7, 1, -2]
+    assert len(db.get_data("foo")) == 4
+    assert len(db.get_data("old_data")) == 0
+
+
+def test_apply_retention_points(populated_db):
+    db.insert_datapoints([("ties", 0, 1546500000), ("ties", 1, 1546532003),
+                          ("ties", 2, 1546532003), ("ties", 3, 1546532100)])
+    # "foo" was added just now: avoid depending on how many seconds that
+    # took.
+    orm.Metric.update(retention_points=10).where(
+        orm.Metric.name == "foo").execute()
+    assert db.apply_retention(points=2, chunk_size=1) == 3
+    assert [dp.value for dp in db.get_data("old_data")] == [5, 8]
+    # Ties with the oldest data point kept are kept too.
+    assert [dp.value for dp in db.get_data("ties")] == [1, 2, 3]
+    assert len(db.get_data("foo")) == 4
+
+
+def test_apply_retention_metric_policy(populated_db):
+    orm.Metric.update(retention_days=10000).where(
+        orm.Metric.name == "old_data").execute()
+    # The metric's own policy wins; other metrics use the default.
+    assert db.apply_retention(days=1) == 1
+    assert [dp.value for dp in db.get_data("old_data")] == [1, 5, 8]
+    assert len(db.get_data("foo")) == 4
+    assert len(db.get_data("foo.bar")) == 2
+
+    orm.Metric.update(retention_points=1).where(
+        orm.Metric.name == "old_data").execute()
+    assert db.apply_retention(days=1) == 2
+    assert [dp.value for dp in db.get_data("old_data")] == [8]
+
+
+def test_apply_retention_nothing_to_do(populated_db):
+    before = _rollups()
+    assert db.apply_retention() == 0
+    assert db.apply_retention(points=10) == 0
+    assert _rollups() == before
+
+
+def test_apply_retention_keeps_rollups_consistent(app):
+    # Every 10 minutes for 3 days, from 2019-01-01T00:00:00Z.
+    db.insert_datapoints(("foo", n % 7, 1546300800 + n * 600)
+                         for n in range(432))
+    now = 1546300800 + 3 * 86400
+    cutoff = now - int(1.5 * 86400)
+    with patch('trendlines.db.time.time', return_value=now):
+        assert db.apply_retention(days=1.5, chunk_size=50) == 216
+
+    assert db.get_data("foo")[0].timestamp == datetime.utcfromtimestamp(cutoff)
+    expected = _rollups()
+    db.rebuild_rollups()
+    assert _rollups() == expected
+    # The first day is gone, the second day is partly gone.
+    days = db.get_rollups("foo", 86400)
+    assert [r.bucket for r in days] == [1546387200, 1546473600]
+    assert [r.count for r in days] == [72, 144]
+
+
+def _expected_stats(metric_id):
+    """
+    Calculate the stats of a metric from its raw data.
+    """
+    query = (orm.DataPoint.select(orm.DataPoint.value,
+                                  orm.DataPoint.timestamp)
+             .where(orm.DataPoint.metric == metric_id)
+             .order_by(orm.DataPoint.timestamp, orm.DataPoint.datapoint_id))
+    # Raw timestamps: peewee reads 0 back as None.
+    data = orm.db.execute_sql(*query.sql()).fetchall()
+    if not data:
+        return None
+    values = [row[0] for row in data]
+    timestamps = [row[1] for row in data]
+    return (len(values), pytest.approx(sum(values)),
+            pytest.approx(sum(v * v for v in values)), min(values),
+            max(values), min(timestamps), max(timestamps), values[-1])
+
+
+def _stats(metric_id):
+    stats = orm.MetricStats.get_or_none(orm.MetricStats.metric == metric_id)
+    if stats is None:
+        return None
+    return (stats.count, stats.total, stats.total_squares, stats.minimum,
+            stats.maximum, stats.first_timestamp, stats.last_timestamp,
+            stats.last_value)
+
+
+def _assert_stats_match(metric_ids):
+    for metric_id in metric_ids:
+        assert _stats(metric_id) == _expected_stats(metric_id)
+
+
+def test_metric_stats_updated_on_insert(populated_db):
+    db.insert_datapoints([("foo.bar", 10, 1546532003),
+                          ("foo.bar", 3, 1546532003),
+                          ("new", 4, 1546532003)])
+    db.insert_datapoint("old_data", -1, 1546500000)
+    stats = db.get_metric_stats("old_data")
+    assert stats.count == 5
+    assert stats.first_timestamp == 0
+    assert stats.last_timestamp == 1546532067
+    assert stats.last_value == 8
+    assert (stats.minimum, stats.maximum) == (-1, 8)
+    _assert_stats_match(range(1, 8))
+
+
+def test_metric_stats_updated_on_update(populated_db):
+    data = db.get_data("old_data")
+    db.update_datapoint(data[3], value=-3)                  # The last one
+    db.update_datapoint(data[1], timestamp=1546532100)      # Now the last
+    db.update_datapoint(data[2], metric=db.get_metric_id("foo.bar"))
+    _assert_stats_match(range(1, 7))
+    assert db.get_metric_stats("old_data").last_value == 1
+
+
+def test_metric_stats_updated_on_delete(populated_db):
+    metric_id = db.get_metric_id("foo.bar")
+    db.delete_datapoint(db.get_data("foo.bar")[0])
+    _assert_stats_match([metric_id])
+    db.delete_datapoint(db.get_data("foo.bar")[0])
+    assert db.get_metric_stats(metric_id) is None
+
+
+def test_metric_stats_updated_by_retention(app):
+    db.insert_datapoints(("foo", n, 1546300800 + n * 600) for n in range(100))
+    db.insert_datapoints(("foo", -n, 1546300800 + n * 600) for n in range(5))
+    metric_id = db.get_metric_id("foo")
+    cutoff = db.get_retention_cutoff(metric_id, points=50)
+    db._delete_data_before(metric_id, cutoff, chunk_size=7)
+    _assert_stats_match([metric_id])
+    assert db.get_metric_stats(metric_id).minimum == 50
+
+
+def test_metric_stats_of_metric_without_data(populated_db):
+    assert db.get_metric_stats("empty_metric") is None
+    with pytest.raises(DoesNotExist):
+        db.get_metric_stats("missing")
+
+
+def test_metric_stats_deleted_with_metric(populated_db):
+    db.delete_metric(db.get_metric_id("foo"))
+    assert orm.MetricStats.select().count() == 2
+
+
+def test_metric_stats_mean_and_std(populated_db):
+    stats = db.get_metric_stats("foo")
+    assert stats.mean == 16.5
+    assert stats.std == pytest.approx(5.72, abs=0.01)
+
+
+def test_get_latest(populated_db):
+    rows = list(db.get_latest())
+    assert [r[0] for r in rows] == ["foo", "foo.bar", "old_data"]
+    assert rows[2] == ("old_data", None, 1546532067, 8)
+
+
+@pytest.mark.parametrize("prefix, expected", [
+    ("foo", ["foo", "foo.bar", "foo_2"]),
+    ("foo.", ["foo.bar"]),
+    ("foo_", ["foo_2"]),          # "_" isn't a wildcard
+    ("Foo", []),                  # Case sensitive
+    ("", ["foo", "foo.bar", "foo_2", "fop", "old_data"]),
+])
+def test_get_latest_prefix(populated_db, prefix, expected):
+    db.insert_datapoints([("foo_2", 1, None), ("fop", 1, None)])
+    assert [r[0] for r in db.get_latest(prefix)] == expected
+
+
+def test_get_latest_prefix_largest_characters(populated_db):
+    names = ["a\ud7ff", "a\ud7ffb", "a\ue000", "\U0010ffff", "\U0010ffffz"]
+    db.insert_datapoints([(name, 1, None) for name in names])
+    assert [r[0] for r in db.get_latest("a\ud7ff")] == names[:2]
+    assert [r[0] for r in db.get_latest("\U0010ffff")] == names[3:]
+
+
+@pytest.mark.parametrize("prefix, expected", [
+    ("ab", "ac"),
+    ("a\ud7ff", "a\ue000"),
+    ("a\U0010ffff", "b"),
+    ("\U0010ffff\U0010ffff", None),
+])
+def test_prefix_upper_bound(prefix, expected):
+    assert db._prefix_upper_bound(prefix) == expected
+
+
+@pytest.mark.parametrize("start, end, expected", [
+    (None, None, 4),
+    (1545321236, None, 3),
+    (None, 1546532003, 2),
+    (datetime(2019, 1, 1), datetime(2019, 1, 4), 2),
+])
+def test_count_data(populated_db, start, end, expected):
+    assert db.count_data("old_data", start, end) == expected
+
+
+def test_count_data_missing_metric(populated_db):
+    with pytest.raises(DoesNotExist):
+        db.count_data("missing")
+
+
+def test_aggregate(populated_db):
+    buckets, columns = db.aggregate("old_data", 86400,
+                                    ["count", "mean", "std", "p95"])
+    assert buckets == [0, 1545264000, 1546473600]
+    assert columns["count"] == [1, 1, 2]
+    assert columns["mean"] == [0, 1, 6.5]
+    assert columns["std"] == [0, 0, 1.5]
+    assert columns["p95"] == pytest.approx([0, 1, 7.85])
+
+
+def test_aggregate_time_window(populated_db):
+    buckets, columns = db.aggregate("old_data", 3600, ["max", "median"],
+                                    start=1, end=1546532067)
+    assert buckets == [1545318000, 1546531200]
+    assert columns == {"max": [1, 5], "median": [1, 5]}
+
+
+def test_aggregate_matches_numpy(app):
+    values = np.random.RandomState(42).normal(10, 3, size=1000)
+    db.insert_datapoints([("foo", v, 1546300800 + 37 * n)
+                          for n, v in enumerate(values)])
+    aggregates = ["count", "sum", "mean", "min", "max", "std", "median",
+                  "p99.9"]
+    buckets, columns = db.aggregate("foo", 3600, aggregates)
+
+    timestamps = 1546300800 + 37 * np.arange(len(values))
+    keys = timestamps - timestamps % 3600
+    assert buckets == sorted(set(keys.tolist()))
+    for n, key in enumerate(buckets):
+        group = values[keys == key]
+        assert columns["count"][n] == len(group)
+        assert columns["sum"][n] == pytest.approx(group.sum())
+        assert columns["mean"][n] == pytest.approx(group.mean())
+        assert columns["min"][n] == group.min()
+        assert columns["max"][n] == group.max()
+        assert columns["std"][n] == pytest.approx(group.std())
+        assert columns["median"][n] == np.median(group)
+        assert columns["p99.9"][n] == np.percentile(group, 99.9)
+
+
+def test_aggregate_uses_rollups(populated_db, query_counter):
+    aggregates = ["count", "sum", "mean", "min", "max"]
+    expected = db.aggregate("old_data", 7200, aggregates + ["std"])
+    query_counter.reset_mock()
+
+    buckets, columns = db.aggregate("old_data", 7200, aggregates)
+    assert buckets == expected[0]
+    assert columns == {k: expected[1][k] for k in aggregates}
+    sql = query_counter.call_args_list[-1][0][0]
+    assert 'FROM "rollup"' in sql
+
+
+@pytest.mark.parametrize("bucket, start", [
+    (90, None),                 # Not a multiple of a rollup resolution
+    (3600, 1546473601),         # Start is not aligned
+])
+def test_aggregate_unaligned_reads_data(populated_db, bucket, start):
+    metric_id = db.get_metric_id("old_data")
+    assert db._aggregate_resolution(metric_id, bucket, start) is None
+
+
+def test_aggregate_incomplete_rollups_reads_data(populated_db):
+    metric_id = db.get_metric_id("old_data")
+    assert db._aggregate_resolution(metric_id, 86400) == 86400
+    orm.Rollup.delete().where(orm.Rollup.bucket == 0).execute()
+    assert db._aggregate_resolution(metric_id, 86400) is None
+    buckets, columns = db.aggregate("old_data", 86400, ["count"])
+    assert columns["count"] == [1, 1, 2]
+
+
+@pytest.mark.parametrize("aggregate", ["avg", "p", "p101", "pfoo", ""])
+def test_aggregate_unknown_aggregate(populated_db, aggregate):
+    with pytest.raises(ValueError):
+        db.aggregate("old_data", 3600, ["mean", aggregate])
+
+
+def test_aggregate_missing_metric(populated_db):
+    with pytest.raises(DoesNotExist):
+        db.aggregate("missing", 3600, ["mean"])
+
+
+def test_aggregate_no_data(populated_db):
+    assert db.aggregate("empty_metric", 3600, ["mean", "p50"]) == ([], {
+        "mean": [],
+        "p50": [],
+    })
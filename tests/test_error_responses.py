@@ -80,11 +80,13 @@ def test_rfc_error_response_content_type(rfc_object):
 # TODO: Should I mock out the `error_response` function here?
 @pytest.mark.parametrize("method, args", [
     (ErrorResponse.metric_not_found, ("foo", )),
+    (ErrorResponse.tree_node_not_found, ("foo", )),
     (ErrorResponse.metric_has_no_data, ("foo", )),
     (ErrorResponse.metric_already_exists, ("foo", )),
     (ErrorResponse.unique_metric_name_required, ("foo", "bar")),
     (ErrorResponse.missing_required_key, ("foo", )),
     (ErrorResponse.missing_required_key, (["foo", "bar"], )),
+    (ErrorResponse.invalid_query_parameter, ("foo", "must be an integer.")),
     (ErrorResponse.no_data, None),
 ])
 def test_error_response_class_methods(app_context, caplog, method, args):
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+import asyncio
+import socket
+import threading
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+
+from trendlines import db
+from trendlines import listeners
+from trendlines import orm
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def tcp_server(loop):
+    """
+    A TCP listener on a random port. Yields ``(port, received_points)``.
+    """
+    received = []
+    server = loop.run_until_complete(
+        listeners.start_tcp_server("127.0.0.1", 0, received.append)
+    )
+    port = server.sockets[0].getsockname()[1]
+    yield port, received
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+
+
+async def _send(port, *chunks):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for chunk in chunks:
+        writer.write(chunk)
+        await writer.drain()
+    writer.write_eof()
+    # Wait for the server to close its side, which happens once it's read
+    # everything we sent.
+    await reader.read()
+    writer.close()
+
+
+@pytest.mark.parametrize("line, expected", [
+    (b"foo 1 1546532003\n", {"metric": "foo", "value": 1.0,
+                             "time": 1546532003}),
+    ("foo.bar -2.5 1546532003\r\n", {"metric": "foo.bar", "value": -2.5,
+                                     "time": 1546532003}),
+    (b"\n", None),
+    (b"foo\n", None),
+    (b"foo bar\n", None),
+    (b"\xff\xfe 1\n", None),
+    (b"bad.metric nan\n", None),
+    (b"x 1 99999999999999999999\n", None),
+])
+def test_parse_line(line, expected):
+    assert listeners.parse_line(line) == expected
+
+
+def test_tcp_many_lines_one_connection(loop, tcp_server):
+    port, received = tcp_server
+    lines = b"".join(b"foo %d 1546532003\n" % n for n in range(2000))
+    # Split mid-line, across many writes.
+    chunks = [lines[i:i + 1000] for i in range(0, len(lines), 1000)]
+    loop.run_until_complete(_send(port, *chunks))
+    assert [p['value'] for p in received] == list(range(2000))
+
+
+def test_tcp_skips_bad_lines(loop, tcp_server):
+    port, received = tcp_server
+    loop.run_until_complete(_send(port, b"foo 1\nnot a point\n\nbar 2\n"))
+    assert [p['metric'] for p in received] == ["foo", "bar"]
+
+
+def test_tcp_last_line_without_newline(loop, tcp_server):
+    port, received = tcp_server
+    loop.run_until_complete(_send(port, b"foo 1\nbar 2"))
+    assert [p['metric'] for p in received] == ["foo", "bar"]
+
+
+def test_tcp_line_too_long(loop, tcp_server):
+    port, received = tcp_server
+    data = b"foo 1\n" + b"x" * (listeners.MAX_LINE_LENGTH * 2) + b" 2\n"
+    loop.run_until_complete(_send(port, data))
+    assert [p['metric'] for p in received] == ["foo"]
+
+
+def test_tcp_concurrent_connections(loop, tcp_server):
+    port, received = tcp_server
+    sends = [_send(port, b"m%d 1\nm%d 2\n" % (n, n)) for n in range(200)]
+    loop.run_until_complete(asyncio.gather(*sends))
+    assert len(received) == 400
+    assert len(set(p['metric'] for p in received)) == 200
+
+
+def test_tcp_waits_for_drain(loop):
+    received = []
+    room = asyncio.Event()
+
+    async def drain():
+        await room.wait()
+
+    server = loop.run_until_complete(
+        listeners.start_tcp_server("127.0.0.1", 0, received.append,
+                                   drain=drain)
+    )
+    port = server.sockets[0].getsockname()[1]
+    send = loop.create_task(_send(port, b"foo 1\nfoo 2\nfoo 3\n"))
+    loop.run_until_complete(asyncio.sleep(0.1))
+    # Reading stopped until there is room again.
+    assert len(received) == 1
+    room.set()
+    loop.run_until_complete(asyncio.wait_for(send, 5))
+    assert [p['value'] for p in received] == [1, 2, 3]
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+
+
+@pytest.fixture
+def udp_server(loop):
+    """
+    A UDP listener on a random port. Yields ``(port, received_points)``.
+    """
+    received = []
+    transport = loop.run_until_complete(
+        listeners.start_udp_server("127.0.0.1", 0, received.append)
+    )
+    port = transport.get_extra_info('sockname')[1]
+    yield port, received
+    transport.close()
+
+
+def _send_udp(port, *datagrams):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for datagram in datagrams:
+            sock.sendto(datagram, ("127.0.0.1", port))
+
+
+def test_udp(loop, udp_server):
+    port, received = udp_server
+    _send_udp(port, b"foo 1 1546532003\n", b"foo.bar 2", b"garbage\n")
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert received == [
+        {"metric": "foo", "value": 1.0, "time": 1546532003},
+        {"metric": "foo.bar", "value": 2.0, "time": received[1]['time']},
+    ]
+
+
+def test_udp_multi_line_datagram(loop, udp_server):
+    port, received = udp_server
+    _send_udp(port, b"".join(b"m %d\n" % n for n in range(100)))
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert [p['value'] for p in received] == list(range(100))
+
+
+def test_udp_drops_datagrams_when_full(loop, caplog):
+    received = []
+    full = [True]
+    transport = loop.run_until_complete(
+        listeners.start_udp_server("127.0.0.1", 0, received.append,
+                                   is_full=lambda: full[0])
+    )
+    port = transport.get_extra_info('sockname')[1]
+    try:
+        _send_udp(port, b"foo 1\n", b"foo 2\n")
+        loop.run_until_complete(asyncio.sleep(0.1))
+        assert received == []
+        assert caplog.text.count("dropping datagrams") == 1
+        full[0] = False
+        _send_udp(port, b"foo 3\n")
+        loop.run_until_complete(asyncio.sleep(0.1))
+        assert [p['value'] for p in received] == [3]
+        assert "UDP: dropped 2 datagrams." in caplog.text
+    finally:
+        transport.close()
+
+
+def test_batcher_flushes_on_size(loop):
+    flushed = []
+    batcher = listeners.Batcher(flushed.append, 3, 60, loop)
+    for n in range(7):
+        batcher({"value": n})
+    assert [[p['value'] for p in b] for b in flushed] == [[0, 1, 2],
+                                                         [3, 4, 5]]
+    assert len(batcher) == 1
+
+
+def test_batcher_flushes_on_time(loop):
+    flushed = []
+    batcher = listeners.Batcher(flushed.append, 1000, 0.05, loop)
+    batcher({"value": 1})
+    batcher({"value": 2})
+    assert flushed == []
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert flushed == [[{"value": 1}, {"value": 2}]]
+
+    # The timer starts again with the next point.
+    batcher({"value": 3})
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert len(flushed) == 2
+
+
+def test_batcher_flush(loop):
+    flushed = []
+    batcher = listeners.Batcher(flushed.append, 1000, 60, loop)
+    batcher.flush()
+    assert flushed == []
+    batcher({"value": 1})
+    batcher.flush()
+    assert flushed == [[{"value": 1}]]
+    # The pending timer was cancelled.
+    assert batcher._timer is None
+
+
+def test_http_writer(loop):
+    with patch("requests.Session.post") as post:
+        write = listeners.HTTPWriter("http://x/api/v1/data", loop,
+                                     max_workers=1)
+        write([{"metric": "foo", "value": 1, "time": 5}])
+        write([{"metric": "bar", "value": 2, "time": 6}])
+        write.close()
+    assert post.call_count == 2
+    post.assert_called_with("http://x/api/v1/data",
+                            json=[{"metric": "bar", "value": 2, "time": 6}])
+    # The session was reused.
+    assert len(write._sessions) == 1
+
+
+def test_pool_writer_full_and_drain(loop):
+    sending = threading.Event()
+    release = threading.Event()
+
+    def slow_post(*args, **kwargs):
+        sending.set()
+        release.wait(5)
+        return Mock(ok=True, status_code=201)
+
+    with patch("requests.Session.post", side_effect=slow_post) as post:
+        write = listeners.HTTPWriter("http://x/api/v1/data", loop,
+                                     max_workers=1, max_pending=2)
+        write([{"metric": "foo", "value": 1, "time": 5}])
+        assert sending.wait(5)
+        assert not write.full()
+        write([{"metric": "foo", "value": 2, "time": 6}])
+        assert write.full()
+        drain = loop.create_task(write.drain())
+        loop.run_until_complete(asyncio.sleep(0.05))
+        assert not drain.done()
+        release.set()
+        loop.run_until_complete(asyncio.wait_for(drain, 5))
+        assert not write.full()
+        write.close()
+    assert post.call_count == 2
+
+
+def test_pool_writer_is_abstract(loop):
+    with pytest.raises(TypeError):
+        listeners._PoolWriter(loop, max_workers=1, max_pending=1)
+
+
+@pytest.mark.parametrize("status_code", [400, 500])
+def test_http_writer_logs_failed_requests(loop, caplog, status_code):
+    response = Mock(ok=False, status_code=status_code, text="Nope")
+    with patch("requests.Session.post", return_value=response):
+        write = listeners.HTTPWriter("http://x/api/v1/data", loop)
+        write([{"metric": "foo", "value": 1, "time": 5}])
+        write.close()
+    assert "1 data points failed: %s Nope" % status_code in caplog.text
+    assert "ERROR" in caplog.text
+
+
+def test_database_writer(loop, populated_db):
+    write = listeners.DatabaseWriter(loop)
+    write([{"metric": "foo", "value": 1, "time": 1546532100},
+           {"metric": "new.metric", "value": 2, "time": 1546532100}])
+    write([{"metric": "new.metric", "value": 3, "time": 1546532200}])
+    write.close()
+    assert [d.value for d in db.get_data("new.metric")] == [2, 3]
+    assert len(db.get_data("foo")) == 5
+
+
+def test_database_writer_skips_bad_points(loop, populated_db):
+    write = listeners.DatabaseWriter(loop)
+    write([{"metric": "foo", "value": 1, "time": 1546532100},
+           {"metric": "foo", "value": float("nan"), "time": 1546532100},
+           {"metric": "foo", "value": 2, "time": 10 ** 20}])
+    write.close()
+    values = [d.value for d in db.get_data("foo")]
+    assert len(values) == 5
+    assert 1 in values
+
+
+def test_database_writer_deleted_metric(loop, populated_db):
+    db.get_metric_id("foo")
+    # Deleted by someone that doesn't share our cache.
+    orm.Metric.delete().where(orm.Metric.name == "foo").execute()
+    write = listeners.DatabaseWriter(loop)
+    write([{"metric": "foo", "value": 1, "time": 1546532100}])
+    write.close()
+    assert [d.value for d in db.get_data("foo")] == [1]
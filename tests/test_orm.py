@@ -3,6 +3,7 @@
 """
 import hashlib
 import sqlite3
+import threading
 from pathlib import Path
 from unittest.mock import MagicMock
 from unittest.mock import patch
@@ -35,6 +36,20 @@ def _hash_file(path, algorithm=hashlib.md5):
     return algorithm(open(str(path), 'rb').read()).hexdigest()
 
 
+def _dump(path):
+    """
+    Return the SQL needed to recreate a database, as a list of statements.
+
+    Copies made with SQLite's backup API have the same contents but not
+    always the same bytes, so compare these instead of file hashes.
+    """
+    conn = sqlite3.connect(str(path))
+    try:
+        return list(conn.iterdump())
+    finally:
+        conn.close()
+
+
 @pytest.fixture
 def up_to_date_db(tmp_path):
     """
@@ -66,6 +81,9 @@ def broken_db(outdated_db):
     Return a database file that is broken and cannot have migrations applied.
     """
     path = outdated_db
+    # Make sure a migration that needs the `datapoint` table is pending.
+    DatabaseManager(SqliteDatabase(str(path))).downgrade(
+        "0007_add_datapoint_metric_id_timestamp_index")
     conn = sqlite3.connect(str(path))
     c = conn.cursor()
     c.execute('DROP TABLE datapoint;')
@@ -85,6 +103,35 @@ def test_datapoint_str():
     assert str(d) == "<DataPoint: None, foo, 15.34, 10>"
 
 
+def test_datapoint_str_metric_not_loaded():
+    d = orm.DataPoint(metric=3, value=15.34, timestamp=10)
+    assert str(d) == "<DataPoint: None, 3, 15.34, 10>"
+
+
+def test_metric_stats_str():
+    s = orm.MetricStats(metric=3, count=10)
+    assert str(s) == "<MetricStats: 3, count=10>"
+
+
+def test_migration_0010_summarizes_existing_data(outdated_db):
+    conn = sqlite3.connect(str(outdated_db))
+    with conn:
+        conn.execute('INSERT INTO "metric" ("name") VALUES ("foo"), ("bar")')
+        conn.executemany(
+            'INSERT INTO "datapoint" ("metric_id", "value", "timestamp")'
+            ' VALUES (?, ?, ?)',
+            [(1, 3, 20), (1, 5, 10), (1, 4, 20), (2, 1, 0)],
+        )
+    conn.close()
+
+    orm.create_db(str(outdated_db))
+    rows = orm.MetricStats.select().order_by(orm.MetricStats.metric).tuples()
+    assert list(rows) == [
+        (1, 3, 12, 50, 3, 5, 10, 20, 4),
+        (2, 1, 1, 1, 1, 1, 0, 0, 1),
+    ]
+
+
 def test_create_db(tmp_path):
     path = tmp_path / "foo.db"
     orm.create_db(str(path))
@@ -117,6 +164,80 @@ def test_create_db_nothing_to_do(up_to_date_db, caplog):
     assert "Database is up to date." in caplog.text
 
 
+def test_create_db_nothing_to_do_skips_backup(up_to_date_db, caplog):
+    with patch("trendlines.utils.backup_sqlite") as backup:
+        orm.create_db(str(up_to_date_db))
+    backup.assert_not_called()
+    assert "Created database backup" not in caplog.text
+    assert list(up_to_date_db.parent.glob("foo.db.*")) == []
+
+
+def test_create_db_backup_includes_wal(outdated_db):
+    # Data that's only in the write-ahead log must make it into the backup.
+    conn = sqlite3.connect(str(outdated_db))
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA wal_autocheckpoint=0")
+    conn.execute("CREATE TABLE only_in_wal (x INTEGER)")
+    conn.execute("INSERT INTO only_in_wal VALUES (1)")
+    conn.commit()
+
+    orm.create_db(str(outdated_db))
+    conn.close()
+
+    backup_file, = outdated_db.parent.glob("foo.db.*[0-9]")
+    backup_conn = sqlite3.connect(str(backup_file))
+    rv = backup_conn.execute("SELECT x FROM only_in_wal").fetchall()
+    backup_conn.close()
+    assert rv == [(1, )]
+
+
+def test_create_db_stores_schema_version(up_to_date_db):
+    orm.create_db(str(up_to_date_db))
+    conn = sqlite3.connect(str(up_to_date_db))
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    conn.close()
+    assert version == orm.schema_version(orm._packaged_migrations())
+
+
+def test_create_db_fast_path(up_to_date_db, caplog):
+    orm.create_db(str(up_to_date_db))
+    with patch("trendlines.orm.DatabaseManager") as manager:
+        orm.create_db(str(up_to_date_db))
+    manager.assert_not_called()
+    assert "Database is up to date." in caplog.text
+
+
+def test_create_db_schema_version_mismatch(outdated_db, caplog):
+    # A stale version, such as one stored before a new migration was added.
+    conn = sqlite3.connect(str(outdated_db))
+    conn.execute("PRAGMA user_version = 12345")
+    conn.close()
+    orm.create_db(str(outdated_db))
+    assert "Successfully applied database migrations" in caplog.text
+
+
+@patch("peewee_moves.DatabaseManager.upgrade", MagicMock(return_value=False))
+def test_create_db_failure_does_not_store_schema_version(outdated_db):
+    orm.create_db(str(outdated_db))
+    conn = sqlite3.connect(str(outdated_db))
+    assert conn.execute("PRAGMA user_version").fetchone() == (0, )
+    conn.close()
+
+
+def test_schema_version():
+    names = ["0001_foo", "0002_bar"]
+    assert orm.schema_version(names) == orm.schema_version(names[::-1])
+    assert orm.schema_version(names) != orm.schema_version(names[:1])
+    assert 0 < orm.schema_version(names) < 2 ** 31
+
+
+@patch("trendlines.orm.MIGRATION_DIRS", ("does_not_exist", ))
+def test_create_db_no_migration_dir_skips_fast_path(up_to_date_db):
+    with patch("trendlines.orm.DatabaseManager") as manager:
+        orm.create_db(str(up_to_date_db))
+    manager.assert_called_once()
+
+
 def test_create_db_applies_missing_migrations(outdated_db, caplog):
     orm.create_db(str(outdated_db))
     assert "Missing migrations:" in caplog.text
@@ -135,7 +256,7 @@ def test_create_db_failure(broken_db, caplog):
     backup_file = Path("{}.{}".format(str(broken_db), "20190228_150202"))
     assert broken_db.exists()
     assert backup_file.exists()
-    assert _hash_file(broken_db) == _hash_file(backup_file)
+    assert _dump(broken_db) == _dump(backup_file)
 
     # and lastly check our logs.
     assert "Missing migrations:" in caplog.text
@@ -204,3 +325,199 @@ def test_create_db_run_migrations_in_docker(outdated_db, caplog):
     assert "Failed to open default migration directory" in caplog.text
     assert "Success" in caplog.text
     assert "Successfully applied database migrations" in caplog.text
+
+
+def test_open_db(tmp_path):
+    db_file = tmp_path / "test.db"
+    orm.create_db(str(db_file))
+    orm.open_db(str(db_file))
+    assert orm.db.database == str(db_file.resolve())
+    assert "datapoint" in orm.db.get_tables()
+    orm.db.close()
+
+
+def test_open_db_missing_file(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        orm.open_db(str(tmp_path / "missing.db"))
+
+
+@pytest.mark.parametrize("mode, synchronous", [
+    ("fast", 0),
+    ("balanced", 1),
+    ("durable", 2),
+])
+def test_get_pragmas(mode, synchronous):
+    rv = orm.get_pragmas(mode)
+    assert rv['synchronous'] == synchronous
+    assert rv['journal_mode'] == "wal"
+    assert rv['foreign_keys'] == 1
+
+
+def test_get_pragmas_fast_is_default():
+    assert orm.get_pragmas() == orm.DB_OPTS
+
+
+def test_get_pragmas_overrides():
+    rv = orm.get_pragmas("durable", cache_size=1000,
+                         extra={"synchronous": 3, "mmap_size": 1024})
+    assert rv['cache_size'] == -1000
+    assert rv['synchronous'] == 3
+    assert rv['mmap_size'] == 1024
+
+
+def test_get_pragmas_unknown_mode():
+    with pytest.raises(ValueError):
+        orm.get_pragmas("yolo")
+
+
+def test_create_db_pragmas(tmp_path):
+    orm.create_db(str(tmp_path / "test.db"),
+                  pragmas=orm.get_pragmas("durable"))
+    assert orm.db.execute_sql("PRAGMA synchronous").fetchone()[0] == 2
+    orm.db.close()
+
+
+@pytest.fixture
+def pool_db(tmp_path):
+    """
+    A :class:`orm.PoolableSqliteDatabase` that isn't the global ``orm.db``.
+    """
+    database = orm.PoolableSqliteDatabase(str(tmp_path / "pool.db"),
+                                          pooled=True)
+    yield database
+    database.close_all()
+
+
+def test_pooled_connection_is_reused(pool_db):
+    pool_db.connect()
+    conn = pool_db.connection()
+    pool_db.close()
+    assert not pool_db._is_closed(conn)
+    pool_db.connect()
+    assert pool_db.connection() is conn
+    pool_db.close()
+
+
+def test_pooled_connection_is_shared_between_threads(pool_db):
+    pool_db.connect()
+    conn = pool_db.connection()
+    pool_db.close()
+
+    def use_connection():
+        with pool_db.connection_context():
+            assert pool_db.connection() is conn
+            pool_db.execute_sql("SELECT 1")
+
+    thread = threading.Thread(target=use_connection)
+    thread.start()
+    thread.join()
+    assert pool_db._connections[0][1] is conn
+
+
+def test_unpooled_connection_is_closed(pool_db):
+    pool_db.set_pooled(False)
+    pool_db.connect()
+    conn = pool_db.connection()
+    pool_db.close()
+    assert pool_db._is_closed(conn)
+    assert pool_db._in_use == {}
+    assert pool_db._connections == []
+
+
+def test_set_pooled_false_closes_idle_connections(pool_db):
+    pool_db.connect()
+    conn = pool_db.connection()
+    pool_db.close()
+    pool_db.set_pooled(False)
+    assert pool_db._is_closed(conn)
+
+
+def test_init_closes_pooled_connections(pool_db, tmp_path):
+    pool_db.connect()
+    conn = pool_db.connection()
+    pool_db.close()
+    pool_db.init(str(tmp_path / "other.db"))
+    assert pool_db._is_closed(conn)
+    pool_db.connect()
+    assert pool_db.connection() is not conn
+    pool_db.close()
+
+
+def test_pooled_connection_keeps_pragmas(pool_db):
+    pool_db.init(pool_db.database, pragmas={"cache_size": -1234})
+    pool_db.connect()
+    pool_db.close()
+    with patch.object(pool_db, "_set_pragmas") as set_pragmas:
+        pool_db.connect()
+        assert pool_db.pragma("cache_size") == -1234
+        pool_db.close()
+    set_pragmas.assert_not_called()
+
+
+def test_read_only_connection(pool_db):
+    with pool_db.connection_context():
+        pool_db.execute_sql("CREATE TABLE foo (x INTEGER)")
+    pool_db.connect(read_only=True)
+    assert pool_db.execute_sql("SELECT count(*) FROM foo").fetchone() == (0, )
+    with pytest.raises(OperationalError):
+        pool_db.execute_sql("INSERT INTO foo VALUES (1)")
+    assert pool_db.pragma("query_only") == 1
+    pool_db.close()
+
+
+def test_read_only_connection_pragmas(pool_db):
+    conn = sqlite3.connect(pool_db.database)
+    conn.execute("CREATE TABLE foo (x INTEGER)")
+    conn.close()
+    pragmas = orm.get_pragmas("fast", extra={"mmap_size": 65536})
+    pool_db.init(pool_db.database, pragmas=pragmas)
+    pool_db.connect(read_only=True)
+    assert pool_db.pragma("cache_size") == -64000
+    assert pool_db.pragma("mmap_size") == 65536
+    # The write pragmas were left alone.
+    assert pool_db.pragma("journal_mode") == "delete"
+    assert pool_db.pragma("synchronous") == 2
+    assert pool_db.pragma("foreign_keys") == 0
+    pool_db.close()
+
+
+def test_read_only_connections_are_pooled_separately(pool_db):
+    pool_db.connect()
+    writer = pool_db.connection()
+    pool_db.close()
+
+    pool_db.connect(read_only=True)
+    reader = pool_db.connection()
+    assert reader is not writer
+    pool_db.close()
+
+    pool_db.connect(read_only=True)
+    assert pool_db.connection() is reader
+    pool_db.close()
+    pool_db.connect()
+    assert pool_db.connection() is writer
+    pool_db.close()
+
+
+def test_read_only_connections_are_closed(pool_db):
+    with pool_db.connection_context():
+        pass
+    pool_db.connect(read_only=True)
+    idle = pool_db.connection()
+    pool_db.close()
+    pool_db.connect(read_only=True)
+    pool_db.close_all()
+    assert pool_db._is_closed(idle)
+    assert pool_db._readers == []
+    assert pool_db._readers_in_use == {}
+
+
+def test_unpooled_read_only_connection_is_closed(pool_db):
+    with pool_db.connection_context():
+        pass
+    pool_db.set_pooled(False)
+    pool_db.connect(read_only=True)
+    conn = pool_db.connection()
+    pool_db.close()
+    assert pool_db._is_closed(conn)
+    assert pool_db._readers == []
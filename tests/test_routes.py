@@ -6,6 +6,8 @@ from unittest.mock import patch
 
 import pytest
 
+from trendlines import app_factory
+from trendlines import db
 from trendlines import routes
 from trendlines import orm
 
@@ -52,8 +54,59 @@ def test_index(client):
 def test_index_with_data(client, populated_db):
     rv = client.get('/')
     assert rv.status_code == 200
-    assert b"empty_metric" in rv.data
-    assert b"foo.bar" in rv.data
+    # The tree is loaded separately, so the page doesn't grow with it.
+    assert b"empty_metric" not in rv.data
+    assert b"/api/v1/tree" in client.get('/static/core.js').data
+
+
+def _tree_ids(client, node_id="#"):
+    rv = client.get(API_BASE + "/tree", query_string={"id": node_id})
+    return [node['id'] for node in rv.get_json()]
+
+
+def test_tree(client, populated_db):
+    rv = client.get(API_BASE + "/tree")
+    assert rv.status_code == 200
+    d = rv.get_json()
+    assert [n['id'] for n in d] == ["empty_metric", "foo", "metric_with_units",
+                                    "old_data", "with_everything"]
+    foo = d[1]
+    assert foo == {"id": "foo", "text": "foo", "metric_id": 2,
+                   "children": True}
+    assert d[0]['children'] is False
+
+    assert _tree_ids(client, "foo") == ["foo.bar"]
+    assert _tree_ids(client, "foo.bar") == []
+
+
+def test_tree_fills_in_parents(client, populated_db):
+    client.post("/api/v1/data", json={"metric": "a.b.c", "value": 1})
+    rv = client.get(API_BASE + "/tree?id=a")
+    assert rv.get_json() == [{"id": "a.b", "text": "a.b", "metric_id": None,
+                              "children": True}]
+    assert _tree_ids(client, "a.b") == ["a.b.c"]
+
+
+def test_tree_node_not_found(client, populated_db):
+    rv = client.get(API_BASE + "/tree?id=missing")
+    assert rv.status_code == 404
+    assert "'missing'" in rv.get_json()['detail']
+
+
+def test_tree_no_data(client):
+    rv = client.get(API_BASE + "/tree")
+    assert rv.status_code == 200
+    assert rv.get_json() == []
+
+
+def test_tree_follows_metric_changes(client, populated_db):
+    assert "renamed_metric" not in _tree_ids(client)
+    client.patch(metric_url(1), json={"name": "renamed_metric"})
+    assert "renamed_metric" in _tree_ids(client)
+    client.delete(metric_url(1))
+    assert "renamed_metric" not in _tree_ids(client)
+    client.post("/api/v1/data", json={"metric": "foo.new", "value": 1})
+    assert "foo.new" in _tree_ids(client, "foo")
 
 
 @pytest.mark.xfail(
@@ -87,6 +140,15 @@ def test_api_add(client):
     assert b"Added DataPoint to Metric" in rv.data
 
 
+def test_api_add_deleted_metric(client, populated_db):
+    db.get_metric_id("foo")
+    # Deleted by another process, which can't invalidate our cache.
+    orm.Metric.delete().where(orm.Metric.name == "foo").execute()
+    rv = client.post("/api/v1/data", json={"metric": "foo", "value": 1})
+    assert rv.status_code == 201
+    assert [d.value for d in db.get_data("foo")] == [1]
+
+
 def test_api_add_with_missing_key(client):
     data = {"value": 10}
     rv = client.post("/api/v1/data", json=data)
@@ -94,6 +156,82 @@ def test_api_add_with_missing_key(client):
     assert b"Missing required key. Required keys are:" in rv.data
 
 
+@pytest.mark.parametrize("wrap", [
+    lambda points: points,
+    lambda points: {"points": points},
+])
+def test_api_add_many(client, populated_db, wrap):
+    points = [
+        {"metric": "foo", "value": 10},
+        {"metric": "foo", "value": 11, "time": 1546532070},
+        {"metric": "brand.new", "value": 12},
+    ]
+    rv = client.post("/api/v1/data", json=wrap(points))
+    assert rv.status_code == 201
+    assert rv.is_json
+    d = rv.get_json()
+    assert d == {"accepted": 3, "rejected": 0, "errors": []}
+
+    assert len(client.get("/api/v1/data/foo").get_json()['rows']) == 6
+    assert len(client.get("/api/v1/data/brand.new").get_json()['rows']) == 1
+
+
+def test_api_add_many_with_invalid_items(client, populated_db):
+    points = [
+        {"metric": "foo", "value": 10},
+        {"value": 11},
+        {"metric": "foo", "value": "twelve"},
+    ]
+    rv = client.post("/api/v1/data", json=points)
+    assert rv.status_code == 201
+    d = rv.get_json()
+    assert d['accepted'] == 1
+    assert d['rejected'] == 2
+    assert [e['index'] for e in d['errors']] == [1, 2]
+    assert "Missing required key" in d['errors'][0]['detail']
+
+
+def test_api_add_many_with_non_finite_items(client, populated_db):
+    points = [
+        {"metric": "foo", "value": 10},
+        {"metric": "foo", "value": float("nan")},
+        {"metric": "foo", "value": float("inf")},
+        {"metric": "foo", "value": 11, "time": float("nan")},
+        {"metric": "foo", "value": 12, "time": 1e300},
+        {"metric": "foo", "value": 13},
+    ]
+    rv = client.post("/api/v1/data", json=points)
+    assert rv.status_code == 201
+    d = rv.get_json()
+    assert d['accepted'] == 2
+    assert [e['index'] for e in d['errors']] == [1, 2, 3, 4]
+    assert "'value' must be finite" in d['errors'][0]['detail']
+    assert "'time' `1e+300` is out of range" in d['errors'][3]['detail']
+    assert [d.value for d in db.get_data("foo")][-2:] == [10, 13]
+
+    assert client.get(metric_url(2)).get_json()['stats']['count'] == 6
+
+
+@pytest.mark.parametrize("data", [
+    {"metric": "foo", "value": float("nan")},
+    {"metric": "foo", "value": float("-inf")},
+    {"metric": "foo", "value": 1, "time": float("nan")},
+    {"metric": "foo", "value": 1, "time": 1e300},
+])
+def test_api_add_non_finite(client, populated_db, data):
+    rv = client.post("/api/v1/data", json=data)
+    assert rv.status_code == 400
+    assert len(db.get_data("foo")) == 4
+
+
+def test_api_add_many_all_invalid(client, populated_db):
+    rv = client.post("/api/v1/data", json={"points": [{"value": 11}]})
+    assert rv.status_code == 400
+    d = rv.get_json()
+    assert d['accepted'] == 0
+    assert d['rejected'] == 1
+
+
 def test_api_get_data_as_json(client, populated_db):
     rv = client.get("/api/v1/data/foo")
     assert rv.status_code == 200
@@ -118,6 +256,258 @@ def test_api_get_data_by_id(client, populated_db):
     assert d[3]['value'] == 9
 
 
+@pytest.fixture
+def windowed_data(client, populated_db):
+    """
+    Like the "old_data" metric, but without a timestamp of 0. See peewee#1875.
+    """
+    points = [(0, 1000), (1, 1545321236), (5, 1546532003), (8, 1546532067)]
+    points = [{"metric": "windowed", "value": v, "time": t} for v, t in points]
+    client.post("/api/v1/data", json=points)
+
+
+@pytest.fixture
+def buffered(app):
+    app.config['WRITE_BUFFER_ENABLED'] = True
+    app.config['WRITE_BUFFER_MAX_LATENCY_MS'] = 60 * 1000
+    app_factory.setup_write_buffer(app)
+    yield db.write_buffer
+    app.config['WRITE_BUFFER_ENABLED'] = False
+    app_factory.setup_write_buffer(app)
+
+
+def test_api_post_data_buffered(client, populated_db, buffered):
+    rv = client.post("/api/v1/data", json={"metric": "foo", "value": 5})
+    assert rv.status_code == 202
+    assert rv.data == b"Queued DataPoint for Metric 'foo'\n"
+
+    rv = client.post("/api/v1/data", json=[{"metric": "foo", "value": 6},
+                                           {"metric": "foo"}])
+    assert rv.status_code == 202
+    assert rv.get_json()['accepted'] == 1
+    assert rv.get_json()['rejected'] == 1
+
+    assert len(db.get_data("foo")) == 4
+    buffered.flush()
+    assert [d.value for d in db.get_data("foo")][-2:] == [5, 6]
+
+
+@pytest.mark.parametrize("data", [
+    {"metric": "foo", "value": "a"},
+    {"metric": "foo", "value": float("inf")},
+    {"metric": "foo", "value": 1, "time": 1e300},
+])
+def test_api_post_data_buffered_invalid(client, populated_db, buffered,
+                                        data):
+    rv = client.post("/api/v1/data", json=data)
+    assert rv.status_code == 400
+    assert len(buffered) == 0
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("", [0, 1, 5, 8]),
+    ("?start=1545321236", [1, 5, 8]),
+    ("?end=2019-01-03T16:13:23Z", [0, 1]),
+    ("?start=2018-12-20&end=1546532067", [1, 5]),
+    ("?limit=3", [0, 1, 5]),
+    ("?order=desc", [8, 5, 1, 0]),
+    ("?order=desc&limit=1", [8]),
+    ("?last=2", [5, 8]),
+    ("?last=2&order=desc", [8, 5]),
+    ("?last=2&end=1546532067", [1, 5]),
+    ("?last=20", [0, 1, 5, 8]),
+])
+def test_api_get_data_query_parameters(client, windowed_data, query,
+                                       expected):
+    rv = client.get("/api/v1/data/windowed" + query)
+    assert rv.status_code == 200
+    d = rv.get_json()['rows']
+    assert [row['value'] for row in d] == expected
+    assert [row['n'] for row in d] == list(range(len(expected)))
+
+
+@pytest.mark.parametrize("query, name", [
+    ("?start=yesterday", "start"),
+    ("?end=2019-13-01", "end"),
+    ("?start=nan", "start"),
+    ("?start=inf", "start"),
+    ("?end=1e400", "end"),
+    ("?start=-1e30", "start"),
+    ("?limit=ten", "limit"),
+    ("?limit=0", "limit"),
+    ("?last=-5", "last"),
+    ("?order=up", "order"),
+    ("?limit=5&last=5", "last"),
+])
+def test_api_get_data_invalid_query_parameters(client, windowed_data, query,
+                                               name):
+    rv = client.get("/api/v1/data/windowed" + query)
+    assert rv.status_code == 400
+    assert rv.is_json
+    d = rv.get_json()
+    assert "Invalid query parameter '{}'".format(name) in d['detail']
+
+
+def test_api_get_data_max_points(client, populated_db):
+    points = [{"metric": "long", "value": v % 7} for v in range(100)]
+    points[42]['value'] = 99
+    client.post("/api/v1/data", json=points)
+
+    rv = client.get("/api/v1/data/long?max_points=10")
+    assert rv.status_code == 200
+    d = rv.get_json()['rows']
+    assert len(d) == 10
+    assert d[0]['n'] == 0
+    assert d[-1]['n'] == 99
+    assert {"n": 42, "value": 99} in [{k: r[k] for k in ("n", "value")}
+                                      for r in d]
+
+    # Short series are returned untouched.
+    rv = client.get("/api/v1/data/long?last=5&max_points=10")
+    assert [r['n'] for r in rv.get_json()['rows']] == [0, 1, 2, 3, 4]
+
+
+@pytest.fixture
+def hourly_data(client, populated_db):
+    """
+    Two data points every hour for 30 days, starting 2019-01-01T00:00:00Z.
+    """
+    points = [("hourly", n % 24, 1546300800 + n * 1800)
+              for n in range(30 * 48)]
+    db.insert_datapoints(points)
+
+
+@pytest.mark.parametrize("query, resolution, length", [
+    ("?max_points=30", "day", 30),
+    ("?max_points=25", "day", 25),      # Days, then downsampled
+    ("?max_points=100", "hour", 100),
+    ("?max_points=720", "hour", 720),
+    ("?max_points=1000", None, 1000),   # Only 720 hours: use the raw data
+    ("?max_points=2000", None, 1440),   # Everything fits
+    ("?max_points=100&limit=2000", None, 100),
+    # Only 48 points that day
+    ("?max_points=100&start=1546473600&end=1546560000", None, 48),
+])
+def test_api_get_data_rollups(client, hourly_data, query, resolution,
+                              length):
+    rv = client.get("/api/v1/data/hourly" + query)
+    assert rv.status_code == 200
+    d = rv.get_json()
+    assert d.get('resolution') == resolution
+    assert len(d['rows']) == length
+
+
+def test_api_get_data_rollups_rows(client, hourly_data):
+    d = client.get("/api/v1/data/hourly?max_points=30").get_json()
+    assert d['units'] is None
+    assert d['rows'][1] == {
+        "timestamp": "2019-01-02T00:00:00",
+        "value": 11.5,
+        "min": 0,
+        "max": 23,
+        "count": 48,
+        "id": None,
+        "n": 48,
+    }
+    assert [r['n'] for r in d['rows']] == list(range(0, 1440, 48))
+
+
+def test_api_get_data_rollups_order(client, hourly_data):
+    d = client.get("/api/v1/data/hourly?max_points=30&order=desc").get_json()
+    assert d['rows'][0]['timestamp'] == "2019-01-30T00:00:00"
+    assert d['rows'][0]['n'] == 0
+    assert d['rows'][-1]['n'] == 29 * 48
+
+
+def test_api_get_data_rollups_columnar(client, hourly_data):
+    rows = client.get("/api/v1/data/hourly?max_points=100").get_json()
+    rv = client.get("/api/v1/data/hourly?max_points=100&format=columnar")
+    d = rv.get_json()
+    assert d['resolution'] == "hour"
+    assert d['timestamps'] == [r['timestamp'] for r in rows['rows']]
+    assert d['values'] == [r['value'] for r in rows['rows']]
+    assert d['mins'] == [r['min'] for r in rows['rows']]
+    assert d['maxs'] == [r['max'] for r in rows['rows']]
+    assert d['counts'] == [r['count'] for r in rows['rows']]
+    assert d['n'] == [r['n'] for r in rows['rows']]
+    assert 'ids' not in d
+
+
+def test_api_get_data_max_points_too_small(client, populated_db):
+    rv = client.get("/api/v1/data/foo?max_points=2")
+    assert rv.status_code == 400
+    assert "max_points" in rv.get_json()['detail']
+
+
+def test_api_get_data_empty_window(client, windowed_data):
+    rv = client.get("/api/v1/data/windowed?start=1600000000")
+    assert rv.status_code == 404
+    assert 'No data exists for metric' in rv.get_json()['detail']
+
+
+@pytest.mark.parametrize("query", [
+    "",
+    "?order=desc&limit=2",
+    "?last=2",
+    "?last=3&order=desc",
+    "?max_points=3",
+])
+def test_api_get_data_columnar(client, windowed_data, query):
+    rows = client.get("/api/v1/data/windowed" + query).get_json()
+    sep = "&" if query else "?"
+    rv = client.get("/api/v1/data/windowed" + query + sep + "format=columnar")
+    assert rv.status_code == 200
+    d = rv.get_json()
+    assert d['units'] == rows['units']
+    assert d['timestamps'] == [r['timestamp'] for r in rows['rows']]
+    assert d['values'] == [r['value'] for r in rows['rows']]
+    assert d['ids'] == [r['id'] for r in rows['rows']]
+    if "max_points" in query:
+        assert d['n'] == [r['n'] for r in rows['rows']]
+    else:
+        assert 'n' not in d
+
+
+@pytest.mark.parametrize("query, name", [
+    ("?format=csv", "format"),
+    ("?format=columnar&stream=1", "stream"),
+])
+def test_api_get_data_invalid_format(client, windowed_data, query, name):
+    rv = client.get("/api/v1/data/windowed" + query)
+    assert rv.status_code == 400
+    assert "'{}'".format(name) in rv.get_json()['detail']
+
+
+@pytest.mark.parametrize("query", [
+    "",
+    "?order=desc&limit=2",
+    "?last=2",
+    "?max_points=3",
+])
+def test_api_get_data_stream(client, windowed_data, query):
+    expected = client.get("/api/v1/data/windowed" + query).get_json()
+    sep = "&" if query else "?"
+    rv = client.get("/api/v1/data/windowed" + query + sep + "stream=true")
+    assert rv.status_code == 200
+    assert rv.is_json
+    assert rv.get_json() == expected
+
+
+def test_api_get_data_stream_is_streamed(client, windowed_data):
+    rv = client.get("/api/v1/data/windowed?stream=1")
+    assert rv.is_streamed
+
+
+def test_api_get_data_stream_errors(client, windowed_data):
+    rv = client.get("/api/v1/data/windowed?stream=1&start=1600000000")
+    assert rv.status_code == 404
+    assert 'No data exists for metric' in rv.get_json()['detail']
+
+    rv = client.get("/api/v1/data/windowed?stream=maybe")
+    assert rv.status_code == 400
+    assert "'stream'" in rv.get_json()['detail']
+
+
 def test_api_get_data_as_json_metric_not_found(client):
     rv = client.get("/api/v1/data/missing")
     assert rv.status_code == 404
@@ -138,6 +528,133 @@ def test_api_get_data_as_json_no_data_for_metric(client, populated_db):
     assert 'No data exists for metric' in d['detail']
 
 
+def test_api_get_data_no_data_does_not_query_data(client, populated_db,
+                                                  query_counter):
+    client.get("/api/v1/data/empty_metric")
+    queries = [c[0][0] for c in query_counter.call_args_list]
+    assert not any('FROM "datapoint"' in q for q in queries)
+
+
+def test_api_get_data_empty_window(client, populated_db):
+    rv = client.get("/api/v1/data/old_data?start=2019-02-01")
+    assert rv.status_code == 404
+    assert 'No data exists for metric' in rv.get_json()['detail']
+
+
+def test_api_get_latest(client, populated_db):
+    rv = client.get("/api/v1/data/old_data/latest")
+    assert rv.status_code == 200
+    assert rv.get_json() == {"metric": "old_data",
+                             "timestamp": "2019-01-03T16:14:27",
+                             "value": 8,
+                             "units": None}
+    # By id
+    rv = client.get("/api/v1/data/3/latest")
+    assert rv.get_json()['metric'] == "foo.bar"
+    assert rv.get_json()['value'] == -2
+
+
+def test_api_get_latest_no_data(client, populated_db):
+    rv = client.get("/api/v1/data/empty_metric/latest")
+    assert rv.status_code == 404
+    assert 'No data exists for metric' in rv.get_json()['detail']
+
+
+@pytest.mark.parametrize("metric", ["missing", "99"])
+def test_api_get_latest_not_found(client, populated_db, metric):
+    rv = client.get("/api/v1/data/%s/latest" % metric)
+    assert rv.status_code == 404
+    assert 'does not exist' in rv.get_json()['detail']
+
+
+def test_api_get_latest_many(client, populated_db, query_counter):
+    rv = client.get("/api/v1/latest?prefix=foo")
+    assert rv.status_code == 200
+    rows = rv.get_json()['rows']
+    assert [r['metric'] for r in rows] == ["foo", "foo.bar"]
+    assert rows[1]['value'] == -2
+    assert query_counter.call_count == 1
+
+
+def test_api_get_latest_many_all_metrics(client, populated_db):
+    rows = client.get("/api/v1/latest").get_json()['rows']
+    assert [r['metric'] for r in rows] == ["foo", "foo.bar", "old_data"]
+    rows = client.get("/api/v1/latest?prefix=nope").get_json()['rows']
+    assert rows == []
+
+
+@pytest.mark.parametrize("prefix", ["%F4%8F%BF%BF", "%ED%9F%BF"])
+def test_api_get_latest_many_largest_characters(client, populated_db, prefix):
+    # U+10FFFF and U+D7FF: neither can simply be incremented.
+    rv = client.get("/api/v1/latest?prefix=" + prefix)
+    assert rv.status_code == 200
+    assert rv.get_json()['rows'] == []
+
+
+def test_api_get_aggregate(client, populated_db):
+    rv = client.get("/api/v1/data/old_data/aggregate?bucket=1d&agg=count,p95")
+    assert rv.status_code == 200
+    assert rv.get_json() == {
+        "timestamps": ["1970-01-01T00:00:00",
+                       "2018-12-20T00:00:00",
+                       "2019-01-03T00:00:00"],
+        "count": [1, 1, 2],
+        "p95": [0, 1, 7.85],
+        "units": None,
+        "bucket": 86400,
+    }
+
+
+def test_api_get_aggregate_defaults_to_mean(client, populated_db):
+    url = "/api/v1/data/5/aggregate?bucket=1h&start=2019-01-03"
+    data = client.get(url).get_json()
+    assert data["timestamps"] == ["2019-01-03T16:00:00"]
+    assert data["mean"] == [6.5]
+    assert data["bucket"] == 3600
+
+
+@pytest.mark.parametrize("query, name", [
+    ("", "bucket"),
+    ("bucket=1y", "bucket"),
+    ("bucket=0", "bucket"),
+    ("bucket=1h&agg=avg", "agg"),
+    ("bucket=1h&agg=mean,p200", "agg"),
+    ("bucket=1h&start=yesterday", "start"),
+    ("bucket=1h&start=nan", "start"),
+    ("bucket=99999999999999999999d", "bucket"),
+])
+def test_api_get_aggregate_invalid(client, populated_db, query, name):
+    rv = client.get("/api/v1/data/old_data/aggregate?" + query)
+    assert rv.status_code == 400
+    assert "'%s'" % name in rv.get_json()['detail']
+
+
+def test_api_get_aggregate_window_too_large(app, client, populated_db):
+    app.config['AGGREGATE_MAX_PERCENTILE_POINTS'] = 3
+    url = "/api/v1/data/old_data/aggregate?bucket=1d&agg="
+    rv = client.get(url + "count,p95")
+    assert rv.status_code == 400
+    assert "too large" in rv.get_json()['detail']
+    # Only percentiles need all of the data.
+    assert client.get(url + "count,std").status_code == 200
+    rv = client.get(url + "p95&start=2018-12-20")
+    assert rv.status_code == 200
+    assert rv.get_json()['p95'] == [1, 7.85]
+
+
+def test_api_get_aggregate_no_data(client, populated_db):
+    rv = client.get("/api/v1/data/empty_metric/aggregate?bucket=1h")
+    assert rv.status_code == 404
+    assert 'No data exists for metric' in rv.get_json()['detail']
+
+
+@pytest.mark.parametrize("metric", ["missing", "99"])
+def test_api_get_aggregate_not_found(client, populated_db, metric):
+    rv = client.get("/api/v1/data/%s/aggregate?bucket=1h" % metric)
+    assert rv.status_code == 404
+    assert 'does not exist' in rv.get_json()['detail']
+
+
 @pytest.mark.usefixtures('populated_db')
 class TestDataPoint(object):
     def test_get(self, client):
@@ -184,6 +701,20 @@ class TestDataPoint(object):
         assert str(metric_id) in d['detail']
 
 
+def test_datapoint_get_query_count_is_constant(client, populated_db,
+                                               query_counter):
+    client.get(datapoint_url())
+    baseline = query_counter.call_count
+
+    client.post("/api/v1/data",
+                json=[{"metric": "foo", "value": n} for n in range(20)])
+    query_counter.reset_mock()
+
+    rv = client.get(datapoint_url())
+    assert len(rv.get_json()['results']) == 30
+    assert query_counter.call_count == baseline
+
+
 @pytest.mark.usefixtures('populated_db')
 class TestDataPointById(object):
     def test_get(self, client):
@@ -221,6 +752,11 @@ class TestDataPointById(object):
         assert old['value'] == -2
         assert new['value'] == 99
 
+    def test_get_single_query(self, client, query_counter):
+        rv = client.get(datapoint_url(6))
+        assert rv.status_code == 200
+        assert query_counter.call_count == 1
+
     @pytest.mark.parametrize('missing_key', ['metric_id', 'value'])
     def test_put_missing_required_key(self, client, missing_key):
         datapoint_id = 3
@@ -316,6 +852,25 @@ class TestDataPointById(object):
         after = client.get(datapoint_url(datapoint_id))
         assert after.status_code == 404
 
+    def test_delete_updates_summaries(self, client):
+        # The newest point of "old_data", 8 at 2019-01-03T16:14:27.
+        rv = client.delete(datapoint_url(10))
+        assert rv.status_code == 204
+
+        latest = client.get("/api/v1/data/old_data/latest").get_json()
+        assert latest['timestamp'] == "2019-01-03T16:13:23"
+        assert latest['value'] == 5
+        stats = client.get("/api/v1/metric/5").get_json()['stats']
+        assert stats['count'] == 3
+        url = "/api/v1/data/old_data/aggregate?bucket=1d&agg=count"
+        assert client.get(url).get_json()['count'] == [1, 1, 1]
+
+    def test_delete_at_epoch(self, client):
+        rv = client.delete(datapoint_url(7))
+        assert rv.status_code == 204
+        url = "/api/v1/data/old_data/aggregate?bucket=1d&agg=count"
+        assert client.get(url).get_json()['count'] == [1, 2]
+
     def test_delete_not_found(self, client, caplog):
         datapoint_id = 103132
         rv = client.delete(datapoint_url(datapoint_id))
@@ -327,6 +882,86 @@ class TestDataPointById(object):
         assert "API error" in caplog.text
 
 
+def test_datapoint_get_paginated(client, populated_db):
+    rv = client.get(datapoint_url() + "?limit=4")
+    assert rv.status_code == 200
+    d = rv.get_json()
+    assert d['count'] == 4
+    assert [x['datapoint_id'] for x in d['results']] == [1, 2, 3, 4]
+    assert d['prev'] is None
+    assert "after=4" in d['next']
+
+    rv = client.get(d['next'])
+    d = rv.get_json()
+    assert [x['datapoint_id'] for x in d['results']] == [5, 6, 7, 8]
+    assert "before=5" in d['prev']
+
+    rv = client.get(d['next'])
+    d = rv.get_json()
+    assert [x['datapoint_id'] for x in d['results']] == [9, 10]
+    assert d['next'] is None
+
+    # And walk back again.
+    rv = client.get(d['prev'])
+    d = rv.get_json()
+    assert [x['datapoint_id'] for x in d['results']] == [5, 6, 7, 8]
+    assert "after=8" in d['next']
+
+    rv = client.get(d['prev'])
+    d = rv.get_json()
+    assert [x['datapoint_id'] for x in d['results']] == [1, 2, 3, 4]
+    assert d['prev'] is None
+
+
+def test_datapoint_get_past_the_end(client, populated_db):
+    rv = client.get(datapoint_url() + "?after=10")
+    assert rv.status_code == 200
+    d = rv.get_json()
+    assert d['count'] == 0
+    assert d['results'] == []
+    assert d['next'] is None
+    assert d['prev'] is None
+
+
+@pytest.mark.parametrize("query, name", [
+    ("limit=0", "limit"),
+    ("limit=1001", "limit"),
+    ("after=a", "after"),
+    ("after=1&before=5", "before"),
+])
+def test_datapoint_get_invalid_page(client, populated_db, query, name):
+    rv = client.get(datapoint_url() + "?" + query)
+    assert rv.status_code == 400
+    d = rv.get_json()
+    assert "'{}'".format(name) in d['detail']
+
+
+def test_datapoint_get_stream(client, populated_db):
+    rv = client.get(datapoint_url() + "?stream=true&after=2&limit=5")
+    assert rv.status_code == 200
+    assert rv.is_streamed
+    d = rv.get_json()
+    assert d['count'] == 5
+    assert d['prev'] is None
+    assert d['next'] is None
+    assert [x['datapoint_id'] for x in d['results']] == [3, 4, 5, 6, 7]
+    assert d['results'][2]['metric']['name'] == "foo.bar"
+
+    # No limit is applied unless asked for.
+    rv = client.get(datapoint_url() + "?stream=true")
+    assert rv.get_json()['count'] == 10
+
+    rv = client.get(datapoint_url() + "?stream=true&after=10")
+    assert rv.get_json() == {"prev": None, "next": None,
+                             "results": [], "count": 0}
+
+
+def test_datapoint_get_stream_no_data(client):
+    rv = client.get(datapoint_url() + "?stream=true")
+    assert rv.status_code == 404
+    assert rv.get_json()['detail'] == "No data found."
+
+
 def test_datapoint_get_no_data(client):
     rv = client.get(datapoint_url())
     assert rv.status_code == 404
@@ -343,6 +978,27 @@ def test_api_get_metric_as_json(client, populated_db, caplog):
     print(d)
     assert d['metric_id'] == 2
     assert "API: get metric" in caplog.text
+    assert d['stats']['count'] == 4
+    assert d['stats']['min'] == 9
+    assert d['stats']['max'] == 25
+    assert d['stats']['sum'] == 66
+    assert d['stats']['mean'] == 16.5
+    assert d['stats']['last_value'] == 9
+
+
+def test_api_get_metric_stats(client, populated_db):
+    d = client.get(metric_url(5)).get_json()['stats']
+    assert d['count'] == 4
+    assert d['first'] == "1970-01-01T00:00:00"
+    assert d['last'] == "2019-01-03T16:14:27"
+    assert d['last_value'] == 8
+
+
+def test_api_get_metric_stats_no_data(client, populated_db):
+    d = client.get(metric_url(1)).get_json()['stats']
+    assert d['count'] == 0
+    assert d['min'] is None
+    assert d['last'] is None
 
 
 def test_api_get_metric_as_json_not_found(client, populated_db, caplog):
@@ -366,6 +1022,14 @@ def test_api_delete_metric(client, populated_db):
     assert after.status_code == 404
 
 
+def test_api_delete_metric_deletes_data(client, populated_db):
+    metric_id = db.get_metric_id("old_data")
+    assert client.delete(metric_url(metric_id)).status_code == 204
+    for model in (orm.DataPoint, orm.Rollup):
+        rows = model.select().where(model.metric == metric_id)
+        assert rows.count() == 0
+
+
 def test_api_delete_metric_not_found(client, populated_db, caplog):
     metric_id = 99
     rv = client.delete(metric_url(metric_id))
@@ -394,6 +1058,16 @@ def test_api_post_metric(client, populated_db):
     assert d['name'] == metric
     assert d['lower_limit'] == lower_limit
     assert d['metric_id'] == 7
+    assert d['retention_days'] is None
+
+
+def test_api_post_metric_retention(client, populated_db):
+    data = {"name": "new", "retention_days": 30, "retention_points": 1000}
+    rv = client.post(metric_url(), json=data)
+    assert rv.status_code == 201
+    d = rv.get_json()
+    assert d['retention_days'] == 30
+    assert d['retention_points'] == 1000
 
 
 def test_api_post_metric_already_exists(client, populated_db):
@@ -415,6 +1089,36 @@ def test_api_post_metric_missing_key(client, populated_db):
     assert "Missing required" in d['detail']
 
 
+@pytest.mark.parametrize("data", [
+    {"retention_days": "abc"},
+    {"retention_days": -1},
+    {"retention_points": 0},
+    {"retention_points": 2.5},
+    {"lower_limit": "abc"},
+])
+def test_api_post_metric_invalid(client, populated_db, data):
+    data["name"] = "new"
+    rv = client.post(metric_url(), json=data)
+    assert rv.status_code == 400
+    assert "Invalid metric" in rv.get_json()['detail']
+    assert client.get(metric_url(7)).status_code == 404
+
+
+@pytest.mark.parametrize("method", ["put", "patch"])
+@pytest.mark.parametrize("data", [
+    {"retention_days": "abc"},
+    {"retention_days": 0},
+    {"retention_points": 0},
+])
+def test_api_update_metric_invalid_retention(client, populated_db, method,
+                                             data):
+    data["name"] = "foo"
+    rv = getattr(client, method)(metric_url(2), json=data)
+    assert rv.status_code == 400
+    assert "retention_" in rv.get_json()['detail']
+    assert client.get(metric_url(2)).get_json()['retention_days'] is None
+
+
 def test_api_put_metric(client, populated_db):
     metric_id = 3
     data = {
@@ -540,6 +1244,32 @@ def test_api_patch_metric_doesnt_change_other_values(client, populated_db):
     assert new['upper_limit'] == original['upper_limit']
 
 
+@pytest.mark.parametrize("method", ["put", "patch"])
+def test_api_rename_metric_invalidates_metric_id_cache(client, populated_db,
+                                                       method):
+    # Make sure "foo" is cached, then rename it.
+    client.post("/api/v1/data", json={"metric": "foo", "value": 1})
+    rv = getattr(client, method)(metric_url(2), json={"name": "renamed"})
+    assert rv.status_code == 204
+
+    # New data for "foo" must not end up in the renamed metric.
+    client.post("/api/v1/data", json={"metric": "foo", "value": 2})
+    renamed = client.get("/api/v1/data/renamed").get_json()['rows']
+    assert len(renamed) == 5
+    foo = client.get("/api/v1/data/foo").get_json()['rows']
+    assert len(foo) == 1
+
+
+def test_api_delete_metric_invalidates_metric_id_cache(client, populated_db):
+    client.post("/api/v1/data", json={"metric": "foo", "value": 1})
+    assert client.delete(metric_url(2)).status_code == 204
+
+    rv = client.post("/api/v1/data", json={"metric": "foo", "value": 2})
+    assert rv.status_code == 201
+    foo = client.get("/api/v1/data/foo").get_json()['rows']
+    assert len(foo) == 1
+
+
 def test_api_patch_metric_not_found(client, populated_db):
     metric_id = 99
     data = {"units": "pears"}
@@ -579,6 +1309,15 @@ def test_api_get_metrics(client, populated_db):
     assert results[0]['name'] == "empty_metric"
 
 
+def test_api_get_metrics_paginated(client, populated_db):
+    rv = client.get(metric_url() + "?after=2&limit=3")
+    assert rv.status_code == 200
+    d = rv.get_json()
+    assert [x['metric_id'] for x in d['results']] == [3, 4, 5]
+    assert "after=5" in d['next']
+    assert "before=3" in d['prev']
+
+
 def test_api_get_metrics_no_data(client):
     rv = client.get(metric_url())
     assert rv.status_code == 404
@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
 """
 """
+import json
+import math
+import sqlite3
 from datetime import datetime
 
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import numpy as np
 import pytest
 from flask import current_app
 from flask import Response
@@ -10,7 +17,6 @@ from freezegun import freeze_time
 
 from trendlines import orm
 from trendlines import utils
-from .test_orm import _hash_file
 
 
 def test_adjust_jsonify_mimetype(app_context):
@@ -114,6 +120,80 @@ def test_format_data(raw_data):
         pytest.fail("data['timestamp'] is not the correct format")
 
 
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    ("1546532070", 1546532070),
+    ("1546532070.5", 1546532070.5),
+    ("2019-01-03", 1546473600),
+    ("2019-01-03T16:14", 1546532040),
+    ("2019-01-03T16:14:30", 1546532070),
+    ("2019-01-03T16:14:30Z", 1546532070),
+])
+def test_parse_timestamp(value, expected):
+    assert utils.parse_timestamp(value) == expected
+
+
+@pytest.mark.parametrize("value", [
+    "yesterday",
+    "2019-13-01",
+    "",
+    "nan",
+    "inf",
+    "-inf",
+    "1e400",
+    "-1e30",
+    "253402300800",         # 10000-01-01
+])
+def test_parse_timestamp_raises_value_error(value):
+    with pytest.raises(ValueError):
+        utils.parse_timestamp(value)
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    ("90", 90),
+    ("90s", 90),
+    ("15m", 900),
+    ("1h", 3600),
+    ("7d", 604800),
+    ("2w", 1209600),
+])
+def test_parse_duration(value, expected):
+    assert utils.parse_duration(value) == expected
+
+
+@pytest.mark.parametrize("value", [
+    "",
+    "h",
+    "1.5h",
+    "1y",
+    "0",
+    "-1h",
+    "99999999999999999999d",
+])
+def test_parse_duration_raises_value_error(value):
+    with pytest.raises(ValueError):
+        utils.parse_duration(value)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("mean", ["mean"]),
+    ("max,p95,count", ["max", "p95", "count"]),
+    ("p95,mean,p95", ["p95", "mean"]),
+    ("median,p0,p100,p99.9", ["median", "p0", "p100", "p99.9"]),
+])
+def test_parse_aggregates(value, expected):
+    assert utils.parse_aggregates(value) == expected
+
+
+@pytest.mark.parametrize("value", [
+    "", "avg", "mean,", "p", "pfoo", "p101", "p-1", "pnan", "Mean",
+])
+def test_parse_aggregates_raises_value_error(value):
+    with pytest.raises(ValueError):
+        utils.parse_aggregates(value)
+
+
 @freeze_time("2019-01-25T04:32:28Z")        # 1548390748
 @pytest.mark.parametrize("value, expected", [
     ("metric 15",
@@ -134,6 +214,9 @@ def test_parse_socket_data(value, expected):
     "metric 15 apple",
     "foo bar 16",
     "aasdas 24.4523 ",
+    "bad.metric nan",
+    "bad.metric inf",
+    "x 1 99999999999999999999",
 ])
 def test_parse_socket_data_raises_value_error(value):
     with pytest.raises(ValueError):
@@ -141,10 +224,273 @@ def test_parse_socket_data_raises_value_error(value):
 
 
 @freeze_time("2019-01-25T04:32:28Z")
-def test_backup_file(tmp_path):
-    path = tmp_path / "foo.bar"
-    path.write_text("hello")
-    rv = utils.backup_file(path)
-    assert rv.exists()
-    assert rv.name == "foo.bar.20190125_043228"
-    assert _hash_file(path) == _hash_file(rv)
+def test_backup_sqlite(tmp_path):
+    path = tmp_path / "foo.db"
+    conn = sqlite3.connect(str(path))
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE foo (x INTEGER)")
+    conn.executemany("INSERT INTO foo VALUES (?)", [(n, ) for n in range(5000)])
+    conn.commit()
+
+    # The connection is still open, so some data is only in the WAL file.
+    rv = utils.backup_sqlite(path, pages=2)
+    conn.close()
+    assert rv.name == "foo.db.20190125_043228"
+
+    backup = sqlite3.connect(str(rv))
+    assert backup.execute("SELECT count(*) FROM foo").fetchone() == (5000, )
+    backup.close()
+
+
+def test_copy_sqlite_replaces_contents(tmp_path):
+    src = tmp_path / "src.db"
+    dst = tmp_path / "dst.db"
+    for path, table in ((src, "a"), (dst, "b")):
+        conn = sqlite3.connect(str(path))
+        conn.execute("CREATE TABLE %s (x INTEGER)" % table)
+        conn.commit()
+        conn.close()
+
+    utils.copy_sqlite(src, dst)
+
+    conn = sqlite3.connect(str(dst))
+    tables = conn.execute("SELECT name FROM sqlite_master").fetchall()
+    conn.close()
+    assert tables == [("a", )]
+
+
+@pytest.mark.parametrize("item, expected", [
+    ({"metric": "foo", "value": 15}, ("foo", 15, None)),
+    ({"metric": "foo.bar", "value": -2.5, "time": 1546532070},
+     ("foo.bar", -2.5, 1546532070)),
+])
+def test_parse_data_point(item, expected):
+    assert utils.parse_data_point(item) == expected
+
+
+@pytest.mark.parametrize("item", [
+    "foo 15",
+    {"value": 15},
+    {"metric": "foo"},
+    {"metric": "", "value": 15},
+    {"metric": "foo", "value": "15"},
+    {"metric": "foo", "value": True},
+    {"metric": "foo", "value": 15, "time": "yesterday"},
+    {"metric": "foo", "value": float("nan")},
+    {"metric": "foo", "value": float("inf")},
+    {"metric": "foo", "value": float("-inf")},
+    {"metric": "foo", "value": 10 ** 400},
+    {"metric": "foo", "value": 15, "time": float("nan")},
+    {"metric": "foo", "value": 15, "time": 1e300},
+    {"metric": "foo", "value": 15, "time": -1e300},
+    {"metric": "foo", "value": 15, "time": 10 ** 400},
+])
+def test_parse_data_point_raises_value_error(item):
+    with pytest.raises(ValueError):
+        utils.parse_data_point(item)
+
+
+def test_lru_cache():
+    cache = utils.LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1      # "b" is now the least recently used
+    cache.set("c", 3)
+    assert len(cache) == 2
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_lru_cache_discard_clear_and_resize():
+    cache = utils.LRUCache(maxsize=3)
+    for n, k in enumerate("abc"):
+        cache.set(k, n)
+    cache.discard("b")
+    cache.discard("missing")
+    assert "b" not in cache
+    cache.resize(1)
+    assert len(cache) == 1
+    assert "c" in cache
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_lru_cache_ttl():
+    cache = utils.LRUCache(maxsize=2, ttl=10)
+    with patch("time.monotonic", return_value=100):
+        cache.set("a", 1)
+    with patch("time.monotonic", return_value=109):
+        assert cache.get("a") == 1
+        assert "a" in cache
+    with patch("time.monotonic", return_value=110):
+        assert "a" not in cache
+        assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_cached_value():
+    func = MagicMock(side_effect=[1, 2])
+    cache = utils.CachedValue()
+    assert cache.get(func) == 1
+    assert cache.get(func) == 1
+    assert func.call_count == 1
+    cache.invalidate()
+    assert cache.get(func) == 2
+    assert func.call_count == 2
+
+
+def test_cached_value_ttl():
+    func = MagicMock(side_effect=[1, 2])
+    cache = utils.CachedValue(ttl=10)
+    with patch("time.monotonic", return_value=100):
+        assert cache.get(func) == 1
+    with patch("time.monotonic", return_value=109):
+        assert cache.get(func) == 1
+    with patch("time.monotonic", return_value=110):
+        assert cache.get(func) == 2
+
+
+def test_cached_value_invalidated_while_computing():
+    cache = utils.CachedValue()
+
+    def compute():
+        cache.invalidate()
+        return "stale"
+
+    assert cache.get(compute) == "stale"
+    assert cache.get(lambda: "fresh") == "fresh"
+
+
+def test_build_jstree_children():
+    tree = utils.build_jstree_data([orm.Metric(metric_id=1, name="foo"),
+                                    orm.Metric(metric_id=2, name="bar.baz")])
+    rv = utils.build_jstree_children(tree)
+    assert rv == {
+        "#": [
+            {"id": "bar", "text": "bar", "metric_id": None, "children": True},
+            {"id": "foo", "text": "foo", "metric_id": 1, "children": False},
+        ],
+        "bar": [
+            {"id": "bar.baz", "text": "bar.baz", "metric_id": 2,
+             "children": False},
+        ],
+        "bar.baz": [],
+        "foo": [],
+    }
+    # The tree itself is left alone.
+    assert all("parent" in node for node in tree)
+
+
+def test_build_jstree_children_empty():
+    assert utils.build_jstree_children([]) == {"#": []}
+
+
+def test_build_jstree_data_many_metrics():
+    metrics = [orm.Metric(metric_id=n, name="a.b{}.c{}.d".format(n % 100, n))
+               for n in range(40000)]
+    rv = utils.build_jstree_data(metrics)
+    # a, 100 * a.bX, 40000 * (a.bX.cY, a.bX.cY.d)
+    assert len(rv) == 1 + 100 + 2 * 40000
+    ids = set(d['id'] for d in rv)
+    assert len(ids) == len(rv)
+    assert all(d['parent'] == "#" or d['parent'] in ids for d in rv)
+
+
+def _lttb_reference(y, n_out):
+    """
+    A direct, loop-based LTTB implementation to check `utils.lttb` against.
+    """
+    n = len(y)
+    every = (n - 2) / (n_out - 2)
+    selected = [0]
+    a = 0
+    for i in range(n_out - 2):
+        start = int(i * every) + 1
+        stop = int((i + 1) * every) + 1
+        next_start = stop
+        next_stop = min(int((i + 2) * every) + 1, n - 1)
+        if i == n_out - 3:
+            avg_x, avg_y = n - 1, y[-1]
+        else:
+            avg_x = sum(range(next_start, next_stop)) / (next_stop - next_start)
+            avg_y = sum(y[next_start:next_stop]) / (next_stop - next_start)
+        areas = [abs((a - avg_x) * (y[j] - y[a]) - (a - j) * (avg_y - y[a]))
+                 for j in range(start, stop)]
+        a = start + areas.index(max(areas))
+        selected.append(a)
+    selected.append(n - 1)
+    return selected
+
+
+@pytest.mark.parametrize("n, n_out", [
+    (10, 3),
+    (100, 7),
+    (1000, 100),
+    (1001, 999),
+])
+def test_lttb_matches_reference(n, n_out):
+    rng = np.random.RandomState(n)
+    y = list(rng.normal(size=n).cumsum())
+    rv = utils.lttb(y, n_out)
+    assert len(rv) == n_out
+    assert list(rv) == _lttb_reference(y, n_out)
+
+
+def test_lttb_keeps_spikes():
+    y = np.zeros(10000)
+    y[1234] = 100
+    y[8765] = -100
+    rv = utils.lttb(y, 50)
+    assert rv[0] == 0
+    assert rv[-1] == 9999
+    assert 1234 in rv
+    assert 8765 in rv
+    assert all(np.diff(rv) > 0)
+
+
+def test_lttb_short_series():
+    assert list(utils.lttb([1, 2, 3], 5)) == [0, 1, 2]
+
+
+def test_lttb_raises_value_error():
+    with pytest.raises(ValueError):
+        utils.lttb(range(10), 2)
+
+
+def test_format_columnar():
+    rows = [(datetime(2019, 1, 3, 16, 13, 23), 5.0, 3),
+            (datetime(2019, 1, 3, 16, 14, 27), 8.0, 4)]
+    rv = utils.format_columnar(rows, "apples")
+    assert rv == {"timestamps": ["2019-01-03T16:13:23", "2019-01-03T16:14:27"],
+                  "values": [5.0, 8.0],
+                  "ids": [3, 4],
+                  "units": "apples"}
+
+    rv = utils.format_columnar(rows, indices=np.array([0, 7]))
+    assert rv['n'] == [0, 7]
+
+
+def test_format_columnar_empty():
+    rv = utils.format_columnar([])
+    assert rv == {"timestamps": [], "values": [], "ids": [], "units": None}
+
+
+def test_format_data_with_indices(raw_data):
+    rv = utils.format_data(raw_data[1:3], indices=[5, 9])
+    assert [r['n'] for r in rv['rows']] == [5, 9]
+    assert [r['value'] for r in rv['rows']] == [17, 25]
+
+
+@pytest.mark.parametrize("items", [
+    [],
+    [1],
+    [{"a": 1}, {"b": [2, 3]}, None],
+    list(range(1234)),
+])
+def test_iter_json_array(items):
+    chunks = list(utils.iter_json_array(items, chunk_size=100))
+    assert json.loads("".join(chunks)) == items
+    # The brackets, then one chunk per 100 items.
+    assert len(chunks) == math.ceil(len(items) / 100) + 2